@@ -0,0 +1,212 @@
+# flow_controller_service/ai_client.py
+# Cliente HTTP da API de IA (V50MCP_AI_QUERY_API_URL) usado pelos nós gptQuery:
+# sessão keep-alive com pool de conexões, timeouts separados de conexão/leitura,
+# semáforo limitando chamadas simultâneas por processo, retry com jitter em 5xx/timeouts
+# e circuit breaker para falhar na hora quando o upstream está fora.
+# AIResponseCache: cache opcional (por nó) das respostas, com TTL, LRU e coalescência de chamadas idênticas em voo.
+import collections
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from process_local import after_fork
+
+logger = logging.getLogger("flow_controller.ai_client")
+
+
+class AIUpstreamUnavailable(Exception):
+    # Circuito aberto ou limite de concorrência esgotado: a chamada nem foi feita
+    pass
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}"); self.response = response
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold; self.reset_timeout = reset_timeout
+        self._lock = threading.Lock(); self._failures = 0; self._opened_at = None
+        self._probe_in_flight = None  # thread da chamada de teste em meia-abertura
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None: return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None: return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probe_in_flight is not None: return False
+            self._probe_in_flight = threading.get_ident()  # Meia-abertura: deixa passar uma única chamada de teste
+            return True
+
+    def record_success(self):
+        with self._lock: self._failures = 0; self._opened_at = None; self._probe_in_flight = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1; self._probe_in_flight = None
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None: logger.error(f"Circuit breaker da API de IA ABERTO após {self._failures} falhas seguidas.")
+                self._opened_at = time.monotonic()
+
+    def release_probe(self):
+        # Chamada de teste que terminou sem veredito (ex.: sem vaga no semáforo, exceção inesperada): libera a próxima tentativa
+        with self._lock:
+            if self._probe_in_flight == threading.get_ident(): self._probe_in_flight = None
+
+
+class AIQueryClient:
+    def __init__(self, connect_timeout: float = 5.0, read_timeout: float = 60.0, max_concurrency: int = 16, queue_timeout: float = 2.0,
+                 max_retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 4.0, total_deadline: float = 60.0,
+                 breaker: CircuitBreaker | None = None):
+        self.connect_timeout = connect_timeout; self.read_timeout = read_timeout
+        self.max_concurrency = max_concurrency; self.queue_timeout = queue_timeout
+        self.max_retries = max_retries; self.backoff_base = backoff_base; self.backoff_max = backoff_max
+        self.total_deadline = total_deadline
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._drop_session(); after_fork(self._drop_session)
+
+    def _drop_session(self):
+        # Sessão criada por processo (não herdar sockets keep-alive através de fork)
+        self._session = None; self._session_lock = threading.Lock()
+
+    def _get_session(self) -> requests.Session:
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_concurrency, max_retries=0)
+                    session.mount("http://", adapter); session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": espalha as novas tentativas para não sincronizar rajadas contra o upstream
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def query(self, url: str, payload: dict) -> dict:
+        if not self.breaker.allow(): raise AIUpstreamUnavailable("circuit breaker aberto")
+        try:
+            if not self._slots.acquire(timeout=self.queue_timeout):
+                raise AIUpstreamUnavailable(f"limite de {self.max_concurrency} chamadas simultâneas à IA atingido")
+            try: return self._post_with_retries(url, payload)
+            finally: self._slots.release()
+        finally: self.breaker.release_probe()  # Toda saída resolve a chamada de teste da meia-abertura
+
+    def _post_with_retries(self, url: str, payload: dict) -> dict:
+        session = self._get_session(); started = time.monotonic(); attempt = 0
+        while True:
+            remaining = self.total_deadline - (time.monotonic() - started)
+            try:
+                response = session.post(url, json=payload, timeout=(self.connect_timeout, max(0.1, min(self.read_timeout, remaining))))
+                if response.status_code >= 500: raise _RetryableStatus(response)
+                self.breaker.record_success()  # Respondeu (2xx ou 4xx não-retentável): o upstream está de pé
+                response.raise_for_status()
+                return response.json()
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, _RetryableStatus) as e:
+                delay = self._backoff(attempt)
+                if attempt >= self.max_retries or time.monotonic() - started + delay >= self.total_deadline:
+                    self.breaker.record_failure()
+                    if isinstance(e, _RetryableStatus): e.response.raise_for_status()
+                    raise
+                attempt += 1
+                logger.warning(f"API de IA: {type(e).__name__} ({e}). Nova tentativa {attempt}/{self.max_retries} em {delay:.2f}s.")
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        return {"circuit": self.breaker.state, "max_concurrency": self.max_concurrency}
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event(); self.result = None; self.error = None
+
+
+def ai_cache_key(payload: dict) -> str:
+    # Modelo, temperatura, maxTokens, system message e prompt renderizados; a apiKey entra só como hash (uma conta não responde pela outra)
+    api_key = payload.get("apiKey") or ""
+    material = {k: payload.get(k) for k in ("model", "temperature", "maxTokens", "systemMessage", "prompt")}
+    material["account"] = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class AIResponseCache:
+    # LRU com TTL por entrada. Só respostas de sucesso são guardadas; chamadas idênticas simultâneas esperam a primeira (singleflight).
+    def __init__(self, max_entries: int = 10000, default_ttl: float = 300.0, wait_timeout: float = 65.0):
+        self.max_entries = max_entries; self.default_ttl = default_ttl; self.wait_timeout = wait_timeout
+        self._reset(); after_fork(self._reset)
+        self.hits = 0; self.misses = 0; self.coalesced = 0; self.evicted = 0; self.expired = 0
+
+    def _reset(self):
+        # Locks/entradas não atravessam fork: cada processo começa com o cache vazio
+        self._lock = threading.Lock(); self._entries = collections.OrderedDict(); self._in_flight = {}
+
+
+    def get_or_query(self, key: str, ttl: float | None, fetch) -> tuple[dict, str]:
+        # Retorna (resposta, "hit" | "miss" | "coalesced"); fetch() só é chamado na falta
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic(): self._entries.move_to_end(key); self.hits += 1; return entry[1], "hit"
+                del self._entries[key]; self.expired += 1
+            flight = self._in_flight.get(key); leader = flight is None
+            if leader: flight = self._in_flight[key] = _Flight(); self.misses += 1
+            else: self.coalesced += 1
+        if not leader:
+            if not flight.done.wait(self.wait_timeout): raise AIUpstreamUnavailable(f"chamada idêntica em andamento não respondeu em {self.wait_timeout}s")
+            if flight.error is not None: raise flight.error
+            return flight.result, "coalesced"
+        try:
+            flight.result = fetch()
+            if isinstance(flight.result, dict) and flight.result.get("success") and "response" in flight.result:
+                self._store(key, flight.result, ttl or self.default_ttl)
+            return flight.result, "miss"
+        except Exception as e: flight.error = e; raise
+        finally:
+            with self._lock: self._in_flight.pop(key, None)
+            flight.done.set()
+
+    def _store(self, key: str, response: dict, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, response); self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False); self.evicted += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                    "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else None, "evicted": self.evicted, "expired": self.expired}
+
+
+def create_ai_client_from_env() -> AIQueryClient:
+    return AIQueryClient(
+        connect_timeout=float(os.environ.get("AI_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(os.environ.get("AI_READ_TIMEOUT", "60")),
+        max_concurrency=int(os.environ.get("AI_MAX_CONCURRENCY", "16")),
+        queue_timeout=float(os.environ.get("AI_QUEUE_TIMEOUT", "2")),
+        max_retries=int(os.environ.get("AI_MAX_RETRIES", "2")),
+        backoff_base=float(os.environ.get("AI_RETRY_BACKOFF_BASE", "0.5")),
+        backoff_max=float(os.environ.get("AI_RETRY_BACKOFF_MAX", "4")),
+        total_deadline=float(os.environ.get("AI_TOTAL_DEADLINE", "60")),
+        breaker=CircuitBreaker(int(os.environ.get("AI_CIRCUIT_FAILURE_THRESHOLD", "5")), float(os.environ.get("AI_CIRCUIT_RESET_TIMEOUT", "30"))),
+    )
+
+
+def create_ai_response_cache_from_env() -> AIResponseCache:
+    # Espera de chamadas coalescidas limitada ao pior caso da chamada líder (deadline total + conexão)
+    return AIResponseCache(int(os.environ.get("AI_CACHE_MAX_ENTRIES", "10000")), float(os.environ.get("AI_CACHE_DEFAULT_TTL", "300")),
+                           float(os.environ.get("AI_TOTAL_DEADLINE", "60")) + float(os.environ.get("AI_CONNECT_TIMEOUT", "5")))
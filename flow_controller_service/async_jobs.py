@@ -0,0 +1,243 @@
+# flow_controller_service/async_jobs.py
+# Execução adiada de mensagens: fila em processo com pool de threads, preservando a ordem
+# por sender (mensagens do mesmo sender_id rodam em série; senders diferentes em paralelo),
+# registro dos resultados por job_id e entrega do payload via callback HTTP.
+# Os resultados ficam no mesmo backend das sessões (memória, Redis ou MySQL): com vários workers
+# o GET /result/<job_id> pode cair em outro processo que não o que executou o job.
+import collections
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from process_local import ProcessOnce, after_fork
+
+logger = logging.getLogger("flow_controller.async_jobs")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class SenderSerialExecutor:
+    def __init__(self, workers: int = 8, max_queued: int = 10000, name: str = "flow-worker"):
+        self.workers = workers; self.max_queued = max_queued; self.name = name
+        self._started = ProcessOnce()  # Threads não sobrevivem a fork: o pool sobe no primeiro uso dentro de cada processo
+
+    def _start_pool(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # sender_id -> deque de jobs ainda não executados
+        self._ready = queue.Queue()  # senders com trabalho e sem ninguém executando
+        self._queued = 0
+        for i in range(self.workers):
+            threading.Thread(target=self._worker_loop, name=f"{self.name}-{i}", daemon=True).start()
+
+    def submit(self, sender_id: str, fn) -> None:
+        self._started.run(self._start_pool)
+        with self._lock:
+            if self._queued >= self.max_queued: raise QueueFull(f"Fila assíncrona cheia ({self.max_queued} jobs).")
+            self._queued += 1
+            jobs = self._pending.get(sender_id)
+            if jobs is not None: jobs.append(fn); return  # Já está na fila/rodando: o worker atual pega na sequência
+            self._pending[sender_id] = collections.deque([fn])
+        self._ready.put(sender_id)
+
+    def _worker_loop(self):
+        while True:
+            sender_id = self._ready.get()
+            with self._lock: fn = self._pending[sender_id].popleft()
+            try: fn()
+            except Exception as e: logger.error(f"Job assíncrono de {sender_id} falhou: {e}", exc_info=True)
+            with self._lock:
+                self._queued -= 1
+                if self._pending[sender_id]: requeue = True
+                else: del self._pending[sender_id]; requeue = False
+            if requeue: self._ready.put(sender_id)
+
+    def stats(self) -> dict:
+        if not self._started.done: return {"workers": self.workers, "queued": 0, "senders": 0}
+        with self._lock: return {"workers": self.workers, "queued": self._queued, "senders": len(self._pending)}
+
+
+class JobStore:
+    # Resultados ficam disponíveis em /result/<job_id> por ttl segundos (apenas neste processo)
+    backend_name = "memory"
+
+    def __init__(self, ttl: float = 600.0, max_entries: int = 100000):
+        self.ttl = ttl; self.max_entries = max_entries
+        self._jobs = collections.OrderedDict(); self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._jobs:
+            job_id, job = next(iter(self._jobs.items()))
+            if len(self._jobs) <= self.max_entries and now - job["created_at"] < self.ttl: break
+            del self._jobs[job_id]
+
+    def create(self, job_id: str, sender_id: str) -> dict:
+        now = time.time()
+        job = {"job_id": job_id, "sender_id": sender_id, "status": "queued", "created_at": now}
+        with self._lock: self._prune(now); self._jobs[job_id] = job
+        return job
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None: job.update(fields)
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+class RedisJobStore(JobStore):
+    # Um HASH por job (cada campo em JSON) com EXPIRE ttl; visível para todos os workers/réplicas
+    backend_name = "redis"
+
+    def __init__(self, client, key_prefix: str = "flow_job:", ttl: float = 600.0):
+        self._client = client; self._prefix = key_prefix; self.ttl = ttl
+
+    def _write(self, job_id: str, fields: dict):
+        with self._client.pipeline() as pipe:
+            pipe.hset(f"{self._prefix}{job_id}", mapping={name: json.dumps(value, default=str) for name, value in fields.items()})
+            pipe.expire(f"{self._prefix}{job_id}", max(1, int(self.ttl))); pipe.execute()
+
+    def create(self, job_id, sender_id):
+        job = {"job_id": job_id, "sender_id": sender_id, "status": "queued", "created_at": time.time()}
+        self._write(job_id, job)
+        return job
+
+    def update(self, job_id, **fields):
+        if self._client.exists(f"{self._prefix}{job_id}"): self._write(job_id, fields)
+
+    def get(self, job_id):
+        raw = self._client.hgetall(f"{self._prefix}{job_id}")
+        if not raw: return None
+        return {(name.decode("utf-8") if isinstance(name, bytes) else name): json.loads(value) for name, value in raw.items()}
+
+
+class MySQLJobStore(JobStore):
+    # Tabela flow_async_jobs (job em JSON), criada no primeiro uso; jobs mais velhos que ttl são apagados de tempos em tempos
+    backend_name = "mysql"
+
+    def __init__(self, connection_factory, table: str = "flow_async_jobs", ttl: float = 600.0):
+        self._connection = connection_factory; self._table = table; self.ttl = ttl
+        self._table_ready = False; self._last_prune = 0.0
+
+    def ensure_table(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self._table} (
+                    job_id VARCHAR(64) NOT NULL PRIMARY KEY,
+                    data LONGTEXT NOT NULL,
+                    created_at DOUBLE NOT NULL,
+                    KEY idx_created_at (created_at)
+                ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci""")
+                conn.commit()
+            finally: cursor.close()
+        self._table_ready = True
+
+    def _execute(self, query: str, params: tuple = (), fetch: bool = False):
+        if not self._table_ready: self.ensure_table()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params)
+                result = cursor.fetchone() if fetch else cursor.rowcount
+                conn.commit()
+                return result
+            finally: cursor.close()
+
+    def create(self, job_id, sender_id):
+        now = time.time()
+        job = {"job_id": job_id, "sender_id": sender_id, "status": "queued", "created_at": now}
+        if now - self._last_prune > min(60.0, self.ttl):
+            self._last_prune = now; self._execute(f"DELETE FROM {self._table} WHERE created_at < %s", (now - self.ttl,))
+        self._execute(f"INSERT INTO {self._table} (job_id, data, created_at) VALUES (%s, %s, %s)", (job_id, json.dumps(job, default=str), now))
+        return job
+
+    def update(self, job_id, **fields):
+        # Só o worker que executa o job escreve nele depois do create: ler-alterar-gravar basta
+        job = self.get(job_id)
+        if job is None: return
+        job.update(fields)
+        self._execute(f"UPDATE {self._table} SET data = %s WHERE job_id = %s", (json.dumps(job, default=str), job_id))
+
+    def get(self, job_id):
+        row = self._execute(f"SELECT data FROM {self._table} WHERE job_id = %s AND created_at >= %s", (job_id, time.time() - self.ttl), fetch=True)
+        if not row: return None
+        return json.loads(row[0].decode("utf-8") if isinstance(row[0], (bytes, bytearray)) else row[0])
+
+
+class CallbackSender:
+    def __init__(self, timeout: float = 10.0, max_retries: int = 3, backoff_base: float = 0.5):
+        self.timeout = timeout; self.max_retries = max_retries; self.backoff_base = backoff_base
+        self._session = None; after_fork(self._drop_session)
+
+    def _drop_session(self):
+        self._session = None  # Não herda sockets keep-alive através de fork
+
+    def _get_session(self):
+        if self._session is None:
+            session = requests.Session(); session.mount("http://", HTTPAdapter(pool_maxsize=32)); session.mount("https://", HTTPAdapter(pool_maxsize=32))
+            self._session = session
+        return self._session
+
+    def send(self, url: str, payload: dict) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._get_session().post(url, json=payload, timeout=self.timeout)
+                if response.status_code < 500:
+                    if response.status_code >= 400: logger.error(f"Callback {url} rejeitou o resultado: HTTP {response.status_code}.")
+                    return response.status_code < 400
+                error = f"HTTP {response.status_code}"
+            except requests.exceptions.RequestException as e: error = str(e)
+            if attempt < self.max_retries:
+                delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+                logger.warning(f"Callback {url} falhou ({error}). Nova tentativa em {delay:.2f}s."); time.sleep(delay)
+        logger.error(f"Callback {url} falhou definitivamente após {self.max_retries + 1} tentativas: {error}")
+        return False
+
+
+def create_executor_from_env() -> SenderSerialExecutor:
+    return SenderSerialExecutor(int(os.environ.get("ASYNC_WORKERS", "8")), int(os.environ.get("ASYNC_MAX_QUEUE", "10000")))
+
+
+def create_job_store_from_env(mysql_connection_factory=None) -> JobStore:
+    # Mesmo backend do session store por padrão (ASYNC_RESULT_BACKEND sobrescreve)
+    backend = (os.environ.get("ASYNC_RESULT_BACKEND") or os.environ.get("SESSION_STORE_BACKEND", "memory")).lower()
+    ttl = float(os.environ.get("ASYNC_RESULT_TTL", "600"))
+    if backend == "memory": return JobStore(ttl, int(os.environ.get("ASYNC_RESULT_MAX_ENTRIES", "100000")))
+    if backend == "redis":
+        try: import redis
+        except ImportError as e: raise RuntimeError("ASYNC_RESULT_BACKEND=redis requer o pacote 'redis' instalado.") from e
+        return RedisJobStore(redis.Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/0")), os.environ.get("ASYNC_RESULT_KEY_PREFIX", "flow_job:"), ttl)
+    if backend == "mysql":
+        if mysql_connection_factory is None: raise RuntimeError("ASYNC_RESULT_BACKEND=mysql requer uma fábrica de conexões MySQL.")
+        return MySQLJobStore(mysql_connection_factory, os.environ.get("ASYNC_RESULT_TABLE", "flow_async_jobs"), ttl)
+    raise ValueError(f"ASYNC_RESULT_BACKEND desconhecido: '{backend}' (use memory, redis ou mysql).")
+
+
+def callback_url_allowed(url: str, allowed_urls: list) -> bool:
+    # Mesmo esquema e host:porta de uma URL permitida, e caminho igual ou abaixo do dela
+    try: target = urlsplit(url)
+    except ValueError: return False
+    if target.scheme not in ("http", "https") or not target.netloc: return False
+    for allowed in allowed_urls:
+        base = urlsplit(allowed)
+        if (target.scheme, target.netloc.lower()) != (base.scheme, base.netloc.lower()): continue
+        base_path = base.path.rstrip("/")
+        if target.path == base_path or target.path.startswith(base_path + "/") or not base_path: return True
+    return False
+
+
+def create_callback_sender_from_env() -> CallbackSender:
+    return CallbackSender(float(os.environ.get("CALLBACK_TIMEOUT", "10")), int(os.environ.get("CALLBACK_MAX_RETRIES", "3")))
@@ -0,0 +1,21 @@
+# flow_controller_service/bench/bench_app.py
+# flow_controller com a tabela flows em memória: alvo do gunicorn no teste de carga
+# ("gunicorn bench_app:app") e do driver em processo (Flask test client).
+# BENCH_FLOW_SPEC (JSON com os argumentos de generate_flow) define o fluxo ativo sintético.
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR)); sys.path.insert(0, BENCH_DIR)
+from load_harness import FlowsTable, generate_flow, install_fake_mysql  # noqa: E402
+
+flows_table = FlowsTable()
+flows_table.add(1, generate_flow(**json.loads(os.environ.get("BENCH_FLOW_SPEC", "{}"))), status="active")
+install_fake_mysql(flows_table)
+os.environ.setdefault("FLOW_POLL_INTERVAL", "0")
+os.environ.setdefault("FLOW_SNAPSHOT_DIR", "")  # Sempre compila o fluxo sintético da vez (sem snapshot de uma rodada anterior)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import flow_controller  # noqa: E402
+from flow_controller import app  # noqa: E402,F401
@@ -0,0 +1,224 @@
+# flow_controller_service/bench/bench_load.py
+# Teste de carga reproduzível do /process_message sem MySQL nem API de IA: fluxo sintético
+# (load_harness.generate_flow), tabela flows em memória e IA falsa com latência configurável.
+# Vários senders simulados em paralelo via Flask test client (em processo) e/ou gunicorn real.
+# Reporta p50/p90/p99, mensagens/s e memória por sessão; salva JSON e compara com um baseline.
+# Uso: python bench/bench_load.py --mode both --senders 200 --messages 10 --concurrency 32 \
+#          --nodes 60 --ai-latency-ms 50 --output bench/results/atual.json --baseline bench/results/baseline.json
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVICE_DIR); sys.path.insert(0, BENCH_DIR)
+from load_harness import DEFAULT_NODE_MIX, FakeAIServer, generate_flow, simulated_message  # noqa: E402
+
+# Métricas comparadas com o baseline e o sentido em que "melhor" aponta
+COMPARED_METRICS = {"p50_ms": "lower", "p99_ms": "lower", "msgs_per_sec": "higher", "session_bytes": "lower"}
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    return {"messages": len(latencies), "errors": errors, "elapsed_s": round(elapsed, 3),
+            "msgs_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3), "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3), "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0}
+
+
+def drive(send, senders: int, messages: int, concurrency: int, seed: int) -> dict:
+    # Cada sender manda suas mensagens em sequência (como um contato real); senders diferentes rodam em paralelo
+    latencies = []; errors = [0]; lock = threading.Lock()
+
+    def conversation(sender_index: int):
+        rng = random.Random(seed * 100003 + sender_index); local = []; failed = 0
+        for _ in range(messages):
+            started = time.perf_counter()
+            ok = send(f"bench-{seed}-{sender_index}", simulated_message(rng))
+            local.append(time.perf_counter() - started); failed += 0 if ok else 1
+        with lock: latencies.extend(local); errors[0] += failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool: list(pool.map(conversation, range(senders)))
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def configure_environment(args, ai_url: str, spec: dict):
+    os.environ["BENCH_FLOW_SPEC"] = json.dumps(spec)
+    os.environ["V50MCP_AI_QUERY_API_URL"] = ai_url
+    os.environ.setdefault("SESSION_STORE_BACKEND", "memory")
+    os.environ.setdefault("LOG_LEVEL", args.log_level)
+    os.environ.setdefault("AI_MAX_CONCURRENCY", str(max(16, args.concurrency)))
+
+
+def run_testclient(args) -> dict:
+    import bench_app
+    client = bench_app.app.test_client()
+
+    def send(sender_id, message):
+        return client.post("/process_message", json={"sender_id": sender_id, "message": message}).status_code == 200
+
+    for index in range(min(20, args.senders)): send(f"warmup-{index}", "oi")  # Compila caminhos quentes e aquece o pool da IA
+    result = drive(send, args.senders, args.messages, args.concurrency, args.seed)
+    result["session_bytes"] = measure_session_memory(send, bench_app.flow_controller.session_store, args.memory_sessions)
+    return result
+
+
+def measure_session_memory(send, session_store, count: int) -> float:
+    # Bytes alocados por sessão viva (tracemalloc), criando `count` sessões novas com uma mensagem cada
+    session_store.clear(); gc.collect()
+    tracemalloc.start(); before = tracemalloc.get_traced_memory()[0]
+    for index in range(count): send(f"mem-{index}", "oi")
+    gc.collect(); after = tracemalloc.get_traced_memory()[0]; tracemalloc.stop()
+    return round((after - before) / max(1, session_store.count()), 1)
+
+
+def _worker_rss_bytes(master_pid: int) -> int:
+    # Soma o RSS dos workers (filhos do master do gunicorn) via /proc
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        try:
+            with open(f"/proc/{entry}/status") as f: status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError: continue
+        if int(status.get("PPid", "0").strip()) == master_pid: total += int(status.get("VmRSS", "0 kB").split()[0]) * 1024
+    return total
+
+
+def run_gunicorn(args) -> dict:
+    port = args.port
+    command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(SERVICE_DIR, "gunicorn.conf.py"), "--chdir", BENCH_DIR,
+               "-b", f"127.0.0.1:{port}", "-w", str(args.workers), "--threads", str(args.threads), "bench_app:app"]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([BENCH_DIR, SERVICE_DIR]))
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL if not args.verbose else None, stderr=subprocess.STDOUT if not args.verbose else None)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if requests.get(f"{base_url}/health", timeout=2).status_code in (200, 503): break
+            except requests.exceptions.RequestException: pass
+            if process.poll() is not None or time.monotonic() > deadline: raise RuntimeError("gunicorn não subiu (rode com --verbose).")
+            time.sleep(0.2)
+        local = threading.local()
+
+        def send(sender_id, message):
+            session = getattr(local, "session", None)
+            if session is None: session = local.session = requests.Session()
+            try: return session.post(f"{base_url}/process_message", json={"sender_id": sender_id, "message": message}, timeout=60).status_code == 200
+            except requests.exceptions.RequestException: return False
+
+        for index in range(min(20, args.senders)): send(f"warmup-{index}", "oi")
+        rss_before = _worker_rss_bytes(process.pid)
+        result = drive(send, args.senders, args.messages, args.concurrency, args.seed)
+        for index in range(args.memory_sessions): send(f"mem-{index}", "oi")
+        rss_after = _worker_rss_bytes(process.pid)
+        live = requests.get(f"{base_url}/health", timeout=5).json().get("details", {}).get("sessions", {}).get("live")
+        # Só com sessões em memória (e então 1 worker, ver main) o RSS cresce com as sessões e o "live" do /health é o do mesmo processo;
+        # com Redis/MySQL elas ficam fora dos workers e bytes/sessão não se mede por RSS
+        result.update({"workers": args.workers, "threads": args.threads, "worker_rss_bytes": rss_after, "live_sessions": live,
+                       "session_bytes": round((rss_after - rss_before) / live, 1) if live and args.workers == 1 else None})
+        return result
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try: process.wait(timeout=30)
+        except subprocess.TimeoutExpired: process.kill()
+
+
+def git_revision() -> str | None:
+    try: return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SERVICE_DIR, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    print(f"\n{'modo':>10} {'métrica':>14} {'baseline':>12} {'atual':>12} {'variação':>9}")
+    for mode, current in results["results"].items():
+        previous = baseline.get("results", {}).get(mode)
+        if not previous: continue
+        for metric, direction in COMPARED_METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None: continue
+            change = (new - old) / old
+            worse = change > tolerance if direction == "lower" else change < -tolerance
+            if worse: regressions.append(f"{mode}.{metric}")
+            print(f"{mode:>10} {metric:>14} {old:>12} {new:>12} {change * 100:>+8.1f}%{'  <- REGRESSÃO' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do flow engine")
+    parser.add_argument("--mode", choices=("testclient", "gunicorn", "both"), default="testclient")
+    parser.add_argument("--senders", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=10, help="mensagens por sender")
+    parser.add_argument("--concurrency", type=int, default=32, help="senders simultâneos")
+    parser.add_argument("--nodes", type=int, default=60)
+    parser.add_argument("--extra-edges", type=int, default=0)
+    parser.add_argument("--mix", default=None, help='JSON, ex.: {"waitInput": 0.3, "condition": 0.3, "setVariable": 0.3, "gptQuery": 0.1}')
+    parser.add_argument("--ai-latency-ms", type=float, default=50.0)
+    parser.add_argument("--ai-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--ai-error-rate", type=float, default=0.0)
+    parser.add_argument("--memory-sessions", type=int, default=2000, help="sessões criadas para medir memória por sessão")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default=None, help="arquivo JSON de resultados")
+    parser.add_argument("--baseline", default=None, help="JSON de uma execução anterior para comparar")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="piora relativa aceita antes de acusar regressão")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    spec = {"node_count": args.nodes, "mix": json.loads(args.mix) if args.mix else DEFAULT_NODE_MIX, "extra_edges": args.extra_edges, "seed": args.seed}
+    flow = generate_flow(**spec)
+    ai = FakeAIServer(args.ai_latency_ms, args.ai_jitter_ms, args.ai_error_rate); ai_url = ai.start()
+    configure_environment(args, ai_url, spec)
+    if args.mode in ("gunicorn", "both") and args.workers > 1 and os.environ["SESSION_STORE_BACKEND"].lower() == "memory":
+        ai.stop(); parser.error(f"--workers {args.workers} com SESSION_STORE_BACKEND=memory: cada worker teria suas próprias sessões e as conversas quebram. "
+                                "Use --workers 1 ou um backend compartilhado (SESSION_STORE_BACKEND=redis|mysql).")
+
+    results = {"meta": {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"), "git": git_revision(), "python": platform.python_version(),
+                        "flow": {**spec, "nodes": len(flow["nodes"]), "edges": len(flow["edges"])},
+                        "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "verbose")}},
+               "results": {}}
+    if args.mode in ("gunicorn", "both"): results["results"]["gunicorn"] = run_gunicorn(args)
+    if args.mode in ("testclient", "both"): results["results"]["testclient"] = run_testclient(args)
+    results["meta"]["ai_calls"] = ai.calls; ai.stop()
+
+    print(f"Fluxo sintético: {results['meta']['flow']['nodes']} nós, {results['meta']['flow']['edges']} edges; IA falsa {args.ai_latency_ms}ms ± {args.ai_jitter_ms}ms")
+    print(f"{'modo':>10} {'msgs':>7} {'erros':>6} {'msg/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'bytes/sessão':>13}")
+    for mode, result in results["results"].items():
+        print(f"{mode:>10} {result['messages']:>7} {result['errors']:>6} {result['msgs_per_sec']:>9} {result['p50_ms']:>9} {result['p90_ms']:>9} "
+              f"{result['p99_ms']:>9} {result['max_ms']:>9} {str(result.get('session_bytes')):>13}")
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f: json.dump(results, f, indent=2, default=str)
+        print(f"Resultados salvos em {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions: print(f"Regressões acima de {args.tolerance:.0%}: {', '.join(regressions)}"); sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
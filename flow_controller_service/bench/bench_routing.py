@@ -0,0 +1,62 @@
+# flow_controller_service/bench/bench_routing.py
+# Benchmark do roteamento por hop: scan linear de edges (implementação antiga) vs grafo compilado.
+# Uso: python bench/bench_routing.py [--edges 100,1000,10000,50000] [--hops 15] [--repeat 2000]
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flow_graph import compile_flow  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+
+def build_elements(total_edges: int, path_length: int) -> dict:
+    # Caminho de 'path_length' nós setVariable + nós "ruído" para inflar a lista de edges
+    nodes = [{"id": f"p{i}", "type": "setVariable", "data": {"variableName": f"v{i}", "value": "x"}} for i in range(path_length + 1)]
+    edges = [{"id": f"pe{i}", "source": f"p{i}", "target": f"p{i + 1}"} for i in range(path_length)]
+    filler = max(total_edges - len(edges), 0)
+    for i in range(filler):
+        nodes.append({"id": f"n{i}", "type": "textMessage", "data": {"text": "ruído"}})
+        edges.append({"id": f"ne{i}", "source": f"n{i}", "target": f"n{(i + 1) % filler}", "sourceHandle": "source-bottom"})
+    # O scan antigo percorre a lista inteira; colocar o caminho no fim é o pior caso realista (fluxos editados ao longo do tempo)
+    return {"nodes": nodes, "edges": edges[path_length:] + edges[:path_length]}
+
+
+def legacy_next_node(edges: list, current_node_id: str) -> str | None:
+    # Cópia do caminho padrão de determine_next_node_id_from_edges antes da compilação do grafo
+    outgoing_edges = [edge for edge in edges if isinstance(edge, dict) and edge.get('source') == current_node_id]
+    default_edges = [edge for edge in outgoing_edges if not edge.get('sourceHandle') or edge.get('sourceHandle') in ['source', 'source-bottom', 'source-default', 'source-success']]
+    return default_edges[0].get('target') if default_edges else None
+
+
+def time_path(step, start: str, hops: int, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        node_id = start
+        for _ in range(hops): node_id = step(node_id)
+    return (time.perf_counter() - started) / (repeat * hops)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de roteamento por hop")
+    parser.add_argument("--edges", default="100,1000,10000,50000")
+    parser.add_argument("--hops", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'edges':>8} {'legado (us/hop)':>16} {'compilado (us/hop)':>19} {'compilação (ms)':>16}")
+    for total in (int(x) for x in args.edges.split(",")):
+        elements = build_elements(total, args.hops)
+        t0 = time.perf_counter(); flow = compile_flow(1, "bench", elements); compile_ms = (time.perf_counter() - t0) * 1000
+        edges = elements["edges"]
+        legacy_repeat = max(1, min(args.repeat, 2_000_000 // max(total, 1)))
+        legacy = time_path(lambda nid: legacy_next_node(edges, nid), "p0", args.hops, legacy_repeat)
+        compiled = time_path(lambda nid: flow.next_node_id(nid, "_internal_transition_", "setVariable"), "p0", args.hops, args.repeat)
+        print(f"{total:>8} {legacy * 1e6:>16.2f} {compiled * 1e6:>19.3f} {compile_ms:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# flow_controller_service/bench/load_harness.py
+# Peças do teste de carga sem MySQL nem API de IA de verdade: gerador de fluxos sintéticos
+# (quantidade de nós/edges e mistura de tipos configuráveis), tabela `flows` em memória atrás de
+# um mysql.connector.connect falso e um endpoint de IA local com latência configurável.
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_NODE_MIX = {"waitInput": 0.2, "condition": 0.2, "setVariable": 0.25, "gptQuery": 0.1, "textMessage": 0.25}
+USER_MESSAGES = ("sim", "não", "42", "7", "quero comprar", "falar com atendente", "meu pedido atrasou", "ok obrigado", "PROMO10", "")
+MAX_NODES_BETWEEN_INPUTS = 6  # Mantém cada mensagem bem abaixo do limite de 15 hops do engine
+
+
+def generate_flow(node_count: int = 50, mix: dict | None = None, extra_edges: int = 0, seed: int = 0) -> dict:
+    # Fluxo em cadeia no formato do editor (nodes/edges do React Flow), terminando em endFlow.
+    # condition/gptQuery ramificam (true/false, success/error) e voltam para a cadeia; extra_edges adiciona
+    # edges de botões que nunca casam com as mensagens simuladas, só para variar o tamanho do grafo.
+    rng = random.Random(seed); mix = mix or DEFAULT_NODE_MIX
+    types, weights = zip(*mix.items())
+    nodes = [{"id": "start", "type": "startNode", "data": {}},
+             {"id": "setup", "type": "setVariable", "data": {"variableName": "openai_key", "value": "sk-bench-0000000000000000"}},
+             {"id": "name", "type": "setVariable", "data": {"variableName": "nome", "value": "Cliente {{lastInput}}"}}]
+    body_types = []; since_input = 0
+    for _ in range(max(1, node_count - len(nodes) - 1)):
+        node_type = "waitInput" if since_input >= MAX_NODES_BETWEEN_INPUTS else rng.choices(types, weights)[0]
+        since_input = 0 if node_type == "waitInput" else since_input + 1
+        body_types.append(node_type)
+    last_input = "lastInput"
+    for index, node_type in enumerate(body_types):
+        node_id = f"n{index}"
+        if node_type == "waitInput":
+            last_input = f"resp_{index}"; data = {"variableName": last_input, "message": f"Pergunta {index}, {{{{nome}}}}?"}
+        elif node_type == "condition":
+            comparison = rng.choice(["contains", "equals", "greaterThan", "regex", "isSet", "startsWith"])
+            value = {"contains": "pedido", "equals": "sim", "greaterThan": "10", "regex": "^[0-9]+$", "isSet": None, "startsWith": "quero"}[comparison]
+            data = {"variableName": last_input, "comparison": comparison, "value": value}
+        elif node_type == "setVariable":
+            data = {"variableName": f"v{index}", "value": f"{{{{{last_input}}}}}-{index} / {{{{nome}}}}"}
+        elif node_type == "gptQuery":
+            data = {"prompt": f"Classifique a mensagem de {{{{nome}}}}: {{{{{last_input}}}}}", "systemMessage": "Você é um classificador.",
+                    "saveResponseTo": f"ia_{index}", "apiKeyVariable": "openai_key", "model": "bench-model", "temperature": 0.2}
+        else:
+            node_type = "textMessage"; data = {"text": f"Mensagem {index} para {{{{nome}}}}: {{{{{last_input}}}}}"}
+        nodes.append({"id": node_id, "type": node_type, "data": data, "position": {"x": 0, "y": 120 * index}})
+    nodes.append({"id": "end", "type": "endFlow", "data": {"text": "Fim, {{nome}}."}})
+
+    edges = []
+    def connect(source, target, handle=None):
+        edge = {"id": f"e{len(edges)}", "source": source, "target": target}
+        if handle: edge["sourceHandle"] = handle
+        edges.append(edge)
+    connect("start", "setup"); connect("setup", "name"); connect("name", nodes[3]["id"])
+    chain = nodes[3:]
+    for position, node in enumerate(chain[:-1]):
+        next_id = chain[position + 1]["id"]
+        if node["type"] == "waitInput": connect(node["id"], next_id, "source-received")
+        elif node["type"] == "condition":
+            # Ramo falso pula um nó só se ele não for waitInput (não deixa a mensagem atravessar duas entradas)
+            skip = chain[position + 2] if position + 2 < len(chain) and chain[position + 1]["type"] != "waitInput" else chain[position + 1]
+            connect(node["id"], next_id, "source-true"); connect(node["id"], skip["id"], "source-false")
+        elif node["type"] == "gptQuery": connect(node["id"], next_id, "source-success"); connect(node["id"], next_id, "source-error")
+        else: connect(node["id"], next_id)
+    for index in range(extra_edges):
+        source, target = rng.choice(nodes[:-1]), rng.choice(nodes[1:])
+        connect(source["id"], target["id"], f"opcao-{index}")
+    return {"nodes": nodes, "edges": edges}
+
+
+def simulated_message(rng: random.Random) -> str:
+    return rng.choice(USER_MESSAGES)
+
+
+class FlowsTable:
+    # Linhas da tabela flows do frontend (id, name, user_id, campaign_id, elements, status, updated_at)
+    def __init__(self):
+        self.rows = {}; self._lock = threading.Lock()
+
+    def add(self, flow_id: int, elements: dict, name: str | None = None, status: str = "inactive", campaign_id=None, user_id: int = 1):
+        with self._lock:
+            if status == "active":
+                for row in self.rows.values(): row["status"] = "inactive"
+            self.rows[flow_id] = {"id": flow_id, "name": name or f"Fluxo sintético {flow_id}", "user_id": user_id, "campaign_id": campaign_id,
+                                  "elements": json.dumps(elements), "status": status, "updated_at": datetime.datetime.now().replace(microsecond=0)}
+
+    def select(self, query: str, params: tuple) -> list:
+        match = re.match(r"\s*SELECT\s+(?P<cols>.+?)\s+FROM\s+flows(?:\s+WHERE\s+(?P<where>.+?))?(?:\s+ORDER BY\s+(?P<order>.+?))?(?:\s+LIMIT\s+(?P<limit>\d+))?\s*$",
+                         query, re.IGNORECASE | re.DOTALL)
+        if not match: raise NotImplementedError(f"Query não suportada pela tabela flows em memória: {query}")
+        params = list(params or ())
+        with self._lock: rows = [dict(row) for row in self.rows.values()]
+        for condition in re.split(r"\s+AND\s+", match["where"] or "", flags=re.IGNORECASE):
+            condition = condition.strip()
+            if not condition: continue
+            in_match = re.match(r"(\w+)\s+IN\s*\((.+)\)", condition, re.IGNORECASE)
+            if in_match:
+                column = in_match[1]; wanted = {str(params.pop(0)) for _ in in_match[2].split(",")}
+                rows = [row for row in rows if str(row[column]) in wanted]; continue
+            column, value = [part.strip() for part in condition.split("=", 1)]
+            value = str(params.pop(0)) if value == "%s" else value.strip("'")
+            rows = [row for row in rows if str(row[column]) == value]
+        if match["order"]: rows.sort(key=lambda row: (row["status"] == "active", row["updated_at"]), reverse=True)
+        if match["limit"]: rows = rows[:int(match["limit"])]
+        columns = [column.strip() for column in match["cols"].split(",")]
+        return [{column: row[column] for column in columns} for row in rows]
+
+
+class _FakeCursor:
+    def __init__(self, table: FlowsTable, dictionary: bool):
+        self._table = table; self._dictionary = dictionary; self._rows = []; self.rowcount = 0
+
+    def execute(self, query, params=()):
+        self._rows = self._table.select(query, params); self.rowcount = len(self._rows)
+
+    def _shape(self, row):
+        return row if self._dictionary else tuple(row.values())
+
+    def fetchone(self):
+        return self._shape(self._rows[0]) if self._rows else None
+
+    def fetchall(self):
+        return [self._shape(row) for row in self._rows]
+
+    def close(self):
+        pass
+
+
+class FakeMySQLConnection:
+    in_transaction = False
+
+    def __init__(self, table: FlowsTable):
+        self._table = table
+
+    def cursor(self, dictionary: bool = False):
+        return _FakeCursor(self._table, dictionary)
+
+    def commit(self): pass
+    def rollback(self): pass
+    def ping(self, reconnect=False): pass
+    def is_connected(self): return True
+    def close(self): pass
+
+
+def install_fake_mysql(table: FlowsTable):
+    # Precisa rodar antes de importar flow_controller (ele lê as variáveis DB_* e carrega o fluxo no import)
+    import mysql.connector
+    mysql.connector.connect = lambda **kwargs: FakeMySQLConnection(table)
+    for name, value in (("DB_HOST_PYTHON", "bench"), ("DB_USER_PYTHON", "bench"), ("DB_PASSWORD_PYTHON", "bench"),
+                        ("DB_NAME_PYTHON", "bench"), ("DB_PORT_PYTHON", "3306")):
+        os.environ.setdefault(name, value)
+
+
+class _BenchHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024; daemon_threads = True
+
+
+class FakeAIServer:
+    # Imita a API de IA (V50MCP_AI_QUERY_API_URL): responde {"success": true, "response": ...} após latency_ms ± jitter_ms
+    def __init__(self, latency_ms: float = 50.0, jitter_ms: float = 10.0, error_rate: float = 0.0, port: int = 0):
+        self.latency_ms = latency_ms; self.jitter_ms = jitter_ms; self.error_rate = error_rate; self.calls = 0
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, como o upstream real
+            def log_message(self, *args): pass
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}"); server.calls += 1
+                time.sleep(max(0.0, random.gauss(server.latency_ms, server.jitter_ms)) / 1000)
+                if random.random() < server.error_rate: status, out = 500, b'{"success": false}'
+                else: status, out = 200, json.dumps({"success": True, "response": f"categoria:{len(body.get('prompt', '')) % 4}"}).encode()
+                self.send_response(status); self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(out)))
+                self.end_headers(); self.wfile.write(out)
+        self._server = _BenchHTTPServer(("127.0.0.1", port), Handler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/api/ai/query"
+
+    def start(self) -> str:
+        threading.Thread(target=self._server.serve_forever, name="fake-ai", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown(); self._server.server_close()
@@ -0,0 +1,103 @@
+# flow_controller_service/conditions.py
+# Nós condition compilados no load em predicados (variables -> bool). Tudo o que é constante
+# na configuração é resolvido uma vez: nome da variável, operando em minúsculas, número já
+# convertido e regex compilado com suas flags. Configuração inválida vira erro de load em vez
+# de um log a cada mensagem. A semântica é a mesma da antiga evaluate_condition.
+import functools
+import logging
+import re
+
+from text_templates import CompiledTemplate, render_template
+
+logger = logging.getLogger("flow_controller.conditions")
+
+NUMERIC_COMPARISONS = {
+    "greaterThan": lambda a, b: a > b, "lessThan": lambda a, b: a < b,
+    "greaterOrEquals": lambda a, b: a >= b, "lessOrEquals": lambda a, b: a <= b,
+}
+STRING_COMPARISONS = {
+    "equals": lambda a, b: a == b, "notEquals": lambda a, b: a != b,
+    "contains": lambda a, b: b is not None and b in a,
+    "startsWith": lambda a, b: b is not None and a.startswith(b),
+    "endsWith": lambda a, b: b is not None and a.endswith(b),
+}
+
+
+def _always_false(variables: dict) -> bool:
+    return False
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_regex(pattern: str) -> re.Pattern:
+    # Sufixo/marcador "[i]" no padrão = case-insensitive (convenção do editor)
+    flags = 0
+    if "[i]" in pattern: pattern = pattern.replace("[i]", ""); flags = re.IGNORECASE
+    return re.compile(pattern, flags)
+
+
+def compile_condition(data: dict):
+    # Retorna (predicado, erro). Com erro, o predicado é sempre False (mesmo resultado de antes, sem log por mensagem).
+    var_name_template = data.get("variableName"); comparison = data.get("comparison"); value_template = data.get("value")
+    if not var_name_template or not comparison: return _always_false, "condição sem variableName/comparison"
+    if comparison not in ("isSet", "isNotSet", "regex") and comparison not in STRING_COMPARISONS and comparison not in NUMERIC_COMPARISONS:
+        return _always_false, f"tipo de comparação desconhecido: '{comparison}'"
+
+    name_template = CompiledTemplate(str(var_name_template))
+    static_name = name_template.source if name_template.is_static else None
+
+    def read_variable(variables):
+        name = static_name if static_name is not None else name_template.render(variables)
+        raw = variables.get(name)
+        return raw, (render_template(str(raw), variables) if raw is not None else None)
+
+    if comparison == "isSet":
+        def predicate(variables):
+            actual = read_variable(variables)[1]
+            return actual is not None and actual != "" and actual.lower() != "none"
+        return predicate, None
+    if comparison == "isNotSet":
+        def predicate(variables):
+            actual = read_variable(variables)[1]
+            return actual is None or actual == "" or actual.lower() == "none"
+        return predicate, None
+
+    if value_template is None and comparison in NUMERIC_COMPARISONS: return _always_false, f"comparação '{comparison}' sem valor"
+    compare_template = CompiledTemplate(str(value_template)) if value_template is not None else None
+    static_compare = compare_template.source if compare_template is not None and compare_template.is_static else None
+
+    if comparison == "regex":
+        if value_template is None: return _always_false, "comparação 'regex' sem padrão"
+        try: regex = compile_regex(str(value_template))
+        except re.error as e: return _always_false, f"regex inválido '{value_template}': {e}"
+        def predicate(variables):
+            raw, actual = read_variable(variables)
+            if actual is None: return False
+            return regex.search(str(raw)) is not None
+        return predicate, None
+
+    if comparison in STRING_COMPARISONS:
+        compare = STRING_COMPARISONS[comparison]
+        static_lower = static_compare.lower() if static_compare is not None else None
+        def predicate(variables):
+            actual = read_variable(variables)[1]
+            if actual is None: return False
+            if compare_template is None: expected = None
+            elif static_lower is not None: expected = static_lower
+            else: expected = compare_template.render(variables).lower()
+            return compare(actual.lower(), expected)
+        return predicate, None
+
+    compare = NUMERIC_COMPARISONS[comparison]
+    static_number = None
+    if static_compare is not None:
+        try: static_number = float(static_compare)
+        except ValueError: return _always_false, f"valor '{static_compare}' não numérico para '{comparison}'"
+    def predicate(variables):
+        actual = read_variable(variables)[1]
+        if actual is None: return False
+        try:
+            number = static_number if static_number is not None else float(compare_template.render(variables))
+            return compare(float(actual), number)
+        except (ValueError, TypeError):
+            logger.debug(f"Condição numérica: conversão para float falhou para '{actual}'."); return False
+    return predicate, None
@@ -0,0 +1,123 @@
+# flow_controller_service/db_pool.py
+# Pool de conexões MySQL por processo: reaproveita conexões (sem novo TCP+TLS+auth por chamada),
+# valida na retirada as que ficaram ociosas, recicla por idade e limita a espera na aquisição.
+import collections
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("flow_controller.db_pool")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class MySQLConnectionPool:
+    def __init__(self, connect, size: int = 5, acquire_timeout: float = 5.0, validate_after: float = 30.0, max_lifetime: float = 1800.0):
+        # connect: função que abre uma conexão nova (get_mysql_connection)
+        self._connect = connect; self.size = size; self.acquire_timeout = acquire_timeout
+        self.validate_after = validate_after; self.max_lifetime = max_lifetime
+        self._lock = threading.Lock()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle = collections.deque()  # (conexão, criada_em, devolvida_em); LIFO para manter as quentes em uso
+        self._in_use = 0; self._created = 0; self._discarded = 0; self._checkouts = 0; self._timeouts = 0
+        self._wait_total = 0.0; self._wait_max = 0.0
+
+    def _check_fork(self):
+        # Após fork (gunicorn --preload) os sockets herdados pertencem ao pai: descarta sem fechar
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid: logger.info("Pool MySQL: fork detectado, reiniciando pool no novo processo."); self._reset_state()
+
+    def _is_usable(self, conn, created_at: float, returned_at: float) -> bool:
+        now = time.monotonic()
+        if self.max_lifetime and now - created_at > self.max_lifetime: return False
+        if now - returned_at < self.validate_after: return True
+        try: conn.ping(reconnect=False); return True
+        except Exception as e: logger.warning(f"Pool MySQL: conexão ociosa inválida descartada: {e}"); return False
+
+    def _close_quietly(self, conn):
+        self._discarded += 1
+        try: conn.close()
+        except Exception: pass
+
+    def acquire(self, timeout: float | None = None):
+        self._check_fork()
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock: self._timeouts += 1
+            raise PoolTimeout(f"Nenhuma conexão MySQL livre em {timeout}s (pool de {self.size}).")
+        waited = time.monotonic() - started
+        try:
+            conn = None; created_at = None
+            while True:
+                with self._lock: entry = self._idle.pop() if self._idle else None
+                if entry is None: break
+                if self._is_usable(*entry): conn, created_at = entry[0], entry[1]; break
+                self._close_quietly(entry[0])
+            if conn is None:
+                conn = self._connect(); created_at = time.monotonic()
+                with self._lock: self._created += 1
+        except BaseException:
+            self._slots.release(); raise
+        with self._lock:
+            self._in_use += 1; self._checkouts += 1
+            self._wait_total += waited; self._wait_max = max(self._wait_max, waited)
+        return conn, created_at
+
+    def release(self, conn, created_at: float, broken: bool = False):
+        if os.getpid() != self._pid: return  # Conexão de outro processo (pré-fork): nunca devolve ao pool novo
+        try:
+            if not broken:
+                try:
+                    if conn.in_transaction: conn.rollback()  # Não deixa transação/snapshot pendurado para o próximo uso
+                except Exception: broken = True
+            if broken: self._close_quietly(conn)
+            else:
+                with self._lock: self._idle.append((conn, created_at, time.monotonic()))
+        finally:
+            with self._lock: self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: float | None = None):
+        conn, created_at = self.acquire(timeout)
+        broken = False
+        try: yield conn
+        except Exception:
+            broken = not _is_connected(conn); raise
+        finally: self.release(conn, created_at, broken)
+
+    def close_all(self):
+        with self._lock: idle = list(self._idle); self._idle.clear()
+        for conn, _, _ in idle: self._close_quietly(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "in_use": self._in_use, "idle": len(self._idle), "created": self._created,
+                    "discarded": self._discarded, "checkouts": self._checkouts, "acquire_timeouts": self._timeouts,
+                    "wait_avg_ms": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                    "wait_max_ms": round(self._wait_max * 1000, 3)}
+
+
+def _is_connected(conn) -> bool:
+    try: return conn.is_connected()
+    except Exception: return False
+
+
+def create_pool_from_env(connect) -> MySQLConnectionPool:
+    return MySQLConnectionPool(
+        connect,
+        size=int(os.environ.get("DB_POOL_SIZE", "5")),
+        acquire_timeout=float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", "5")),
+        validate_after=float(os.environ.get("DB_POOL_VALIDATE_AFTER", "30")),
+        max_lifetime=float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800")),
+    )
@@ -5,48 +5,83 @@ import logging
 import os
 import mysql.connector
 import json
-import re
+import threading
+import time
 import requests 
 import socket
+import uuid
+from concurrent.futures import Future, wait as wait_futures
+from contextlib import contextmanager
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from ai_client import AIUpstreamUnavailable, ai_cache_key, create_ai_client_from_env, create_ai_response_cache_from_env
+from async_jobs import QueueFull, callback_url_allowed, create_callback_sender_from_env, create_executor_from_env, create_job_store_from_env
+from db_pool import create_pool_from_env
+from flow_graph import INTERNAL_TRIGGERS, TIMER_TRIGGER, CompiledFlow, compile_flow, elements_version, in_time_window
+from flow_registry import create_registry_from_env, flow_key
+from flow_snapshot import create_snapshot_store_from_env
+from log_config import REDACTED, SECRET_KEY_PATTERN, add_request_fields, configure_logging, mark_secret, request_log_context
+from metrics import create_profiler_from_env, create_registry_from_env as create_metrics_registry_from_env
+from process_local import ProcessOnce
+from session_store import SessionLocks, create_session_store, start_session_sweeper
+from timer_scheduler import create_scheduler_from_env, create_timer_store, new_timer
 
 app = Flask(__name__)
 
 # --- Configuração de Logging ---
-log_formatter = logging.Formatter('%(asctime)s - [%(levelname)s] - (%(module)s:%(funcName)s:%(lineno)d) - %(message)s')
-logger = logging.getLogger(__name__)
-logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-
-if not logger.hasHandlers():
-    logger.addHandler(console_handler)
+# LOG_FORMAT=text|json, LOG_ASYNC (handler em fila), LOG_SAMPLE_RATE (fração das mensagens com log detalhado)
+logger = logging.getLogger("flow_controller")
+configure_logging(logger, '%(asctime)s - [%(levelname)s] - (%(module)s:%(funcName)s:%(lineno)d) - %(message)s')
 logger.info("Logging configurado para Flow Controller (MySQL).")
 
+# --- Métricas (/metrics) ---
+# Com vários workers, METRICS_DIR (definido no gunicorn.conf.py) recebe um snapshot por processo e o scrape soma todos
+metrics = create_metrics_registry_from_env()
+REQUEST_SECONDS = metrics.histogram("flow_http_request_duration_seconds", "Duração das requisições HTTP.", ("endpoint", "status"))
+MESSAGE_SECONDS = metrics.histogram("flow_message_duration_seconds", "Processamento completo de uma mensagem (síncrona ou job assíncrono).")
+HOP_SECONDS = metrics.histogram("flow_hop_duration_seconds", "Duração de cada hop do engine, por tipo de nó.", ("node_type",))
+ROUTING_SECONDS = metrics.histogram("flow_routing_duration_seconds", "Escolha da próxima edge (determine_next_node_id_from_edges).",
+                                    buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.0001, 0.001))
+TEMPLATE_SECONDS = metrics.histogram("flow_template_render_seconds", "Renderização de {{variáveis}} por tipo de nó.", ("node_type",),
+                                     buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.0001, 0.001, 0.01))
+AI_SECONDS = metrics.histogram("flow_ai_request_duration_seconds", "Latência das chamadas à API de IA (nós gptQuery), incluindo retries.")
+AI_CACHE_LOOKUPS = metrics.counter("flow_ai_cache_lookups_total", "Consultas ao cache de respostas de IA (nós gptQuery com cacheResponse).", ("outcome",))
+DB_SECONDS = metrics.histogram("flow_db_duration_seconds", "Uso de uma conexão MySQL do pool (aquisição + queries).")
+SESSION_STORE_SECONDS = metrics.histogram("flow_session_store_duration_seconds", "Operações no session store.", ("operation",))
+BATCH_ITEMS = metrics.histogram("flow_batch_items", "Mensagens por requisição em /process_messages.", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+MAX_HOPS_ABORTS = metrics.counter("flow_max_hops_aborts_total", "Mensagens abortadas por atingir o limite de hops.")
+SESSION_RESETS = metrics.counter("flow_session_resets_total", "Sessões reiniciadas/descartadas por erro ou mudança de fluxo.", ("reason",))
+ERROR_EDGE_ROUTES = metrics.counter("flow_error_edge_routes_total", "Saídas pela edge de erro, por tipo de nó.", ("node_type",))
+LIVE_SESSIONS = metrics.gauge("flow_live_sessions", "Sessões residentes em memória (backend memory).")
+SESSIONS_EXPIRED = metrics.counter("flow_sessions_expired_total", "Sessões descartadas por inatividade (SESSION_IDLE_TTL) por este processo.")
+SESSIONS_EVICTED = metrics.counter("flow_sessions_evicted_total", "Sessões removidas pelo teto SESSION_MAX_ENTRIES (LRU, backend memory).")
+FLOW_NODES = metrics.gauge("flow_loaded_flow_nodes", "Nós do fluxo ativo carregado.", multiprocess_mode="max")
+FLOW_EDGES = metrics.gauge("flow_loaded_flow_edges", "Edges do fluxo ativo carregado.", multiprocess_mode="max")
+PENDING_TIMERS = metrics.gauge("flow_pending_timers", "Timers agendados (delay / timeout de waitInput).", multiprocess_mode="max")
+TIMER_FIRES = metrics.counter("flow_timer_fires_total", "Timers disparados, por tipo e resultado.", ("kind", "outcome"))
+CACHED_FLOWS = metrics.gauge("flow_registry_cached_flows", "Fluxos compilados em cache no registro.", multiprocess_mode="max")
+request_profiler = create_profiler_from_env()  # PROFILE_SAMPLE_RATE: fração das mensagens perfiladas com cProfile (PROFILE_DIR)
+
 # --- DEBUG DE DNS ---
-V50MCP_AI_QUERY_API_URL_ENV = os.environ.get("V50MCP_AI_QUERY_API_URL", "")
-V50MCP_DOMAIN_TO_CHECK = ""
-if V50MCP_AI_QUERY_API_URL_ENV.startswith("https://"):
-    V50MCP_DOMAIN_TO_CHECK = V50MCP_AI_QUERY_API_URL_ENV.replace("https://", "").split("/")[0]
-elif V50MCP_AI_QUERY_API_URL_ENV.startswith("http://"):
-    V50MCP_DOMAIN_TO_CHECK = V50MCP_AI_QUERY_API_URL_ENV.replace("http://", "").split("/")[0]
-
-if V50MCP_DOMAIN_TO_CHECK:
+# Fora do import: roda em background em cada processo (start_background_work), sem atrasar a subida
+def check_ai_dns():
+    ai_url = os.environ.get("V50MCP_AI_QUERY_API_URL", "")
+    domain_to_check = ""
+    if ai_url.startswith("https://"): domain_to_check = ai_url.replace("https://", "").split("/")[0]
+    elif ai_url.startswith("http://"): domain_to_check = ai_url.replace("http://", "").split("/")[0]
+    if not domain_to_check:
+        logger.warning("DEBUG DNS: V50MCP_AI_QUERY_API_URL não definida ou formato inválido, não é possível checar DNS do host da API de IA."); return
     try:
-        logger.info(f"DEBUG DNS: Tentando resolver o IP para '{V50MCP_DOMAIN_TO_CHECK}'...")
-        ip_address = socket.gethostbyname(V50MCP_DOMAIN_TO_CHECK)
-        logger.info(f"DEBUG DNS: '{V50MCP_DOMAIN_TO_CHECK}' resolvido para IP: {ip_address}")
+        logger.info(f"DEBUG DNS: Tentando resolver o IP para '{domain_to_check}'...")
+        ip_address = socket.gethostbyname(domain_to_check)
+        logger.info(f"DEBUG DNS: '{domain_to_check}' resolvido para IP: {ip_address}")
     except socket.gaierror as e:
-        logger.error(f"DEBUG DNS: FALHA ao resolver '{V50MCP_DOMAIN_TO_CHECK}'. Erro: {e}")
+        logger.error(f"DEBUG DNS: FALHA ao resolver '{domain_to_check}'. Erro: {e}")
     except Exception as e_gen:
-        logger.error(f"DEBUG DNS: Erro inesperado durante a tentativa de resolução de DNS para '{V50MCP_DOMAIN_TO_CHECK}': {e_gen}")
-else:
-    logger.warning("DEBUG DNS: V50MCP_AI_QUERY_API_URL não definida ou formato inválido, não é possível checar DNS do host da API de IA.")
+        logger.error(f"DEBUG DNS: Erro inesperado durante a tentativa de resolução de DNS para '{domain_to_check}': {e_gen}")
 # --- FIM DO DEBUG DE DNS ---
 
-user_states = {}
-current_flow_definition = {
-    "id": None, "name": None, "nodes": {}, "edges": [], "start_node_id": None
-}
+current_flow = CompiledFlow.empty()  # Grafo compilado e imutável; trocado por inteiro a cada (re)carga
 
 def get_mysql_connection():
     try:
@@ -72,290 +107,420 @@ def get_mysql_connection():
         logger.error(f"Erro ao obter conexão MySQL: {e}", exc_info=True)
         raise
 
+# Todo acesso ao MySQL passa pelo pool do processo (DB_POOL_SIZE, DB_POOL_ACQUIRE_TIMEOUT, DB_POOL_VALIDATE_AFTER, DB_POOL_MAX_LIFETIME)
+db_pool = create_pool_from_env(get_mysql_connection)
+
+@contextmanager
+def db_connection():
+    with DB_SECONDS.time(), db_pool.connection() as conn: yield conn
+
+# Sessões: memória local (padrão) ou backend compartilhado entre workers/réplicas (SESSION_STORE_BACKEND=redis|mysql)
+session_store = create_session_store(mysql_connection_factory=db_connection)
+SESSION_CAS_MAX_ATTEMPTS = int(os.environ.get('SESSION_CAS_MAX_ATTEMPTS', '3'))
+session_locks = SessionLocks()  # Um lock por sender, criado e descartado sob demanda
+logger.info(f"Session store: backend '{session_store.backend_name}'.")
+
+# Chamadas dos nós gptQuery: sessão keep-alive, timeouts conexão/leitura, limite de concorrência, retry e circuit breaker (AI_*)
+ai_client = create_ai_client_from_env()
+# Nós gptQuery com cacheResponse=true (e cacheTtlSeconds opcional): AI_CACHE_MAX_ENTRIES, AI_CACHE_DEFAULT_TTL
+ai_response_cache = create_ai_response_cache_from_env()
+
+# Modo assíncrono: /process_message responde 202 com job_id e o resultado sai via callback ou /result/<job_id>
+PROCESS_MESSAGE_MODE = os.environ.get('PROCESS_MESSAGE_MODE', 'sync').lower()
+ASYNC_CALLBACK_URL = os.environ.get('ASYNC_CALLBACK_URL')
+# callback_url vindo no corpo só é aceito se estiver sob ASYNC_CALLBACK_URL ou ASYNC_CALLBACK_ALLOWED_URLS (lista separada por vírgula)
+ASYNC_CALLBACK_ALLOWED_URLS = [url.strip() for url in os.environ.get('ASYNC_CALLBACK_ALLOWED_URLS', '').split(',') if url.strip()] + ([ASYNC_CALLBACK_URL] if ASYNC_CALLBACK_URL else [])
+message_executor = create_executor_from_env()
+async_job_store = create_job_store_from_env(mysql_connection_factory=db_connection)
+callback_sender = create_callback_sender_from_env()
+# Lote (/process_messages): itens agrupados por sender rodam no mesmo executor, um job por sender com os itens em ordem
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', '30'))
+
+# Timers de delay / timeout de waitInput: mesmo backend do session store (TIMER_STORE_BACKEND, TIMER_POLL_INTERVAL, TIMER_BATCH_SIZE).
+# O payload gerado quando um timer dispara sai por callback (TIMER_CALLBACK_URL, ou ASYNC_CALLBACK_URL).
+TIMER_CALLBACK_URL = os.environ.get('TIMER_CALLBACK_URL') or ASYNC_CALLBACK_URL
+timer_scheduler = create_scheduler_from_env(create_timer_store(mysql_connection_factory=db_connection),
+                                            lambda session_key, timer_id: fire_session_timer(session_key, timer_id), message_executor)
+FLOW_TIMEZONE = os.environ.get('FLOW_TIMEZONE')  # Fuso dos nós timeCondition (ex.: America/Sao_Paulo); vazio = fuso do servidor
+flow_timezone = ZoneInfo(FLOW_TIMEZONE) if FLOW_TIMEZONE else None
+
+LIVE_SESSIONS.set_function(lambda: session_store.stats().get("live"))
+SESSIONS_EXPIRED.set_function(lambda: session_store.expired); SESSIONS_EVICTED.set_function(lambda: session_store.evicted)
+PENDING_TIMERS.set_function(lambda: timer_scheduler.stats()["pending"])
+
+def _fetch_flow_row(query: str, params: tuple = ()) -> dict | None:
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        try: cursor.execute(query, params); return cursor.fetchone()
+        finally: cursor.close()
+
+def _fetch_flow_rows(query: str, params: tuple = ()) -> list:
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=True)
+        try: cursor.execute(query, params); return cursor.fetchall()
+        finally: cursor.close()
+
+def _compile_flow_row(row: dict) -> CompiledFlow:
+    flow_id = row['id']; flow_name = row['name']; elements_data = row['elements']
+    if isinstance(elements_data, (bytes, bytearray)): elements_data = elements_data.decode('utf-8')
+    version = elements_version(elements_data)
+    if isinstance(elements_data, str): elements = json.loads(elements_data)
+    elif isinstance(elements_data, dict): elements = elements_data
+    else: logger.error(f"Formato de 'elements' inesperado para o fluxo ID {flow_id}."); elements = {"nodes": [], "edges": []}
+    return compile_flow(flow_id, flow_name, elements, version=version, source_updated_at=row.get('updated_at'))
+
+def load_flow_by_id(flow_id) -> CompiledFlow | None:
+    # Loader do registro de fluxos: qualquer fluxo por id (goToFlow, sessões já fixadas em fluxos que deixaram de ser ativos)
+    logger.info(f"Carregando fluxo ID={flow_id} do MySQL.")
+    try:
+        row = _fetch_flow_row("SELECT id, name, elements, updated_at FROM flows WHERE id = %s", (flow_id,))
+        if not row: logger.warning(f"Fluxo ID={flow_id} não existe no DB."); return None
+        compiled = _compile_flow_row(row)
+    except json.JSONDecodeError as je: logger.error(f"Erro JSON 'elements' do fluxo {flow_id}: {je}"); return None
+    except Exception as e: logger.error(f"Erro ao carregar fluxo {flow_id}: {e}", exc_info=True); return None
+    if not compiled.is_ready: logger.error(f"Fluxo ID={flow_id} sem nó inicial válido."); return None
+    logger.info(f"Fluxo '{compiled.name}' (ID: {compiled.id}, versão {compiled.version}) compilado: {compiled.node_count} nós, {compiled.edge_count} edges.")
+    return compiled
+
+def resolve_campaign_flow_id(campaign_id):
+    # Canal/tenant -> fluxo ativo da campanha (o mais recente, se houver mais de um); rascunhos/inativos nunca são servidos
+    row = _fetch_flow_row("SELECT id FROM flows WHERE campaign_id = %s AND status = 'active' ORDER BY updated_at DESC LIMIT 1", (campaign_id,))
+    return row['id'] if row else None
+
+def resolve_active_flow_id(flow_id):
+    # flow_id vindo no body da requisição: só fluxos ativos, como nas campanhas
+    row = _fetch_flow_row("SELECT id FROM flows WHERE id = %s AND status = 'active'", (flow_id,))
+    return row['id'] if row else None
+
+# Fluxos compilados em memória por id, com carga preguiçosa e LRU (FLOW_CACHE_SIZE)
+flow_registry = create_registry_from_env(load_flow_by_id, resolve_campaign_flow_id, resolve_active_flow_id)
+# Último fluxo ativo válido em disco (FLOW_SNAPSHOT_DIR): a subida serve dele e revalida no MySQL em background
+flow_snapshots = create_snapshot_store_from_env()
+flow_loaded_from_snapshot = False
+
 def load_flow_from_db():
-    global current_flow_definition
+    # Compila a versão nova fora de qualquer lock e só então troca a referência global: requisições em andamento
+    # continuam na versão que já pegaram. Uma versão nova inválida nunca substitui uma versão válida em serviço.
+    global current_flow
     logger.info("Tentando carregar fluxo ativo do banco de dados MySQL.")
-    conn = None; cursor = None; success_flag = False
+    success_flag = False
     try:
-        conn = get_mysql_connection(); cursor = conn.cursor(dictionary=True)
-        query = "SELECT id, name, elements FROM flows WHERE status = 'active' LIMIT 1"; cursor.execute(query); row = cursor.fetchone()
+        row = _fetch_flow_row("SELECT id, name, elements, updated_at FROM flows WHERE status = 'active' LIMIT 1")
         if row:
-            flow_id = row['id']; flow_name = row['name']; elements_data = row['elements']
+            flow_id = row['id']; flow_name = row['name']
             logger.info(f"Fluxo ativo encontrado no MySQL: ID={flow_id}, Nome='{flow_name}'")
-            if isinstance(elements_data, (bytes, bytearray)): elements_data = elements_data.decode('utf-8')
-            if isinstance(elements_data, str): elements = json.loads(elements_data)
-            elif isinstance(elements_data, dict): elements = elements_data
-            else: logger.error(f"Formato de 'elements' inesperado para o fluxo ID {flow_id}."); elements = {"nodes": [], "edges": []}
-            nodes_list = elements.get('nodes', []); edges_list = elements.get('edges', [])
-            if not isinstance(nodes_list, list) or not isinstance(edges_list, list): logger.warning(f"Formato de 'nodes' ou 'edges' inválido no fluxo {flow_id}."); nodes_list, edges_list = [], []
-            nodes_dict = {node['id']: node for node in nodes_list if isinstance(node, dict) and 'id' in node}
-            start_node = None
-            if nodes_list:
-                explicit_start_node = next((n for n in nodes_list if isinstance(n,dict) and n.get("type")=="startNode"),None)
-                if explicit_start_node: start_node = explicit_start_node; logger.info(f"Nó inicial explícito (startNode): ID={start_node.get('id')}")
-                else:
-                    all_target_ids = {e.get('target') for e in edges_list if isinstance(e,dict) and e.get('target')}
-                    possible_starts = [n for nid,n in nodes_dict.items() if nid not in all_target_ids]
-                    if possible_starts: start_node = possible_starts[0]; logger.info(f"Nó inicial inferido (sem incoming edges): ID={start_node.get('id')}")
-                    elif nodes_list and isinstance(nodes_list[0],dict): start_node = nodes_list[0]; logger.warning(f"Nenhum nó inicial claro. Usando primeiro nó da lista: ID={start_node.get('id') if start_node else 'N/A'}")
-                    else: logger.error("Lista de nós vazia ou mal formatada. Não foi possível determinar o nó inicial.")
-            else: logger.error("A lista de 'nodes' está vazia no fluxo.")
-            current_flow_definition = {"id": flow_id, "name": flow_name, "nodes": nodes_dict, "edges": edges_list, "start_node_id": start_node['id'] if start_node and 'id' in start_node else None}
-            if current_flow_definition['start_node_id']:
-                success_flag = True; logger.info(f"Fluxo MySQL '{flow_name}' (ID: {flow_id}) carregado. Nó inicial: {current_flow_definition['start_node_id']}")
-                initial_node_details = get_node_by_id(current_flow_definition['start_node_id'])
-                if initial_node_details: logger.info(f"Detalhes Nó Inicial ({current_flow_definition['start_node_id']}): Tipo='{initial_node_details.get('type')}', Data='{json.dumps(initial_node_details.get('data', {}))[:100]}...'")
-                else: logger.warning(f"Nó inicial ID '{current_flow_definition['start_node_id']}' não encontrado nos nós."); success_flag = False
+            compiled = _compile_flow_row(row)
+            if compiled.start_node_id:
+                initial_node_details = compiled.get_node(compiled.start_node_id)
+                if initial_node_details:
+                    success_flag = True; logger.info(f"Fluxo MySQL '{flow_name}' (ID: {flow_id}, versão {compiled.version}) carregado e compilado: {compiled.node_count} nós, {compiled.edge_count} edges. Nó inicial: {compiled.start_node_id}")
+                    logger.info(f"Detalhes Nó Inicial ({compiled.start_node_id}): Tipo='{initial_node_details.type}', Data='{json.dumps(initial_node_details.data)[:100]}...'")
+                else: logger.warning(f"Nó inicial ID '{compiled.start_node_id}' não encontrado nos nós.")
             else: logger.error(f"NÓ INICIAL NÃO DETERMINADO para fluxo '{flow_name}'.")
-        else: logger.warning("Nenhum fluxo 'active' no DB."); current_flow_definition = {"id": None, "name": None, "nodes": {}, "edges": [], "start_node_id": None}
+            if success_flag:
+                diff = flow_registry.put(compiled)
+                if diff: logger.info(f"Fluxo {flow_id}: versão {current_flow.version} -> {compiled.version}. Nós adicionados={len(diff['added'])}, removidos={len(diff['removed'])}, alterados={len(diff['changed'])}.")
+                current_flow = compiled; flow_snapshots.save(compiled)
+            elif current_flow.is_ready: logger.error(f"Versão nova do fluxo {flow_id} inválida. Mantendo em serviço o fluxo {current_flow.id} (versão {current_flow.version}).")
+            else: current_flow = compiled
+        else: logger.warning("Nenhum fluxo 'active' no DB."); current_flow = CompiledFlow.empty()
     except json.JSONDecodeError as je: logger.error(f"Erro JSON 'elements': {je}", exc_info=True)
     except Exception as e: logger.error(f"Erro ao carregar fluxo: {e}", exc_info=True)
-    finally:
-        if cursor: cursor.close();
-        if conn and conn.is_connected(): conn.close(); logger.debug("Conexão MySQL fechada (load_flow).")
-    if not success_flag and not current_flow_definition.get("id"): current_flow_definition = {"id": None, "name": None, "nodes": {}, "edges": [], "start_node_id": None}
+    if not success_flag and current_flow.id is None: current_flow = CompiledFlow.empty()
     return success_flag
 
-def get_node_by_id(node_id: str | None):
-    if not node_id: return None
-    return current_flow_definition["nodes"].get(node_id)
-
-def process_text_variables(text: str | None, user_vars: dict) -> str | None:
-    if text is None: return None
-    processed_text = str(text)
-    for _ in range(5): 
-        new_text = re.sub(r"\{\{(.+?)\}\}", lambda m: str(user_vars.get(m.group(1).strip(),f"{{{{{m.group(1).strip()}}}}}")) ,processed_text)
-        if new_text == processed_text: break
-        processed_text = new_text
-    return processed_text
-
-def get_response_payload_for_node(node_id: str, user_vars: dict) -> dict | None:
-    node = get_node_by_id(node_id)
+def refresh_flows_if_changed():
+    # Checagem barata de versão (id, updated_at) na tabela flows; só recompila o que mudou
+    active_row = _fetch_flow_row("SELECT id, updated_at FROM flows WHERE status = 'active' LIMIT 1")
+    if active_row is None:
+        if current_flow.id is not None: logger.info("Poller de fluxos: nenhum fluxo ativo no DB."); load_flow_from_db()
+    elif flow_key(active_row['id']) != flow_key(current_flow.id) or active_row['updated_at'] != current_flow.source_updated_at:
+        logger.info(f"Poller de fluxos: fluxo ativo {active_row['id']} mudou no DB. Recarregando."); load_flow_from_db()
+    others = {flow_key(f.id): f for f in flow_registry.cached_flows() if flow_key(f.id) != flow_key(current_flow.id)}
+    if not others: return
+    placeholders = ", ".join(["%s"] * len(others))
+    for row in _fetch_flow_rows(f"SELECT id, updated_at FROM flows WHERE id IN ({placeholders})", tuple(others)):
+        cached = others.get(flow_key(row['id']))
+        if cached is not None and row['updated_at'] != cached.source_updated_at:
+            refreshed, diff = flow_registry.refresh(row['id'])
+            if refreshed: logger.info(f"Poller de fluxos: fluxo {row['id']} atualizado para versão {refreshed.version}. Diff: {diff}")
+
+def warm_start_from_snapshot() -> bool:
+    # Sem MySQL e sem parse de JSON: instala o último fluxo ativo gravado em disco
+    global current_flow, flow_loaded_from_snapshot
+    started = time.perf_counter(); snapshot = flow_snapshots.load_active()
+    if snapshot is None: return False
+    flow_registry.put(snapshot); current_flow = snapshot; flow_loaded_from_snapshot = True
+    logger.info(f"Fluxo '{snapshot.name}' (ID: {snapshot.id}, versão {snapshot.version}) carregado do snapshot em {(time.perf_counter() - started) * 1000:.1f}ms. Revalidação no MySQL em background.")
+    return True
+
+def init_flow(load_from_db: bool = True) -> bool:
+    # Com gunicorn (preload_app) roda no import do master: o snapshot é instalado ali e os workers herdam o fluxo por copy-on-write.
+    # load_from_db=False (master do gunicorn): sem snapshot o master não espera o MySQL; cada worker carrega em ensure_flow_loaded.
+    if warm_start_from_snapshot(): return True
+    if not load_from_db: logger.info("Nenhum snapshot utilizável. Carga do fluxo inicial do MySQL adiada para os workers."); return False
+    logger.info("Nenhum snapshot utilizável. Carregando fluxo inicial do MySQL...")
+    if not load_flow_from_db(): logger.critical("FALHA CRÍTICA AO CARREGAR FLUXO INICIAL NA INICIALIZAÇÃO."); return False
+    logger.info("Fluxo inicial carregado com sucesso."); return True
+
+def revalidate_flow():
+    try: refresh_flows_if_changed(); logger.info(f"Fluxo do snapshot revalidado no MySQL (ID: {current_flow.id}, versão {current_flow.version}).")
+    except Exception as e: logger.warning(f"Revalidação do fluxo no MySQL falhou ({e}). Servindo o snapshot até a próxima checagem do poller.")
+
+FLOW_POLL_INTERVAL = float(os.environ.get('FLOW_POLL_INTERVAL', '30'))
+_flow_poller = ProcessOnce()
+
+def _flow_poller_loop():
+    while True:
+        time.sleep(FLOW_POLL_INTERVAL)
+        try: refresh_flows_if_changed()
+        except Exception as e: logger.warning(f"Poller de fluxos: falha ao checar versões no DB: {e}")
+
+def start_flow_poller():
+    # Substitui as chamadas manuais a /reload_flow; FLOW_POLL_INTERVAL=0 desliga. Uma thread por processo.
+    if FLOW_POLL_INTERVAL <= 0: return
+    if _flow_poller.run(lambda: threading.Thread(target=_flow_poller_loop, name="flow-poller", daemon=True).start()):
+        logger.info(f"Poller de fluxos iniciado (intervalo {FLOW_POLL_INTERVAL}s).")
+
+def get_response_payload_for_node(flow: CompiledFlow, node_id: str, user_vars: dict) -> dict | None:
+    node = flow.get_node(node_id)
     if not node: logger.warning(f"Nó ID '{node_id}' não encontrado em get_response_payload_for_node."); return None
-    node_type = node.get("type"); node_data = node.get("data", {})
-    logger.debug(f"Gerando payload para nó ID '{node_id}', tipo '{node_type}'.")
+    node_type = node.type
+    logger.debug("Gerando payload para nó ID '%s', tipo '%s'.", node_id, node_type)
     payload = None
     try:
-        if node_type == "textMessage":
-            text = process_text_variables(node_data.get("text"), user_vars)
-            if text is not None: payload = {"type": "text", "text": text} # Envia mesmo se for string vazia, se processado
-            else: logger.warning(f"Nó textMessage '{node_id}' sem texto ou resultou em None.")
-        elif node_type == "waitInput": # Este nó envia um prompt
-            message_prompt = process_text_variables(node_data.get("message"), user_vars)
-            if message_prompt is not None: payload = {"type": "text", "text": message_prompt}
-            else: logger.warning(f"Nó waitInput '{node_id}' sem prompt ('data.message') ou resultou em None.")
-        # Adicione aqui a lógica para gerar payloads para SEUS outros tipos de nós que enviam mensagens
-        # (imageMessage, buttonMessage, listMessage, endFlow com texto, etc.)
-        # Exemplo para endFlow com texto:
-        elif node_type == "endFlow":
-            text = process_text_variables(node_data.get("text"), user_vars) # Assumindo que 'text' é o campo para a mensagem final
-            if text is not None: payload = {"type": "text", "text": text}
-            # Se endFlow não tiver texto, não gera payload, o que é ok.
+        with TEMPLATE_SECONDS.time(node_type=node_type):
+            if node_type == "textMessage":
+                text = node.render("text", user_vars)
+                if text is not None: payload = {"type": "text", "text": text} # Envia mesmo se for string vazia, se processado
+                else: logger.warning(f"Nó textMessage '{node_id}' sem texto ou resultou em None.")
+            elif node_type == "waitInput": # Este nó envia um prompt
+                message_prompt = node.render("message", user_vars)
+                if message_prompt is not None: payload = {"type": "text", "text": message_prompt}
+                else: logger.warning(f"Nó waitInput '{node_id}' sem prompt ('data.message') ou resultou em None.")
+            # Adicione aqui a lógica para gerar payloads para SEUS outros tipos de nós que enviam mensagens
+            # (imageMessage, buttonMessage, listMessage, endFlow com texto, etc.)
+            # Exemplo para endFlow com texto:
+            elif node_type == "endFlow":
+                text = node.render("text", user_vars) # Assumindo que 'text' é o campo para a mensagem final
+                if text is not None: payload = {"type": "text", "text": text}
+                # Se endFlow não tiver texto, não gera payload, o que é ok.
     except Exception as e:
         logger.error(f"Erro em get_response_payload_for_node para nó {node_id} (tipo: {node_type}): {e}", exc_info=True)
         return None
-    if payload: logger.info(f"Payload gerado para '{node_id}': {str(payload)[:100]}...")
-    else: logger.debug(f"Nenhum payload de resposta gerado para nó '{node_id}' (tipo: {node_type}).")
+    if payload: logger.debug("Payload gerado para '%s': %.100s...", node_id, payload)
+    else: logger.debug("Nenhum payload de resposta gerado para nó '%s' (tipo: %s).", node_id, node_type)
     return payload
 
-def evaluate_condition(condition_node_data: dict, user_message_trigger: str | None, variables: dict) -> bool:
-    var_name_template = condition_node_data.get('variableName'); comparison_type = condition_node_data.get('comparison'); value_to_compare_template = condition_node_data.get('value')
-    if not var_name_template or not comparison_type: logger.warning(f"Condição malformada: {condition_node_data}"); return False
-    processed_var_name = process_text_variables(var_name_template, variables); value_from_user_vars = variables.get(processed_var_name)
-    actual_value = process_text_variables(str(value_from_user_vars) if value_from_user_vars is not None else None, variables)
-    value_to_compare = process_text_variables(str(value_to_compare_template) if value_to_compare_template is not None else None, variables)
-    logger.debug(f"Avaliando Condição: Var='{processed_var_name}' (Efetivo='{actual_value}'), Comp='{comparison_type}', ValParaComparar='{value_to_compare}'")
-    if comparison_type == 'isSet': return actual_value is not None and actual_value != "" and actual_value.lower() != 'none'
-    if comparison_type == 'isNotSet': return actual_value is None or actual_value == "" or actual_value.lower() == 'none'
-    if actual_value is None: return False # Outras comparações geralmente falham se a variável não estiver setada
-    actual_value_str = str(actual_value).lower(); value_to_compare_str = str(value_to_compare).lower() if value_to_compare is not None else None
-    if comparison_type == 'equals': return actual_value_str == value_to_compare_str
-    if comparison_type == 'notEquals': return actual_value_str != value_to_compare_str
-    if comparison_type == 'contains': return value_to_compare_str is not None and value_to_compare_str in actual_value_str
-    if comparison_type == 'startsWith': return value_to_compare_str is not None and actual_value_str.startswith(value_to_compare_str)
-    if comparison_type == 'endsWith': return value_to_compare_str is not None and actual_value_str.endswith(value_to_compare_str)
-    if comparison_type == 'regex':
-        if value_to_compare is None: return False
-        try:
-            pattern = str(value_to_compare_template); flags = 0
-            if '[i]' in pattern: pattern = pattern.replace('[i]', ''); flags = re.IGNORECASE
-            return bool(re.search(pattern, str(value_from_user_vars if value_from_user_vars is not None else ""), flags))
-        except re.error as e: logger.error(f"Regex inválido: '{value_to_compare_template}', erro: {e}"); return False
-    numeric_comparisons = ['greaterThan', 'lessThan', 'greaterOrEquals', 'lessOrEquals']
-    if comparison_type in numeric_comparisons:
-        if value_to_compare is None: return False
-        try:
-            num_actual = float(actual_value); num_compare = float(value_to_compare)
-            if comparison_type == 'greaterThan': return num_actual > num_compare
-            if comparison_type == 'lessThan': return num_actual < num_compare
-            if comparison_type == 'greaterOrEquals': return num_actual >= num_compare
-            if comparison_type == 'lessOrEquals': return num_actual <= num_compare
-        except (ValueError, TypeError): logger.warning(f"Conversão para float falhou para '{actual_value}' ou '{value_to_compare}'"); return False
-    logger.warning(f"Tipo de comparação desconhecido: {comparison_type}"); return False
-
-def determine_next_node_id_from_edges(current_node_id: str, trigger_value: str | None, user_vars: dict, node_type_of_source: str | None) -> str | None:
-    outgoing_edges = [edge for edge in current_flow_definition.get("edges", []) if isinstance(edge, dict) and edge.get('source') == current_node_id]
-    logger.debug(f"Determinando próximo nó de {current_node_id} (Tipo:{node_type_of_source}). Edges:{len(outgoing_edges)}. Trigger:'{trigger_value}'")
-    if trigger_value and trigger_value not in ["_internal_start_flow_", "_internal_transition_", "_internal_error_"]:
-        for edge in outgoing_edges:
-            if edge.get('sourceHandle') == trigger_value: logger.info(f"Edge por sourceHandle '{trigger_value}'. Próximo nó: {edge.get('target')}"); return edge.get('target')
-    if node_type_of_source == "waitInput" and trigger_value not in [None, "_internal_start_flow_", "_internal_transition_"]:
-        edge = next((e for e in outgoing_edges if e.get('sourceHandle') == 'source-received'), None)
-        if edge: logger.info(f"WaitInput: Input '{trigger_value}'. Edge 'source-received'. Próximo nó: {edge.get('target')}"); return edge.get('target')
-    if trigger_value == "_internal_error_": # Para nós que podem ter uma saída de erro específica
-        error_edge = next((edge for edge in outgoing_edges if edge.get('sourceHandle') == 'source-error'), None)
-        if error_edge: logger.info(f"Nó {current_node_id} em erro. Usando edge 'source-error'. Próximo nó: {error_edge.get('target')}"); return error_edge.get('target')
-    # Fallback para edge padrão (sem sourceHandle ou com handles genéricos)
-    default_edges = [edge for edge in outgoing_edges if not edge.get('sourceHandle') or edge.get('sourceHandle') in ['source', 'source-bottom', 'source-default', 'source-success']]
-    if default_edges:
-        if len(default_edges) > 1: logger.warning(f"Múltiplas edges padrão para {current_node_id} (handles: {[e.get('sourceHandle') for e in default_edges]}). Usando a primeira.")
-        logger.info(f"Usando edge padrão de {current_node_id} (handle: {default_edges[0].get('sourceHandle')}). Próximo nó: {default_edges[0].get('target')}"); return default_edges[0].get('target')
-    logger.warning(f"Nenhuma edge aplicável de {current_node_id} (Tipo:{node_type_of_source}) com trigger '{trigger_value}'.")
-    return None
+def determine_next_node_id_from_edges(flow: CompiledFlow, current_node_id: str, trigger_value: str | None, node_type_of_source: str | None) -> str | None:
+    with ROUTING_SECONDS.time(): next_node_id = flow.next_node_id(current_node_id, trigger_value, node_type_of_source)
+    # Só conta quando a saída foi de fato a edge source-error (sem ela o roteamento cai na edge padrão)
+    if next_node_id and trigger_value == "_internal_error_" and getattr(flow.get_node(current_node_id), "error_target", None) == next_node_id:
+        ERROR_EDGE_ROUTES.inc(node_type=node_type_of_source)
+    return next_node_id
 
-@app.route('/process_message', methods=['POST'])
-def process_message_route():
-    data = request.json
-    if not data: logger.warning("API /process_message: Request body vazio."); return jsonify({"error": "Request body is missing"}), 400
-    sender_id = data.get('sender_id'); message_content_or_interaction_id = data.get('message', '') 
-    logger.info(f"API /process_message: Recebido de sender_id='{sender_id}', message/interaction='{str(message_content_or_interaction_id)[:100]}'")
-    if not sender_id: return jsonify({"error": "sender_id é obrigatório"}), 400
-    if not current_flow_definition.get("id") or not current_flow_definition.get("start_node_id"):
-         if not load_flow_from_db() or not current_flow_definition.get("start_node_id"):
-            logger.error("API /process_message: Falha crítica ao recarregar fluxo ou fluxo inválido.")
-            return jsonify({"response_payload": {"type":"text", "text": "Desculpe, o sistema está temporariamente indisponível."}}), 200
-         logger.info("Fluxo recarregado com sucesso durante o processamento da mensagem.")
-    user_session = user_states.get(sender_id)
+def query_ai(url: str, api_payload: dict, cache_ttl: float | None) -> dict:
+    if cache_ttl is None:
+        with AI_SECONDS.time(): return ai_client.query(url, api_payload)
+    api_response_data, cache_outcome = ai_response_cache.get_or_query(ai_cache_key(api_payload), cache_ttl, AI_SECONDS.time()(lambda: ai_client.query(url, api_payload)))
+    AI_CACHE_LOOKUPS.inc(outcome=cache_outcome); add_request_fields(ai_cache=cache_outcome)
+    return api_response_data
+
+def run_flow_engine(flow: CompiledFlow, sender_id: str, user_session: dict | None, message_content_or_interaction_id, side_effects: dict | None = None,
+                    timer_fired: bool = False) -> tuple[dict | None, dict | None]:
+    # Executa os hops de uma mensagem sobre a sessão (cópia local). Retorna (payload de resposta, sessão atualizada ou None se ela deve ser removida).
+    # side_effects: memória entre tentativas do CAS da mesma mensagem (respostas de IA já pagas não são pedidas de novo)
+    # timer_fired: disparo do timer pendente pelo scheduler (decidido pelo timer_id, nunca pelo texto da mensagem)
     is_new_session = False
     if not user_session:
-        is_new_session = True; user_session = {"current_node_id": current_flow_definition["start_node_id"], "variables": {}, "history": []}
-        user_states[sender_id] = user_session; current_message_trigger = "_internal_start_flow_"
-        logger.info(f"Nova sessão para {sender_id}. Nó inicial: {user_session['current_node_id']}.")
-    else: current_message_trigger = message_content_or_interaction_id; logger.info(f"Sessão existente para {sender_id}. Nó atual: {user_session['current_node_id']}. Trigger: '{current_message_trigger}'")
+        is_new_session = True; user_session = {"flow_id": flow.id, "flow_version": flow.version, "current_node_id": flow.start_node_id, "variables": {}, "history": []}
+        current_message_trigger = "_internal_start_flow_"
+        logger.debug("Nova sessão para %s. Nó inicial: %s.", sender_id, user_session['current_node_id'])
+    else: current_message_trigger = TIMER_TRIGGER if timer_fired else message_content_or_interaction_id; logger.debug("Sessão existente para %s. Nó atual: %s. Trigger: '%s'", sender_id, user_session['current_node_id'], current_message_trigger)
+    add_request_fields(flow_id=flow.id, flow_version=flow.version, new_session=is_new_session, start_node=user_session["current_node_id"])
+    pending_timer = user_session.pop("timer", None)  # Qualquer mensagem consome o timer pendente (timeout de waitInput respondido)...
+    if pending_timer and pending_timer.get("kind") == "delay" and current_message_trigger != TIMER_TRIGGER:
+        if (pending_timer.get("due") or 0) <= time.time():
+            # Delay já vencido e não disparado (disparo falhou ou foi abandonado): a mensagem retoma o fluxo no lugar do timer
+            logger.info(f"Sessão {sender_id}: delay do nó {pending_timer.get('node_id')} vencido sem disparo. Retomando com a mensagem recebida.")
+            current_message_trigger = TIMER_TRIGGER; add_request_fields(timer="delay_overdue")
+        else:
+            # ...exceto durante um delay: a mensagem é ignorada e o fluxo só segue quando o timer disparar
+            logger.debug("Sessão %s em delay no nó %s até %s. Mensagem ignorada.", sender_id, pending_timer.get("node_id"), pending_timer.get("due"))
+            user_session["timer"] = pending_timer; add_request_fields(timer="delay_pending"); return None, user_session
     
     active_node_id = user_session["current_node_id"]; user_vars = user_session["variables"]
     if not is_new_session: user_session["history"].append({"node_before_input": active_node_id, "trigger_received": current_message_trigger})
     
     response_payload_to_send = None; next_node_id_for_session_update = active_node_id 
     hop_count = 0; max_hops = 15
+    hop_started = None; hop_node_type = None
 
     while hop_count < max_hops:
-        hop_count += 1; current_node_object = get_node_by_id(active_node_id)
+        if hop_started is not None: HOP_SECONDS.observe(time.perf_counter() - hop_started, node_type=hop_node_type)
+        hop_count += 1; current_node_object = flow.get_node(active_node_id)
+        hop_started = time.perf_counter(); hop_node_type = current_node_object.type if current_node_object else "missing"
         if not current_node_object:
-            logger.error(f"Loop {hop_count}: Nó ID '{active_node_id}' não encontrado! Resetando sessão.");
-            if sender_id in user_states: del user_states[sender_id];
+            logger.error(f"Loop {hop_count}: Nó ID '{active_node_id}' não encontrado! Resetando sessão."); SESSION_RESETS.inc(reason="node_missing")
             response_payload_to_send = {"type":"text", "text":"Erro interno no fluxo."}; next_node_id_for_session_update=None; break
             
-        node_type = current_node_object.get("type"); node_data = current_node_object.get("data", {})
-        logger.info(f"Loop {hop_count}/{max_hops}: Processando nó ID='{active_node_id}' (Tipo='{node_type}') Trigger='{current_message_trigger}'")
+        node_type = current_node_object.type; node_data = current_node_object.data
+        logger.debug("Loop %s/%s: Processando nó ID='%s' (Tipo='%s') Trigger='%s'", hop_count, max_hops, active_node_id, node_type, current_message_trigger)
 
         if response_payload_to_send is None and \
            (current_message_trigger == "_internal_start_flow_" or \
-            (node_type in ["waitInput", "buttonMessage", "listMessage", "textMessage", "imageMessage", "audioMessage", "videoMessage", "fileMessage", "locationMessage", "endFlow"] and hop_count == 1) or \
+            (node_type in ["waitInput", "buttonMessage", "listMessage", "textMessage", "imageMessage", "audioMessage", "videoMessage", "fileMessage", "locationMessage", "endFlow"] and hop_count == 1 and current_message_trigger != TIMER_TRIGGER) or \
             (node_type in ["waitInput", "buttonMessage", "listMessage"] and current_message_trigger == "_internal_transition_")):
-            response_payload_to_send = get_response_payload_for_node(active_node_id, user_vars)
+            response_payload_to_send = get_response_payload_for_node(flow, active_node_id, user_vars)
         
         potential_next_node_id_after_processing = None
         
         if node_type == "waitInput":
-            if current_message_trigger not in ["_internal_start_flow_", "_internal_transition_"]:
+            if current_message_trigger == TIMER_TRIGGER:
+                potential_next_node_id_after_processing = current_node_object.handles.get("source-timeout")
+                if not potential_next_node_id_after_processing: logger.debug("WaitInput: timeout no nó %s sem edge 'source-timeout'. Continua aguardando.", active_node_id); next_node_id_for_session_update = active_node_id; break
+                logger.debug("WaitInput: timeout no nó %s. Edge 'source-timeout'. Próximo nó: %s", active_node_id, potential_next_node_id_after_processing)
+                current_message_trigger = "_internal_transition_"
+            elif current_message_trigger not in ["_internal_start_flow_", "_internal_transition_"]:
                 variable_to_save = node_data.get("variableName", "lastInput"); user_vars[variable_to_save] = current_message_trigger
-                logger.info(f"WaitInput: Input '{str(current_message_trigger)[:50]}' salvo em '{variable_to_save}'.")
-                potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, current_message_trigger, user_vars, node_type)
+                logger.debug("WaitInput: Input '%.50s' salvo em '%s'.", current_message_trigger, variable_to_save)
+                potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, current_message_trigger, node_type)
                 current_message_trigger = "_internal_transition_"
-            else: next_node_id_for_session_update = active_node_id; break
+            else:
+                if current_node_object.timer_seconds: user_session["timer"] = new_timer("timeout", active_node_id, current_node_object.timer_seconds)
+                next_node_id_for_session_update = active_node_id; break
         
+        elif node_type == "delay":
+            if current_message_trigger == TIMER_TRIGGER or current_node_object.config_error:
+                if current_node_object.config_error: logger.error(f"Nó delay {active_node_id} mal configurado ({current_node_object.config_error}). Seguindo sem esperar.")
+                potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
+                current_message_trigger = "_internal_transition_"
+                if not potential_next_node_id_after_processing: next_node_id_for_session_update = None; break
+            else:
+                user_session["timer"] = new_timer("delay", active_node_id, current_node_object.timer_seconds)
+                logger.debug("Delay: nó %s aguardando %ss.", active_node_id, current_node_object.timer_seconds)
+                next_node_id_for_session_update = active_node_id; break
+
+        elif node_type == "timeCondition":
+            if current_node_object.config_error: logger.error(f"Nó timeCondition {active_node_id} mal configurado ({current_node_object.config_error}). Seguindo 'source-outside'."); is_inside = False
+            else: now = datetime.now(flow_timezone); is_inside = in_time_window(current_node_object.time_window, now.hour * 60 + now.minute)
+            handle_to_follow = 'source-inside' if is_inside else 'source-outside'
+            potential_next_node_id_after_processing = current_node_object.handles.get(handle_to_follow)
+            if not potential_next_node_id_after_processing: logger.warning(f"TimeCondition: Nó {active_node_id}, não encontrada edge para handle '{handle_to_follow}'.")
+            current_message_trigger = "_internal_transition_"
+
         elif node_type == "setVariable":
-            var_name_template = node_data.get("variableName"); value_template = node_data.get("value")
+            var_name_template = node_data.get("variableName")
             if var_name_template:
-                var_name = process_text_variables(var_name_template, user_vars).strip()
-                processed_value = process_text_variables(str(value_template if value_template is not None else ''), user_vars)
-                user_vars[var_name] = processed_value; logger.info(f"SetVariable: '{var_name}' = '{str(processed_value)[:50]}'.")
-            potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type)
+                with TEMPLATE_SECONDS.time(node_type=node_type):
+                    var_name = current_node_object.render("variableName", user_vars).strip()
+                    processed_value = current_node_object.render("value", user_vars)
+                is_secret = var_name in flow.secret_variables or SECRET_KEY_PATTERN.search(var_name) is not None
+                if is_secret: mark_secret(processed_value)  # Antes de qualquer log: o valor truncado abaixo não seria reconhecido depois
+                user_vars[var_name] = processed_value; logger.debug("SetVariable: '%s' = '%.50s'.", var_name, REDACTED if is_secret else processed_value)
+            potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
             current_message_trigger = "_internal_transition_"
 
         elif node_type == "gptQuery":
-            logger.debug(f"[GPTQuery Node Debug] Raw node_data: {json.dumps(node_data)}")
+            if logger.isEnabledFor(logging.DEBUG): logger.debug("[GPTQuery Node Debug] Raw node_data: %s", json.dumps(node_data))
             prompt_template = node_data.get("prompt")
             system_message_template = node_data.get("systemMessage")
             api_key_variable_name_from_node = node_data.get("apiKeyVariable")
             variable_to_save_response = node_data.get("saveResponseTo")
             
-            logger.debug(f"[GPTQuery Node Debug] prompt_template: '{prompt_template}'")
-            logger.debug(f"[GPTQuery Node Debug] apiKeyVariableName (lido do nó): '{api_key_variable_name_from_node}'")
-            logger.debug(f"[GPTQuery Node Debug] variable_to_save_response: '{variable_to_save_response}'")
+            logger.debug("[GPTQuery Node Debug] prompt_template: '%s'", prompt_template)
+            logger.debug("[GPTQuery Node Debug] apiKeyVariableName (lido do nó): '%s'", api_key_variable_name_from_node)
+            logger.debug("[GPTQuery Node Debug] variable_to_save_response: '%s'", variable_to_save_response)
 
+            ai_upstream_unavailable = False
             ai_model = node_data.get("model"); ai_temp = node_data.get("temperature"); ai_max_tokens = node_data.get("maxTokens")
 
-            if not prompt_template or not variable_to_save_response or not api_key_variable_name_from_node:
+            if current_node_object.config_error:
                 logger.error(f"Nó gptQuery {active_node_id} mal configurado: falta prompt ('{prompt_template}'), saveResponseTo ('{variable_to_save_response}') ou apiKeyVariable ('{api_key_variable_name_from_node}').")
                 user_vars[variable_to_save_response if variable_to_save_response else "gpt_error"] = "ERRO_CONFIG_IA: Nó de IA mal configurado."
-                potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_error_", user_vars, node_type)
-                if not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type)
+                potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_error_", node_type)
+                if not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
             else:
-                processed_prompt = process_text_variables(prompt_template, user_vars)
-                processed_system_message = process_text_variables(system_message_template, user_vars) if system_message_template else None
-                api_key = user_vars.get(api_key_variable_name_from_node)
+                with TEMPLATE_SECONDS.time(node_type=node_type):
+                    processed_prompt = current_node_object.render("prompt", user_vars)
+                    processed_system_message = current_node_object.render("systemMessage", user_vars) if system_message_template else None
+                api_key = user_vars.get(api_key_variable_name_from_node); mark_secret(api_key)
                 
                 if not api_key:
                     logger.error(f"Nó gptQuery {active_node_id}: API Key não encontrada na variável de fluxo '{api_key_variable_name_from_node}'.")
                     user_vars[variable_to_save_response] = f"ERRO_IA: API Key '{api_key_variable_name_from_node}' não definida."
-                    potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_error_", user_vars, node_type)
-                    if not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type)
+                    potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_error_", node_type)
+                    if not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
                 else:
-                    logger.info(f"Nó gptQuery {active_node_id}: API Key recuperada de '{api_key_variable_name_from_node}'. Enviando prompt: '{processed_prompt[:70]}...'")
+                    logger.debug("Nó gptQuery %s: API Key recuperada de '%s'. Enviando prompt: '%.70s...'", active_node_id, api_key_variable_name_from_node, processed_prompt)
                     V50MCP_AI_QUERY_API_URL = os.environ.get("V50MCP_AI_QUERY_API_URL")
                     if not V50MCP_AI_QUERY_API_URL:
                         logger.error(f"Nó gptQuery {active_node_id}: V50MCP_AI_QUERY_API_URL não configurada."); user_vars[variable_to_save_response] = "ERRO_CONFIG_CTRL: URL da API de IA não configurada."
-                        potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_error_", user_vars, node_type) # Tenta sair por erro
-                        if not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type) # Ou saida normal
+                        potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_error_", node_type) # Tenta sair por erro
+                        if not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type) # Ou saida normal
                     else:
                         try:
                             api_payload = {"prompt": processed_prompt, "apiKey": api_key, "systemMessage": processed_system_message, "model": ai_model, "temperature": ai_temp, "maxTokens": ai_max_tokens }
                             api_payload = {k: v for k, v in api_payload.items() if v is not None}
-                            logger.debug(f"Payload para {V50MCP_AI_QUERY_API_URL}: {json.dumps(api_payload)}")
-                            response = requests.post(V50MCP_AI_QUERY_API_URL, json=api_payload, timeout=60)
-                            response.raise_for_status()
-                            api_response_data = response.json()
+                            if logger.isEnabledFor(logging.DEBUG): logger.debug("Payload para %s: %s", V50MCP_AI_QUERY_API_URL, json.dumps(api_payload))
+                            side_effect_key = ("ai", active_node_id, ai_cache_key(api_payload))
+                            api_response_data = side_effects.get(side_effect_key) if side_effects is not None else None
+                            if api_response_data is not None: add_request_fields(ai_reused=True)
+                            else:
+                                api_response_data = query_ai(V50MCP_AI_QUERY_API_URL, api_payload, current_node_object.cache_ttl)
+                                if side_effects is not None: side_effects[side_effect_key] = api_response_data
                             if api_response_data.get("success") and "response" in api_response_data:
                                 user_vars[variable_to_save_response] = api_response_data["response"]
-                                logger.info(f"Nó gptQuery {active_node_id}: Resposta da IA salva em '{variable_to_save_response}'.")
+                                logger.debug("Nó gptQuery %s: Resposta da IA salva em '%s'.", active_node_id, variable_to_save_response)
                             else:
                                 error_detail = api_response_data.get("details") or api_response_data.get("message", "Erro da API de IA.")
                                 logger.error(f"Nó gptQuery {active_node_id}: Falha na API de IA: {error_detail}")
                                 user_vars[variable_to_save_response] = f"ERRO_IA_API: {str(error_detail)[:200]}"
-                        except requests.exceptions.Timeout: user_vars[variable_to_save_response] = "ERRO_IA_TIMEOUT"; logger.error(f"Timeout (60s) ao chamar API de IA.")
+                        except AIUpstreamUnavailable as e: user_vars[variable_to_save_response] = f"ERRO_IA_INDISPONIVEL: {e}"; ai_upstream_unavailable = True; logger.error(f"Nó gptQuery {active_node_id}: API de IA indisponível ({e}). Saindo pela edge de erro.")
+                        except requests.exceptions.Timeout: user_vars[variable_to_save_response] = "ERRO_IA_TIMEOUT"; logger.error(f"Timeout (conexão {ai_client.connect_timeout}s / leitura {ai_client.read_timeout}s) ao chamar API de IA.")
                         except requests.exceptions.RequestException as e: user_vars[variable_to_save_response] = f"ERRO_IA_CONEXAO: {str(e)[:100]}"; logger.error(f"Erro de requisição à API de IA: {e}")
                         except Exception as e: user_vars[variable_to_save_response] = f"ERRO_IA_INESPERADO: {str(e)[:100]}"; logger.error(f"Erro inesperado ao processar IA: {e}", exc_info=True)
-                potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type) # Sempre tenta transição padrão após gptQuery
+                        if ai_upstream_unavailable: potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_error_", node_type) # Upstream fora: sai direto pela edge de erro
+                if not ai_upstream_unavailable or not potential_next_node_id_after_processing: potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type) # Sempre tenta transição padrão após gptQuery
             current_message_trigger = "_internal_transition_"
         
         elif node_type == "condition":
-            is_true_branch = evaluate_condition(node_data, current_message_trigger, user_vars)
+            is_true_branch = current_node_object.predicate(user_vars)
             handle_to_follow = 'source-true' if is_true_branch else 'source-false'
-            edge_found = next((e for e in current_flow_definition.get("edges", []) if e.get('source') == active_node_id and e.get('sourceHandle') == handle_to_follow), None)
-            if edge_found: potential_next_node_id_after_processing = edge_found.get('target')
-            else: logger.warning(f"Condition: Nó {active_node_id}, não encontrada edge para handle '{handle_to_follow}'.")
+            potential_next_node_id_after_processing = current_node_object.true_target if is_true_branch else current_node_object.false_target
+            if not potential_next_node_id_after_processing: logger.warning(f"Condition: Nó {active_node_id}, não encontrada edge para handle '{handle_to_follow}'.")
             current_message_trigger = "_internal_transition_"
 
         elif node_type in ["textMessage", "imageMessage", "audioMessage", "videoMessage", "fileMessage", "locationMessage", "buttonMessage", "listMessage", "endFlow"]: # Adicionado buttonMessage e listMessage aqui
-            if node_type == "endFlow": logger.info(f"EndFlow: Nó {active_node_id} atingido."); next_node_id_for_session_update = None; break
+            if node_type == "endFlow": logger.debug("EndFlow: Nó %s atingido.", active_node_id); next_node_id_for_session_update = None; break
             # Para nós de mensagem que não são interativos (ou interativos que já mostraram seu prompt e agora só transicionam)
             if node_type not in ["buttonMessage", "listMessage"] or current_message_trigger == "_internal_transition_":
-                 potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type)
+                 potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
                  if not potential_next_node_id_after_processing: next_node_id_for_session_update = None; break 
                  current_message_trigger = "_internal_transition_"
             else: # É buttonMessage ou listMessage e recebeu um input do usuário (trigger_value não é interno)
-                potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, current_message_trigger, user_vars, node_type)
+                potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, current_message_trigger, node_type)
                 current_message_trigger = "_internal_transition_"
 
+        elif node_type == "goToFlow":
+            target_flow = flow_registry.get(node_data.get("targetFlowId"))
+            if target_flow is not None:
+                logger.debug("GoToFlow: Nó %s desvia do fluxo %s para o fluxo %s (nó inicial %s).", active_node_id, flow.id, target_flow.id, target_flow.start_node_id)
+                flow = target_flow; user_session["flow_id"] = target_flow.id; user_session["flow_version"] = target_flow.version
+                potential_next_node_id_after_processing = target_flow.start_node_id
+            else:
+                logger.error(f"GoToFlow: Nó {active_node_id}, fluxo destino '{node_data.get('targetFlowId')}' não encontrado. Seguindo edge padrão.")
+                potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
+            current_message_trigger = "_internal_transition_"
+
         elif node_type == "startNode":
-            potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type)
+            potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
             current_message_trigger = "_internal_transition_"
         
         else: 
             logger.warning(f"Loop {hop_count}: Tipo de nó '{node_type}' (ID: {active_node_id}) não tratado explicitamente. Verificando edges padrão.");
-            potential_next_node_id_after_processing = determine_next_node_id_from_edges(active_node_id, "_internal_transition_", user_vars, node_type)
+            potential_next_node_id_after_processing = determine_next_node_id_from_edges(flow, active_node_id, "_internal_transition_", node_type)
             current_message_trigger = "_internal_transition_"
             if not potential_next_node_id_after_processing and node_type not in ["waitInput", "buttonMessage", "listMessage"]:
                  next_node_id_for_session_update = None; break
@@ -363,74 +528,345 @@ def process_message_route():
         if potential_next_node_id_after_processing:
             active_node_id = potential_next_node_id_after_processing
             user_session["history"].append({"transitioned_to_node": active_node_id, "via_trigger": current_message_trigger})
-            logger.info(f"Transição para '{active_node_id}'.")
+            logger.debug("Transição para '%s'.", active_node_id)
             if response_payload_to_send is None:
-                next_node_object_check = get_node_by_id(active_node_id)
+                next_node_object_check = flow.get_node(active_node_id)
                 if next_node_object_check:
-                    next_node_type_check = next_node_object_check.get("type")
+                    next_node_type_check = next_node_object_check.type
                     message_sending_node_types = ["textMessage", "imageMessage", "audioMessage", "videoMessage", "fileMessage", "locationMessage", "buttonMessage", "listMessage", "endFlow", "waitInput"]
                     if next_node_type_check in message_sending_node_types:
-                        logger.debug(f"Após transição para {active_node_id} (tipo {next_node_type_check}), gerando seu payload.")
-                        response_payload_to_send = get_response_payload_for_node(active_node_id, user_vars)
+                        logger.debug("Após transição para %s (tipo %s), gerando seu payload.", active_node_id, next_node_type_check)
+                        response_payload_to_send = get_response_payload_for_node(flow, active_node_id, user_vars)
         else: 
-            logger.info(f"Loop {hop_count}: Nenhuma transição de '{active_node_id}'.")
+            logger.debug("Loop %s: Nenhuma transição de '%s'.", hop_count, active_node_id)
             if node_type not in ["waitInput", "buttonMessage", "listMessage"]: next_node_id_for_session_update = None
             else: next_node_id_for_session_update = active_node_id
             break 
     
-    if hop_count >= max_hops: logger.error(f"Max hops atingido."); response_payload_to_send = {"type":"text", "text": "Erro."}; next_node_id_for_session_update = None 
+    if hop_started is not None: HOP_SECONDS.observe(time.perf_counter() - hop_started, node_type=hop_node_type)
+    if hop_count >= max_hops: logger.error(f"Max hops atingido."); MAX_HOPS_ABORTS.inc(); SESSION_RESETS.inc(reason="max_hops"); response_payload_to_send = {"type":"text", "text": "Erro."}; next_node_id_for_session_update = None 
     
-    if sender_id in user_states:
-        if next_node_id_for_session_update is not None:
-            user_states[sender_id]["current_node_id"] = next_node_id_for_session_update
-            logger.info(f"Sessão {sender_id} atualizada. Próx nó: '{next_node_id_for_session_update}'. Vars: {json.dumps(user_vars)}")
-        else:
-            logger.info(f"Fim do fluxo/erro para {sender_id}. Removendo sessão.")
-            del user_states[sender_id]
+    add_request_fields(hops=hop_count, end_node=active_node_id, flow_id=flow.id, flow_version=flow.version)
+    if next_node_id_for_session_update is None:
+        logger.debug("Fim do fluxo/erro para %s. Removendo sessão.", sender_id)
+        return response_payload_to_send, None
+    user_session["current_node_id"] = next_node_id_for_session_update
+    logger.debug("Sessão %s atualizada. Próx nó: '%s'. Variáveis: %s", sender_id, next_node_id_for_session_update, len(user_vars))
+    return response_payload_to_send, user_session
+
+def resolve_entry_flow(flow_id=None, campaign_id=None) -> tuple[CompiledFlow | None, str | None]:
+    # Retorna (fluxo de entrada, chave de roteamento). Sem flow_id/campaign_id no body vale o fluxo 'active' (comportamento original).
+    if flow_key(flow_id) is not None: return flow_registry.get_active(flow_id), f"flow:{flow_id}"
+    if campaign_id not in (None, ""): return flow_registry.get_for_campaign(campaign_id), f"campaign:{campaign_id}"
+    if current_flow.id is None or not current_flow.start_node_id:
+         if not load_flow_from_db() or not current_flow.start_node_id:
+            logger.error("API /process_message: Falha crítica ao recarregar fluxo ou fluxo inválido.")
+            return None, None
+         logger.info("Fluxo recarregado com sucesso durante o processamento da mensagem.")
+    return current_flow, None
+
+FLOW_SESSION_PINNING = os.environ.get('FLOW_SESSION_PINNING', 'true').lower() == 'true'
 
+def resolve_session_flow(session_key: str, stored_session: dict | None, entry_flow: CompiledFlow) -> tuple[CompiledFlow, dict | None]:
+    # Qual versão de qual fluxo executa esta sessão. A sessão continua no fluxo em que está (ex.: depois de um goToFlow);
+    # se ele foi atualizado, fica fixada na versão em que começou enquanto ela estiver retida em memória
+    # (FLOW_VERSIONS_RETAINED) e depois migra para a versão nova se o nó atual ainda existir nela.
+    if not stored_session: return entry_flow, None
+    session_flow_key = flow_key(stored_session.get("flow_id"))
+    latest = entry_flow if session_flow_key in (None, flow_key(entry_flow.id)) else flow_registry.get(session_flow_key)
+    if latest is None:
+        logger.warning(f"Sessão {session_key}: fluxo {session_flow_key} indisponível. Reiniciando no fluxo {entry_flow.id}.")
+        SESSION_RESETS.inc(reason="flow_unavailable"); return entry_flow, None
+    session_version = stored_session.get("flow_version")
+    if session_version is None or session_version == latest.version: return latest, stored_session
+    if FLOW_SESSION_PINNING:
+        pinned = flow_registry.get_version(latest.id, session_version)
+        if pinned is not None: return pinned, stored_session
+    if stored_session.get("current_node_id") in latest.nodes:
+        logger.info(f"Sessão {session_key}: migrada do fluxo {latest.id} versão {session_version} para {latest.version} (nó '{stored_session.get('current_node_id')}' mantido).")
+        stored_session["flow_version"] = latest.version
+        return latest, stored_session
+    logger.warning(f"Sessão {session_key}: nó '{stored_session.get('current_node_id')}' não existe na versão {latest.version} do fluxo {latest.id}. Reiniciando sessão.")
+    SESSION_RESETS.inc(reason="flow_version_changed"); return latest, None
+
+@MESSAGE_SECONDS.time()
+@request_profiler.profiled("message")
+def handle_incoming_message(sender_id: str, message_content_or_interaction_id, flow_id=None, campaign_id=None, timer_id=None) -> tuple[dict, int]:
+    with request_log_context(logger, "Mensagem processada", sender_id=sender_id, flow_id=flow_id, campaign_id=campaign_id) as log_fields:
+        response_data, status_code = _process_incoming_message(sender_id, message_content_or_interaction_id, flow_id, campaign_id, timer_id)
+        log_fields["status"] = status_code
+    return response_data, status_code
+
+def _process_incoming_message(sender_id: str, message_content_or_interaction_id, flow_id=None, campaign_id=None, timer_id=None) -> tuple[dict, int]:
+    # timer_id: disparo de timer; só vale se a sessão ainda estiver esperando exatamente esse timer
+    if timer_id is None and isinstance(message_content_or_interaction_id, str) and message_content_or_interaction_id in INTERNAL_TRIGGERS:
+        logger.warning(f"Mensagem de {sender_id} com trigger interno reservado ('{message_content_or_interaction_id}'). Rejeitada.")
+        return {"error": "Mensagem reservada para uso interno."}, 400
+    entry_flow, routing_key = resolve_entry_flow(flow_id, campaign_id)  # Referência fixa durante toda a mensagem, mesmo se houver recarga concorrente
+    if entry_flow is None:
+        if routing_key is not None: logger.error(f"API /process_message: nenhum fluxo válido para '{routing_key}'."); return {"error": f"Fluxo não encontrado para '{routing_key}'."}, 404
+        return {"response_payload": {"type":"text", "text": "Desculpe, o sistema está temporariamente indisponível."}}, 200
+    session_key = sender_id if routing_key is None else f"{routing_key}:{sender_id}"  # Mesmo contato em canais diferentes = sessões diferentes
+
+    # Mensagens do mesmo contato são serializadas neste processo; entre processos vale o lock otimista: processa sobre uma
+    # cópia e só grava se ninguém alterou a sessão nesse meio-tempo. Se alterou, reprocessa reaproveitando as respostas de IA.
+    with session_locks.hold(session_key): return _process_session_message(session_key, sender_id, message_content_or_interaction_id, entry_flow, flow_id, campaign_id, timer_id)
+
+def _process_session_message(session_key: str, sender_id: str, message_content_or_interaction_id, entry_flow: CompiledFlow, flow_id, campaign_id, timer_id) -> tuple[dict, int]:
+    side_effects = {}
+    for attempt in range(1, SESSION_CAS_MAX_ATTEMPTS + 1):
+        try:
+            with SESSION_STORE_SECONDS.time(operation="load"): stored_session, session_version = session_store.load(session_key)
+            flow, stored_session = resolve_session_flow(session_key, stored_session, entry_flow)
+            previous_timer = stored_session.get("timer") if stored_session else None
+            if timer_id is not None and (previous_timer or {}).get("id") != timer_id:
+                logger.info(f"Timer {timer_id} da sessão {session_key} obsoleto (sessão encerrada, respondida ou reiniciada). Ignorado.")
+                add_request_fields(timer="stale"); return {"stale_timer": True}, 200
+            response_payload_to_send, updated_session = run_flow_engine(flow, sender_id, stored_session, message_content_or_interaction_id, side_effects, timer_fired=timer_id is not None)
+            scheduled_timer = updated_session.get("timer") if updated_session else None
+            if scheduled_timer is not None: scheduled_timer.setdefault("route", {"sender_id": sender_id, "flow_id": flow_id, "campaign_id": campaign_id})
+            if updated_session is None:
+                with SESSION_STORE_SECONDS.time(operation="delete"): committed = session_store.delete(session_key, session_version)
+            else:
+                with SESSION_STORE_SECONDS.time(operation="save"): committed = session_store.save(session_key, updated_session, session_version)
+        except Exception as e:
+            if timer_id is not None: raise  # Disparo de timer não gravado: o scheduler reagenda com backoff
+            logger.error(f"Erro no session store ({session_store.backend_name}) para {session_key}: {e}", exc_info=True)
+            return {"response_payload": {"type":"text", "text": "Desculpe, o sistema está temporariamente indisponível."}}, 200
+        if committed: break
+        logger.warning(f"Sessão {session_key} alterada concorrentemente (versão {session_version}). Reprocessando ({attempt}/{SESSION_CAS_MAX_ATTEMPTS}).")
+    else:
+        logger.error(f"Sessão {session_key}: conflito de concorrência persistente após {SESSION_CAS_MAX_ATTEMPTS} tentativas.")
+        return {"error": "Conflito de sessão concorrente, tente novamente."}, 409
+
+    # A sessão (com o timer dentro) é a fonte da verdade; o índice de timers só é atualizado depois do commit
+    try:
+        if scheduled_timer is not None and scheduled_timer["id"] != (previous_timer or {}).get("id"): timer_scheduler.schedule(session_key, scheduled_timer)
+        elif scheduled_timer is None and previous_timer is not None: timer_scheduler.cancel(session_key)
+    except Exception as e: logger.error(f"Falha ao atualizar timer da sessão {session_key} ({timer_scheduler.store.backend_name}): {e}", exc_info=True)
     final_response_data = {}
     if response_payload_to_send: final_response_data["response_payload"] = response_payload_to_send
-    logger.info(f"API /process_message: Respondendo Next.js para {sender_id} {'COM' if response_payload_to_send else 'SEM'} payload.")
-    return jsonify(final_response_data), 200
+    add_request_fields(session="ended" if updated_session is None else "saved", cas_attempts=attempt, payload=bool(response_payload_to_send))
+    return final_response_data, 200
+
+@app.before_request
+def _start_request_timer():
+    flask.g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    started = getattr(flask.g, "request_started", None)
+    if started is not None: REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
+def parse_bool(value, default: bool) -> bool | None:
+    # Aceita true/false do JSON e as formas em texto ("false" não é verdadeiro); None = valor inválido
+    if value is None: return default
+    if isinstance(value, bool): return value
+    if isinstance(value, int) and value in (0, 1): return bool(value)
+    if isinstance(value, str):
+        normalized = value.strip().lower()
+        if normalized in ("true", "1", "yes", "sim", "on"): return True
+        if normalized in ("false", "0", "no", "nao", "não", "off", ""): return False
+    return None
+
+@app.route('/process_message', methods=['POST'])
+def process_message_route():
+    data = request.json
+    if not data: logger.warning("API /process_message: Request body vazio."); return jsonify({"error": "Request body is missing"}), 400
+    sender_id = data.get('sender_id'); message_content_or_interaction_id = data.get('message', '') 
+    logger.debug("API /process_message: Recebido de sender_id='%s', message/interaction='%.100s'", sender_id, message_content_or_interaction_id)
+    if not sender_id: return jsonify({"error": "sender_id é obrigatório"}), 400
+    flow_id = data.get('flow_id'); campaign_id = data.get('campaign_id')
+    run_async = parse_bool(data.get('async'), PROCESS_MESSAGE_MODE == 'async')
+    if run_async is None: return jsonify({"error": "async deve ser booleano"}), 400
+    if run_async:
+        callback_url = data.get('callback_url') or ASYNC_CALLBACK_URL
+        if callback_url and not (isinstance(callback_url, str) and callback_url_allowed(callback_url, ASYNC_CALLBACK_ALLOWED_URLS)):
+            logger.warning(f"API /process_message: callback_url '{str(callback_url)[:200]}' fora da lista permitida. Rejeitado."); return jsonify({"error": "callback_url não permitida"}), 400
+        return enqueue_message_job(sender_id, message_content_or_interaction_id, callback_url, flow_id, campaign_id)
+    response_data, status_code = handle_incoming_message(sender_id, message_content_or_interaction_id, flow_id, campaign_id)
+    return jsonify(response_data), status_code
+
+@app.route('/process_messages', methods=['POST'])
+def process_messages_route():
+    # Corpo: {"messages": [{sender_id, message, flow_id?, campaign_id?}, ...], "flow_id"?, "campaign_id"?} ou a lista direto.
+    # Resposta: um resultado por item, na ordem recebida; erro em um item não derruba o lote.
+    # Estourado BATCH_TIMEOUT, itens que não começaram são cancelados (504, podem ser reenviados) e os que já rodam viram 202 com job_id.
+    data = request.get_json(silent=True)
+    items = data.get('messages') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items: logger.warning("API /process_messages: lista 'messages' vazia ou ausente."); return jsonify({"error": "messages (lista não vazia) é obrigatório"}), 400
+    if len(items) > BATCH_MAX_ITEMS: return jsonify({"error": f"Lote com {len(items)} mensagens excede o limite de {BATCH_MAX_ITEMS}."}), 413
+    defaults = data if isinstance(data, dict) else {}
+    BATCH_ITEMS.observe(len(items))
+
+    results = [None] * len(items); groups = {}
+    for index, item in enumerate(items):
+        sender_id = item.get('sender_id') if isinstance(item, dict) else None
+        if not sender_id or isinstance(sender_id, (dict, list)): results[index] = {"status_code": 400, "error": "sender_id é obrigatório"}; continue
+        groups.setdefault(str(sender_id), []).append(index)
+
+    late_jobs = {}; batch_lock = threading.Lock()  # Itens ainda rodando no fim do prazo viram jobs em /result/<job_id>
+
+    def run_group(indexes: list, futures: list):
+        for position, (index, future) in enumerate(zip(indexes, futures)):
+            if not future.set_running_or_notify_cancel():
+                for later in futures[position:]: later.cancel()  # Prazo do lote estourou: nada deste sender roda fora de ordem
+                return
+            item = items[index]
+            try: response_data, status_code = handle_incoming_message(item['sender_id'], item.get('message', ''), item.get('flow_id', defaults.get('flow_id')), item.get('campaign_id', defaults.get('campaign_id')))
+            except Exception as e:
+                logger.error(f"API /process_messages: item {index} ({item['sender_id']}) falhou: {e}", exc_info=True)
+                response_data, status_code = {"error": "Erro interno ao processar mensagem."}, 500
+            with batch_lock: future.set_result({"status_code": status_code, **response_data}); job_id = late_jobs.get(index)
+            if job_id is not None: record_job_result(job_id, status_code, response_data)
+
+    pending = {}
+    for sender_key, indexes in groups.items():
+        futures = [Future() for _ in indexes]
+        try: message_executor.submit(items[indexes[0]]['sender_id'], lambda indexes=indexes, futures=futures: run_group(indexes, futures))
+        except QueueFull as e:
+            logger.error(f"API /process_messages: {e} Rejeitando {len(indexes)} mensagens de {sender_key}.")
+            for index in indexes: results[index] = {"status_code": 503, "error": "Fila de processamento cheia, tente novamente."}
+            continue
+        pending.update(zip(futures, indexes))
+    wait_futures(pending, timeout=BATCH_TIMEOUT)
+    with batch_lock:
+        for future, index in pending.items():
+            if future.done() and not future.cancelled(): results[index] = future.result()
+            elif future.cancel():
+                # Ainda não tinha começado: cancelado e nunca vai rodar, o chamador pode reenviar
+                results[index] = {"status_code": 504, "error": f"Não processada em {BATCH_TIMEOUT}s (cancelada, pode ser reenviada).", "cancelled": True}
+            else:
+                # Já está rodando e vai gravar a sessão: o resultado fica em /result/<job_id>, reenviar processaria duas vezes
+                job_id = uuid.uuid4().hex; sender_id = items[index]['sender_id']
+                if store_job(job_id, sender_id, status="running"):
+                    late_jobs[index] = job_id; results[index] = {"status_code": 202, "job_id": job_id, "status": "running", "result_url": f"/result/{job_id}"}
+                else: results[index] = {"status_code": 202, "status": "running", "error": f"Ainda em processamento após {BATCH_TIMEOUT}s; resultado indisponível."}
+    for index, result in enumerate(results): result["index"] = index; result["sender_id"] = items[index].get('sender_id') if isinstance(items[index], dict) else None
+    logger.info(f"API /process_messages: lote de {len(items)} mensagens ({len(groups)} senders) processado.")
+    return jsonify({"results": results}), 200
+
+def update_job(job_id: str, **fields) -> bool:
+    # Falha no store de resultados (Redis/MySQL fora) é registrada, mas não derruba o job nem impede o callback
+    try: async_job_store.update(job_id, **fields); return True
+    except Exception as e: logger.error(f"Job {job_id}: falha ao gravar {sorted(fields)} no store de resultados ({async_job_store.backend_name}): {e}", exc_info=True); return False
+
+def store_job(job_id: str, sender_id: str, **fields) -> bool:
+    try: async_job_store.create(job_id, sender_id)
+    except Exception as e: logger.error(f"Job {job_id}: falha ao criar no store de resultados ({async_job_store.backend_name}): {e}", exc_info=True); return False
+    return update_job(job_id, **fields) if fields else True
+
+def record_job_result(job_id: str, status_code: int, response_data: dict) -> bool:
+    return update_job(job_id, status="done" if status_code < 400 else "failed", status_code=status_code, result=response_data, finished_at=time.time())
+
+def run_message_job(job_id: str, sender_id: str, message_content_or_interaction_id, callback_url: str | None, flow_id=None, campaign_id=None):
+    update_job(job_id, status="running", started_at=time.time())
+    try: response_data, status_code = handle_incoming_message(sender_id, message_content_or_interaction_id, flow_id, campaign_id)
+    except Exception as e:
+        logger.error(f"Job {job_id} ({sender_id}) falhou: {e}", exc_info=True)
+        response_data, status_code = {"error": "Erro interno ao processar mensagem."}, 500
+    record_job_result(job_id, status_code, response_data)
+    if callback_url:
+        delivered = callback_sender.send(callback_url, {"job_id": job_id, "sender_id": sender_id, "status_code": status_code, **response_data})
+        update_job(job_id, callback_delivered=delivered)
+
+def enqueue_message_job(sender_id: str, message_content_or_interaction_id, callback_url: str | None, flow_id=None, campaign_id=None):
+    job_id = uuid.uuid4().hex
+    if not store_job(job_id, sender_id): return jsonify({"error": "Store de resultados indisponível, tente novamente."}), 503
+    try: message_executor.submit(sender_id, lambda: run_message_job(job_id, sender_id, message_content_or_interaction_id, callback_url, flow_id, campaign_id))
+    except QueueFull as e:
+        update_job(job_id, status="rejected")
+        logger.error(f"API /process_message: {e} Rejeitando mensagem de {sender_id}.")
+        return jsonify({"error": "Fila de processamento cheia, tente novamente."}), 503
+    logger.info(f"API /process_message: Mensagem de {sender_id} enfileirada como job {job_id}.")
+    return jsonify({"job_id": job_id, "status": "queued", "result_url": f"/result/{job_id}"}), 202
+
+def fire_session_timer(session_key: str, timer_id: str):
+    # Roda no executor quando um timer vence: reprocessa a sessão com TIMER_TRIGGER e entrega o payload por callback
+    stored_session, _ = session_store.load(session_key)
+    timer = (stored_session or {}).get("timer") or {}
+    if timer.get("id") != timer_id: TIMER_FIRES.inc(kind=timer.get("kind") or "unknown", outcome="stale"); return
+    route = timer.get("route") or {}; sender_id = route.get("sender_id") or session_key
+    response_data, status_code = handle_incoming_message(sender_id, TIMER_TRIGGER, route.get("flow_id"), route.get("campaign_id"), timer_id=timer_id)
+    TIMER_FIRES.inc(kind=timer.get("kind"), outcome="stale" if response_data.get("stale_timer") else "fired" if status_code < 400 else "failed")
+    if status_code >= 400: raise RuntimeError(f"disparo não gravado (HTTP {status_code}: {response_data.get('error')})")
+    if not response_data.get("response_payload"): return
+    if not TIMER_CALLBACK_URL: logger.warning(f"Timer {timer_id} de {sender_id} gerou resposta, mas TIMER_CALLBACK_URL/ASYNC_CALLBACK_URL não está definida. Payload descartado."); return
+    callback_sender.send(TIMER_CALLBACK_URL, {"sender_id": sender_id, "timer_id": timer_id, "timer_kind": timer.get("kind"), "node_id": timer.get("node_id"),
+                                              "flow_id": route.get("flow_id"), "campaign_id": route.get("campaign_id"), "status_code": status_code, **response_data})
+
+@app.route('/result/<job_id>', methods=['GET'])
+def job_result_route(job_id):
+    job = async_job_store.get(job_id)
+    if not job: return jsonify({"error": "job_id desconhecido ou expirado"}), 404
+    if job["status"] in ("queued", "running"): return jsonify({"job_id": job_id, "status": job["status"]}), 202
+    return jsonify({"job_id": job_id, "status": job["status"], "status_code": job.get("status_code"), "result": job.get("result")}), 200
 
 @app.route('/reload_flow', methods=['POST'])
 def reload_flow_endpoint():
     logger.info("API /reload_flow: Solicitada recarga.")
-    previous_flow_id = current_flow_definition.get("id")
+    requested_flow_id = (request.get_json(silent=True) or {}).get('flow_id')
+    if flow_key(requested_flow_id) is not None and flow_key(requested_flow_id) != flow_key(current_flow.id):
+        # Fluxo não-ativo servido pelo registro: recompila do DB e troca a versão em cache
+        reloaded, _ = flow_registry.refresh(requested_flow_id)
+        if reloaded: return jsonify({"success": True, "message": f"Fluxo '{reloaded.name}' (ID: {reloaded.id}) recarregado.", "version": reloaded.version}), 200
+        return jsonify({"success": False, "message": f"Falha ao recarregar fluxo {requested_flow_id}."}), 500
+    previous_flow_id = current_flow.id; previous_version = current_flow.version
     success = load_flow_from_db()
     if success:
-        if previous_flow_id is None or current_flow_definition.get("id") != previous_flow_id :
-            logger.info(f"Fluxo alterado/carregado (ID: {current_flow_definition.get('id')}). Limpando {len(user_states)} estados de usuário.")
-            user_states.clear()
-        else: 
-            logger.info("Fluxo recarregado, ID e nó inicial são os mesmos. Estados mantidos.")
-        return jsonify({"success": True, "message": f"Fluxo '{current_flow_definition.get('name', 'N/A')}' (ID: {current_flow_definition.get('id')}) recarregado."}), 200
+        # Sessões não são mais apagadas: as em andamento seguem na versão em que estão (ou migram), ver resolve_session_flow
+        if previous_flow_id is None or current_flow.id != previous_flow_id: logger.info(f"Fluxo ativo alterado/carregado (ID: {current_flow.id}, versão {current_flow.version}). Sessões existentes mantidas.")
+        elif current_flow.version != previous_version: logger.info(f"Fluxo {current_flow.id} atualizado: versão {previous_version} -> {current_flow.version}. Sessões existentes mantidas.")
+        else: logger.info("Fluxo recarregado, sem mudanças de conteúdo. Estados mantidos.")
+        return jsonify({"success": True, "message": f"Fluxo '{current_flow.name or 'N/A'}' (ID: {current_flow.id}) recarregado.", "version": current_flow.version}), 200
     return jsonify({"success": False, "message": "Falha ao recarregar fluxo."}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    FLOW_NODES.set(current_flow.node_count); FLOW_EDGES.set(current_flow.edge_count); CACHED_FLOWS.set(flow_registry.stats()["cached"])
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    flow_loaded_ok = ( current_flow_definition.get("id") is not None and
-                       current_flow_definition.get("start_node_id") is not None and
-                       get_node_by_id(current_flow_definition.get("start_node_id")) is not None )
+    flow_loaded_ok = current_flow.is_ready
     db_ok = False; db_err_msg = "N/A"
-    try: conn_test = get_mysql_connection(); conn_test.close(); db_ok = True
+    try:
+        with db_connection() as conn_test: conn_test.ping(reconnect=False)
+        db_ok = True
     except Exception as e: db_err_msg = str(e)
     is_healthy = flow_loaded_ok and db_ok
-    status_data = {"status": "ok" if is_healthy else "degraded", "details": {"flow_loaded": flow_loaded_ok, "db_connection": db_ok}}
+    status_data = {"status": "ok" if is_healthy else "degraded", "details": {"flow_loaded": flow_loaded_ok, "db_connection": db_ok, "flow_nodes": current_flow.node_count, "flow_edges": current_flow.edge_count, "db_pool": db_pool.stats(), "ai_upstream": ai_client.stats(), "ai_cache": ai_response_cache.stats(), "async_queue": message_executor.stats(), "flow_registry": flow_registry.stats(), "sessions": session_store.stats(), "timers": timer_scheduler.stats()}}
     if not flow_loaded_ok: status_data["details"]["flow_error"] = "Fluxo não carregado ou inválido."
     if not db_ok: status_data["details"]["db_error"] = db_err_msg
-    logger.info(f"Health check: {status_data['status']}")
+    logger.debug("Health check: %s", status_data['status'])
     return jsonify(status_data), 200 if is_healthy else 503
 
 @app.route('/', methods=['GET', 'POST'])
 def root_route():
     return jsonify({ "message": "Flow Controller Service (MySQL) is running." }), 200
 
+_background = ProcessOnce()
+
+def ensure_flow_loaded():
+    # Worker que não herdou fluxo do master (sem snapshot): carrega do MySQL antes de atender; se falhar, a primeira mensagem tenta de novo
+    if current_flow.id is None and not flow_loaded_from_snapshot: init_flow()
+
+def start_background_work():
+    # Threads não sobrevivem a fork: com gunicorn é chamada em cada worker (post_worker_init no gunicorn.conf.py)
+    ensure_flow_loaded(); _background.run(_start_background_threads)
+
+def _start_background_threads():
+    start_flow_poller(); start_session_sweeper(session_store); metrics.start_flusher(); timer_scheduler.start()
+    threading.Thread(target=check_ai_dns, name="dns-check", daemon=True).start()
+    if flow_loaded_from_snapshot: threading.Thread(target=revalidate_flow, name="flow-revalidate", daemon=True).start()
+
+# FLOW_BACKGROUND_START=post_worker_init (padrão no gunicorn.conf.py): o master só instala o snapshot (se houver),
+# quem carrega do MySQL e sobe as threads são os workers
+FLOW_BACKGROUND_START = os.environ.get('FLOW_BACKGROUND_START', 'import')
 logger.info("Módulo flow_controller.py carregado. Tentando carregar fluxo inicial...")
-if not load_flow_from_db():
-    logger.critical("FALHA CRÍTICA AO CARREGAR FLUXO INICIAL NA INICIALIZAÇÃO.")
-else:
-    logger.info("Fluxo inicial carregado com sucesso.")
+init_flow(load_from_db=FLOW_BACKGROUND_START == 'import')
+if FLOW_BACKGROUND_START == 'import': start_background_work()
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5001)) 
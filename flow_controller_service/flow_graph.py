@@ -0,0 +1,222 @@
+# flow_controller_service/flow_graph.py
+# Compilação do fluxo (elements do React Flow) em um grafo indexado.
+# Tudo o que depende só da definição do fluxo é resolvido uma única vez no load:
+# edges de saída por nó (sourceHandle -> target), handles padrão/erro/true/false,
+# configuração dos nós e validação. O roteamento por mensagem fica O(1) por hop.
+import hashlib
+import json
+import logging
+
+from conditions import compile_condition
+from text_templates import CompiledTemplate
+
+logger = logging.getLogger("flow_controller.flow_graph")
+
+TIMER_TRIGGER = "_internal_timer_"  # disparo de timer (delay / timeout de waitInput) pelo scheduler
+INTERNAL_TRIGGERS = frozenset({"_internal_start_flow_", "_internal_transition_", "_internal_error_", TIMER_TRIGGER})
+DEFAULT_SOURCE_HANDLES = frozenset({"source", "source-bottom", "source-default", "source-success"})
+# Campos de texto com {{variáveis}} tokenizados no load, por tipo de nó
+TEMPLATE_FIELDS = {
+    "textMessage": ("text",), "endFlow": ("text",), "waitInput": ("message",),
+    "setVariable": ("variableName", "value"), "gptQuery": ("prompt", "systemMessage"),
+}
+
+
+class CompiledNode:
+    __slots__ = ("id", "type", "data", "handles", "default_target", "default_handle",
+                 "error_target", "true_target", "false_target", "received_target", "config_error", "templates", "predicate",
+                 "timer_seconds", "time_window", "cache_ttl")
+
+    def __init__(self, node_id: str, node_type: str | None, data: dict):
+        self.id = node_id; self.type = node_type; self.data = data
+        self.handles = {}  # sourceHandle -> target (primeira edge vence, como no scan linear antigo)
+        self.default_target = None; self.default_handle = None
+        self.error_target = None; self.true_target = None; self.false_target = None; self.received_target = None
+        self.config_error = None
+        self.templates = {}  # campo -> CompiledTemplate
+        self.predicate = None  # nós condition: variables -> bool
+        self.timer_seconds = None  # delay: duração; waitInput: timeoutSeconds (None = sem timer)
+        self.time_window = None  # timeCondition: (início, fim) em minutos do dia
+        self.cache_ttl = None  # gptQuery com cacheResponse: TTL em segundos (0 = padrão do cache); None = sem cache
+
+    def __getstate__(self):
+        # predicate é uma closure (não serializável): no snapshot em disco vai só o resto, e ele é recompilado de data ao carregar
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != "predicate"}
+
+    def __setstate__(self, state: dict):
+        for slot in self.__slots__: setattr(self, slot, state.get(slot))
+        if self.type == "condition": self.predicate, _ = compile_condition(self.data)
+
+    def render(self, field: str, variables: dict) -> str | None:
+        template = self.templates.get(field)
+        return template.render(variables) if template is not None else None
+
+
+class CompiledFlow:
+    # Imutável depois de compilado: uma recarga cria outro objeto e troca a referência (swap atômico)
+    __slots__ = ("id", "name", "nodes", "start_node_id", "node_count", "edge_count", "problems", "version", "source_updated_at", "secret_variables")
+
+    def __init__(self, flow_id=None, name=None, nodes: dict | None = None, start_node_id: str | None = None,
+                 edge_count: int = 0, problems: list | None = None, version: str | None = None, source_updated_at=None):
+        self.id = flow_id; self.name = name; self.nodes = nodes or {}
+        self.start_node_id = start_node_id; self.node_count = len(self.nodes); self.edge_count = edge_count
+        self.problems = problems or []
+        self.version = version; self.source_updated_at = source_updated_at
+        # Variáveis que guardam API keys (apiKeyVariable dos gptQuery): o valor nunca vai para os logs
+        self.secret_variables = frozenset(node.data["apiKeyVariable"] for node in self.nodes.values()
+                                          if node.type == "gptQuery" and isinstance(node.data.get("apiKeyVariable"), str))
+
+    @classmethod
+    def empty(cls):
+        return cls()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.id is not None and self.start_node_id is not None and self.start_node_id in self.nodes
+
+    def get_node(self, node_id: str | None) -> CompiledNode | None:
+        if not node_id: return None
+        return self.nodes.get(node_id)
+
+    def next_node_id(self, current_node_id: str, trigger_value, node_type_of_source: str | None) -> str | None:
+        node = self.nodes.get(current_node_id)
+        if node is None: logger.warning(f"Roteamento: nó '{current_node_id}' não existe no fluxo compilado."); return None
+        logger.debug("Determinando próximo nó de %s (Tipo:%s). Handles:%s. Trigger:'%s'", current_node_id, node_type_of_source, len(node.handles), trigger_value)
+        if trigger_value and not (isinstance(trigger_value, str) and trigger_value in INTERNAL_TRIGGERS):
+            try: target = node.handles.get(trigger_value)
+            except TypeError: target = None  # trigger não-hashable (ex.: dict vindo do JSON) nunca casa com um handle
+            if target is not None: logger.debug("Edge por sourceHandle '%s'. Próximo nó: %s", trigger_value, target); return target
+        if node_type_of_source == "waitInput" and trigger_value not in (None, "_internal_start_flow_", "_internal_transition_", TIMER_TRIGGER):
+            if node.received_target is not None: logger.debug("WaitInput: Input '%.50s'. Edge 'source-received'. Próximo nó: %s", trigger_value, node.received_target); return node.received_target
+        if trigger_value == "_internal_error_" and node.error_target is not None:
+            logger.debug("Nó %s em erro. Usando edge 'source-error'. Próximo nó: %s", current_node_id, node.error_target); return node.error_target
+        if node.default_target is not None:
+            logger.debug("Usando edge padrão de %s (handle: %s). Próximo nó: %s", current_node_id, node.default_handle, node.default_target); return node.default_target
+        logger.warning(f"Nenhuma edge aplicável de {current_node_id} (Tipo:{node_type_of_source}) com trigger '{trigger_value}'.")
+        return None
+
+
+def _validate_node(node: CompiledNode) -> str | None:
+    data = node.data
+    if node.type == "gptQuery":
+        missing = [f for f in ("prompt", "saveResponseTo", "apiKeyVariable") if not data.get(f)]
+        if missing: return f"gptQuery sem {', '.join(missing)}"
+        if data.get("cacheResponse") in (True, "true", 1): node.cache_ttl = _duration_seconds(data.get("cacheTtlSeconds"), "seconds") or 0.0
+    elif node.type == "condition":
+        node.predicate, error = compile_condition(data)
+        return error
+    elif node.type == "setVariable":
+        if not data.get("variableName"): return "setVariable sem variableName"
+    elif node.type == "delay":
+        seconds = _duration_seconds(data.get("duration") or 1, data.get("unit") or "seconds")  # padrões do editor
+        if seconds is None: return f"delay com duração inválida ({data.get('duration')!r} {data.get('unit')!r})"
+        node.timer_seconds = seconds
+    elif node.type == "waitInput":
+        # Como no editor, timeout só vale com valor > 0 (senão espera indefinidamente)
+        if data.get("timeoutSeconds") not in (None, ""):
+            try: timeout = float(data["timeoutSeconds"])
+            except (TypeError, ValueError): return f"waitInput com timeoutSeconds inválido ({data['timeoutSeconds']!r})"
+            if timeout > 0: node.timer_seconds = timeout
+    elif node.type == "timeCondition":
+        # Padrões iguais aos do editor (09:00-18:00) quando o nó nunca foi editado
+        start = _minute_of_day(data.get("startTime") or "09:00"); end = _minute_of_day(data.get("endTime") or "18:00")
+        if start is None or end is None: return f"timeCondition com horário inválido ({data.get('startTime')!r}-{data.get('endTime')!r})"
+        node.time_window = (start, end)
+    return None
+
+
+def _duration_seconds(value, unit) -> float | None:
+    try: amount = float(value)
+    except (TypeError, ValueError): return None
+    if amount <= 0 or unit not in ("seconds", "minutes"): return None
+    return amount * 60 if unit == "minutes" else amount
+
+
+def _minute_of_day(value) -> int | None:
+    try: hours, minutes = (int(part) for part in str(value).split(":"))
+    except ValueError: return None
+    return hours * 60 + minutes if 0 <= hours < 24 and 0 <= minutes < 60 else None
+
+
+def in_time_window(window: tuple, minute_of_day: int) -> bool:
+    # Janela [início, fim); início > fim atravessa a meia-noite (ex.: 22:00-06:00)
+    start, end = window
+    return start <= minute_of_day < end if start <= end else (minute_of_day >= start or minute_of_day < end)
+
+
+def _node_signature(node: CompiledNode) -> tuple:
+    return (node.type, repr(sorted(node.data.items())), tuple(sorted(node.handles.items())), node.default_target)
+
+
+def diff_flows(old: CompiledFlow, new: CompiledFlow) -> dict:
+    # Diferença entre duas versões do mesmo fluxo, usada para decidir quais sessões migram
+    old_ids = set(old.nodes); new_ids = set(new.nodes)
+    changed = sorted(nid for nid in old_ids & new_ids if _node_signature(old.nodes[nid]) != _node_signature(new.nodes[nid]))
+    return {"added": sorted(new_ids - old_ids), "removed": sorted(old_ids - new_ids), "changed": changed}
+
+
+def elements_version(elements_data) -> str:
+    # Versão = hash do conteúdo: só muda quando nós/edges mudam (não em toggles de status)
+    if isinstance(elements_data, str): elements_data = elements_data.encode("utf-8")
+    elif not isinstance(elements_data, (bytes, bytearray)): elements_data = json.dumps(elements_data, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(elements_data).hexdigest()[:12]
+
+
+def compile_flow(flow_id, flow_name, elements: dict, version: str | None = None, source_updated_at=None) -> CompiledFlow:
+    problems = []
+    nodes_list = elements.get("nodes", []) if isinstance(elements, dict) else []
+    edges_list = elements.get("edges", []) if isinstance(elements, dict) else []
+    if not isinstance(nodes_list, list) or not isinstance(edges_list, list):
+        logger.warning(f"Formato de 'nodes' ou 'edges' inválido no fluxo {flow_id}."); nodes_list, edges_list = [], []
+
+    nodes = {}
+    for raw in nodes_list:
+        if not isinstance(raw, dict) or "id" not in raw: continue
+        data = raw.get("data") if isinstance(raw.get("data"), dict) else {}
+        node = CompiledNode(raw["id"], raw.get("type"), data)
+        node.config_error = _validate_node(node)
+        for field in TEMPLATE_FIELDS.get(node.type, ()):
+            if data.get(field) is not None: node.templates[field] = CompiledTemplate(str(data[field]))
+        if node.type == "setVariable" and "value" not in node.templates: node.templates["value"] = CompiledTemplate("")
+        if node.config_error: problems.append(f"Nó {node.id}: {node.config_error}")
+        nodes[node.id] = node
+
+    edge_count = 0; all_target_ids = set(); default_handles = {}
+    for edge in edges_list:
+        if not isinstance(edge, dict): continue
+        edge_count += 1
+        source = edge.get("source"); target = edge.get("target"); handle = edge.get("sourceHandle")
+        if target: all_target_ids.add(target)
+        node = nodes.get(source)
+        if node is None: problems.append(f"Edge {edge.get('id')}: origem '{source}' inexistente"); continue
+        if target not in nodes: problems.append(f"Edge {edge.get('id')}: destino '{target}' inexistente")
+        if handle: node.handles.setdefault(handle, target)
+        if not handle or handle in DEFAULT_SOURCE_HANDLES:
+            defaults = default_handles.setdefault(source, [])
+            if not defaults: node.default_target = target; node.default_handle = handle
+            defaults.append(handle)
+
+    for source, handles in default_handles.items():
+        if len(handles) > 1: problems.append(f"Múltiplas edges padrão para {source} (handles: {handles}). Usando a primeira.")
+    for node in nodes.values():
+        node.error_target = node.handles.get("source-error")
+        node.true_target = node.handles.get("source-true")
+        node.false_target = node.handles.get("source-false")
+        node.received_target = node.handles.get("source-received")
+        if node.type == "condition" and (node.true_target is None or node.false_target is None):
+            problems.append(f"Nó condition {node.id} sem edge 'source-true' e/ou 'source-false'")
+
+    start_node_id = None
+    if nodes_list:
+        explicit_start_node = next((n for n in nodes.values() if n.type == "startNode"), None)
+        if explicit_start_node: start_node_id = explicit_start_node.id; logger.info(f"Nó inicial explícito (startNode): ID={start_node_id}")
+        else:
+            possible_starts = [nid for nid in nodes if nid not in all_target_ids]
+            if possible_starts: start_node_id = possible_starts[0]; logger.info(f"Nó inicial inferido (sem incoming edges): ID={start_node_id}")
+            elif nodes: start_node_id = next(iter(nodes)); logger.warning(f"Nenhum nó inicial claro. Usando primeiro nó da lista: ID={start_node_id}")
+            else: logger.error("Lista de nós vazia ou mal formatada. Não foi possível determinar o nó inicial.")
+    else: logger.error("A lista de 'nodes' está vazia no fluxo.")
+
+    for problem in problems: logger.warning(f"Validação do fluxo {flow_id}: {problem}")
+    return CompiledFlow(flow_id, flow_name, nodes, start_node_id, edge_count, problems,
+                        version or elements_version(elements), source_updated_at)
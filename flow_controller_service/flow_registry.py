@@ -0,0 +1,131 @@
+# flow_controller_service/flow_registry.py
+# Registro em memória de fluxos compilados, por id: carga preguiçosa (primeira mensagem que
+# precisa do fluxo), cache LRU limitado com evicção e resolução campaign_id / flow_id de entrada -> fluxo ativo.
+# Permite que um único processo sirva vários fluxos ao mesmo tempo e que nós goToFlow
+# pulem de um fluxo para outro dentro da mesma requisição. Ao recarregar, a versão nova
+# substitui a anterior por troca de referência e as últimas versões ficam retidas para as
+# sessões que começaram nelas.
+import collections
+import logging
+import os
+import threading
+import time
+
+from flow_graph import CompiledFlow, diff_flows
+
+logger = logging.getLogger("flow_controller.flow_registry")
+
+
+def flow_key(flow_id) -> str | None:
+    # Ids vêm do MySQL como int e do editor/JSON como string: normaliza para string
+    return None if flow_id is None or flow_id == "" else str(flow_id)
+
+
+class FlowRegistry:
+    def __init__(self, loader, campaign_resolver=None, max_size: int = 32, negative_ttl: float = 30.0, alias_ttl: float = 60.0,
+                 versions_retained: int = 2, active_resolver=None):
+        # loader(flow_id) -> CompiledFlow | None (qualquer status) ; campaign_resolver(campaign_id) -> flow_id | None ;
+        # active_resolver(flow_id) -> flow_id | None (só se o fluxo estiver 'active')
+        self._loader = loader; self._campaign_resolver = campaign_resolver; self._active_resolver = active_resolver
+        self.max_size = max_size; self.negative_ttl = negative_ttl; self.alias_ttl = alias_ttl
+        self.versions_retained = versions_retained
+        self._flows = collections.OrderedDict()  # flow_key -> CompiledFlow (ordem = uso mais recente no fim)
+        self._old_versions = {}  # flow_key -> OrderedDict(versão -> CompiledFlow) das versões anteriores ainda retidas
+        self._missing = {}  # flow_key -> instante da última carga sem sucesso
+        self._campaigns = {}  # campaign_id -> (flow_key, resolvido_em)
+        self._active = {}  # flow_key pedido na entrada -> (flow_key se ativo, resolvido_em)
+        self._lock = threading.Lock(); self._load_locks = {}
+        self._hits = 0; self._misses = 0; self._evictions = 0
+
+    def _store(self, key: str, flow: CompiledFlow):
+        previous = self._flows.get(key)
+        if previous is not None and previous.version != flow.version and self.versions_retained > 0:
+            retained = self._old_versions.setdefault(key, collections.OrderedDict())
+            retained.pop(flow.version, None); retained[previous.version] = previous
+            while len(retained) > self.versions_retained: retained.popitem(last=False)
+        self._flows[key] = flow; self._flows.move_to_end(key); self._missing.pop(key, None)
+        while len(self._flows) > self.max_size:
+            evicted_key, _ = self._flows.popitem(last=False); self._evictions += 1; self._old_versions.pop(evicted_key, None)
+            logger.info(f"Registro de fluxos: fluxo {evicted_key} removido do cache (limite {self.max_size}).")
+
+    def put(self, flow: CompiledFlow) -> dict | None:
+        # Instala a versão nova; devolve o diff em relação à versão anterior (None se não havia ou é a mesma)
+        key = flow_key(flow.id)
+        if key is None: return None
+        with self._lock: previous = self._flows.get(key); self._store(key, flow)
+        if previous is None or previous.version == flow.version: return None
+        return diff_flows(previous, flow)
+
+    def refresh(self, flow_id) -> tuple[CompiledFlow | None, dict | None]:
+        # Recompila do DB sem tirar a versão atual de serviço: em falha, a anterior continua valendo
+        flow = self._loader(flow_id)
+        if flow is None or not flow.is_ready: return None, None
+        return flow, self.put(flow)
+
+    def evict(self, flow_id):
+        key = flow_key(flow_id)
+        with self._lock: self._flows.pop(key, None); self._missing.pop(key, None); self._old_versions.pop(key, None); self._active.pop(key, None)
+
+    def get_version(self, flow_id, version) -> CompiledFlow | None:
+        # Versão específica, se ainda retida em memória (sessões fixadas na versão em que começaram)
+        key = flow_key(flow_id)
+        with self._lock:
+            latest = self._flows.get(key)
+            if latest is not None and latest.version == version: return latest
+            return self._old_versions.get(key, {}).get(version)
+
+    def get(self, flow_id) -> CompiledFlow | None:
+        key = flow_key(flow_id)
+        if key is None: return None
+        with self._lock:
+            flow = self._flows.get(key)
+            if flow is not None: self._flows.move_to_end(key); self._hits += 1; return flow
+            failed_at = self._missing.get(key)
+            if failed_at is not None and time.monotonic() - failed_at < self.negative_ttl: return None
+            self._misses += 1
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:  # Uma única carga por fluxo mesmo com várias mensagens chegando juntas
+            with self._lock:
+                flow = self._flows.get(key)
+                if flow is not None: return flow
+            flow = self._loader(flow_id)
+            with self._lock:
+                if flow is not None and flow.is_ready: self._store(key, flow)
+                else: self._missing[key] = time.monotonic(); flow = None
+                self._load_locks.pop(key, None)
+        return flow
+
+    def _resolve_alias(self, aliases: dict, resolver, value) -> str | None:
+        with self._lock: cached = aliases.get(value)
+        if cached is not None and time.monotonic() - cached[1] < self.alias_ttl: return cached[0]
+        key = flow_key(resolver(value))
+        with self._lock: aliases[value] = (key, time.monotonic())
+        return key
+
+    def get_for_campaign(self, campaign_id) -> CompiledFlow | None:
+        if self._campaign_resolver is None or campaign_id in (None, ""): return None
+        key = self._resolve_alias(self._campaigns, self._campaign_resolver, campaign_id)
+        return self.get(key) if key is not None else None
+
+    def get_active(self, flow_id) -> CompiledFlow | None:
+        # Entrada por flow_id: rascunhos/inativos não são servidos (get() continua valendo para goToFlow e sessões já fixadas)
+        key = flow_key(flow_id)
+        if key is None: return None
+        if self._active_resolver is not None: key = self._resolve_alias(self._active, self._active_resolver, key)
+        return self.get(key) if key is not None else None
+
+    def cached_flows(self) -> list:
+        with self._lock: return list(self._flows.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"cached": len(self._flows), "max_size": self.max_size, "hits": self._hits, "misses": self._misses,
+                    "evictions": self._evictions, "versions": {key: flow.version for key, flow in self._flows.items()},
+                    "retained_old_versions": sum(len(v) for v in self._old_versions.values())}
+
+
+def create_registry_from_env(loader, campaign_resolver=None, active_resolver=None) -> FlowRegistry:
+    return FlowRegistry(loader, campaign_resolver, active_resolver=active_resolver, max_size=int(os.environ.get("FLOW_CACHE_SIZE", "32")),
+                        negative_ttl=float(os.environ.get("FLOW_NEGATIVE_CACHE_TTL", "30")),
+                        alias_ttl=float(os.environ.get("FLOW_CAMPAIGN_CACHE_TTL", "60")),
+                        versions_retained=int(os.environ.get("FLOW_VERSIONS_RETAINED", "2")))
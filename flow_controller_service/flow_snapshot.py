@@ -0,0 +1,123 @@
+# flow_controller_service/flow_snapshot.py
+# Snapshot em disco do último fluxo ativo compilado com sucesso (pickle do CompiledFlow), por id e versão.
+# Na subida o processo serve direto do snapshot, sem ida ao MySQL nem parse do JSON de 'elements',
+# e revalida contra o banco em background. O ponteiro active.json diz qual snapshot é o ativo.
+# Snapshots gravados por outra versão do código de compilação (SNAPSHOT_FORMAT) são ignorados.
+# Pickle executa código ao carregar: os snapshots só ligam com FLOW_SNAPSHOT_DIR e FLOW_SNAPSHOT_KEY definidos,
+# o diretório precisa ser do usuário do processo com modo 0700 e cada arquivo é assinado (HMAC-SHA256) antes do unpickle.
+import hashlib
+import hmac
+import json
+import logging
+import os
+import pickle
+import stat
+import tempfile
+import time
+
+from flow_graph import CompiledFlow
+from flow_registry import flow_key
+
+logger = logging.getLogger("flow_controller.flow_snapshot")
+
+_COMPILER_MODULES = ("flow_graph.py", "conditions.py", "text_templates.py")
+
+
+def _compiler_fingerprint() -> str:
+    digest = hashlib.sha1()
+    for name in _COMPILER_MODULES:
+        try:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as source: digest.update(source.read())
+        except OSError: digest.update(name.encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+SNAPSHOT_FORMAT = _compiler_fingerprint()
+_MAGIC = b"FLOWSNAP1"
+
+
+class FlowSnapshotStore:
+    def __init__(self, directory: str | None, key: bytes | None, versions_retained: int = 2):
+        # Sem diretório ou sem chave os snapshots ficam desligados
+        self.directory = (directory or None) if key else None; self._key = key; self.versions_retained = versions_retained
+
+    def _directory_trusted(self) -> bool:
+        # Diretório real (não symlink), do mesmo usuário do processo e sem acesso de grupo/outros
+        try: info = os.lstat(self.directory)
+        except FileNotFoundError: return False
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            logger.warning(f"Diretório de snapshots {self.directory} recusado: precisa ser do usuário {os.getuid()} com modo 0700 "
+                           f"(dono {info.st_uid}, modo {oct(stat.S_IMODE(info.st_mode))}). Snapshots ignorados."); return False
+        return True
+
+    def _sign(self, data: bytes) -> bytes:
+        return hmac.new(self._key, data, hashlib.sha256).digest()
+
+    def _path(self, flow_id, version: str) -> str:
+        return os.path.join(self.directory, f"flow-{flow_key(flow_id)}-{version}-{SNAPSHOT_FORMAT}.pkl")
+
+    def _write_atomic(self, path: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp: tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+
+    def save(self, flow: CompiledFlow) -> bool:
+        # Grava o fluxo (se a versão ainda não está em disco) e aponta active.json para ele
+        if not self.directory or not flow.is_ready: return False
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if not self._directory_trusted(): return False
+            path = self._path(flow.id, flow.version)
+            if not os.path.exists(path):
+                data = pickle.dumps(flow, protocol=pickle.HIGHEST_PROTOCOL); self._write_atomic(path, _MAGIC + self._sign(data) + data)
+            pointer = {"flow_id": flow.id, "version": flow.version, "format": SNAPSHOT_FORMAT, "saved_at": time.time()}
+            self._write_atomic(os.path.join(self.directory, "active.json"), json.dumps(pointer).encode("utf-8"))
+            self._prune(flow.id, path)
+            return True
+        except Exception as e:
+            logger.warning(f"Snapshot do fluxo {flow.id} (versão {flow.version}) não gravado em {self.directory}: {e}")
+            return False
+
+    def _prune(self, flow_id, keep_path: str):
+        prefix = f"flow-{flow_key(flow_id)}-"
+        paths = sorted((os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.startswith(prefix) and name.endswith(".pkl")),
+                       key=os.path.getmtime, reverse=True)
+        for path in [p for p in paths if p != keep_path][max(0, self.versions_retained - 1):]:
+            try: os.unlink(path)
+            except OSError: pass
+
+    def load(self, flow_id, version: str) -> CompiledFlow | None:
+        if not self.directory or not self._directory_trusted(): return None
+        path = self._path(flow_id, version)
+        try:
+            with open(path, "rb") as snapshot: raw = snapshot.read()
+        except FileNotFoundError: return None
+        except OSError as e: logger.warning(f"Snapshot {path} ilegível, ignorado: {e}"); return None
+        signature, data = raw[len(_MAGIC):len(_MAGIC) + 32], raw[len(_MAGIC) + 32:]
+        if not raw.startswith(_MAGIC) or not hmac.compare_digest(signature, self._sign(data)):
+            logger.warning(f"Snapshot {path} com assinatura inválida (outra FLOW_SNAPSHOT_KEY ou arquivo adulterado). Ignorado."); return None
+        try: flow = pickle.loads(data)
+        except Exception as e: logger.warning(f"Snapshot {path} ilegível, ignorado: {e}"); return None
+        return flow if isinstance(flow, CompiledFlow) and flow.is_ready else None
+
+    def load_active(self) -> CompiledFlow | None:
+        if not self.directory or not self._directory_trusted(): return None
+        try:
+            with open(os.path.join(self.directory, "active.json"), "rb") as pointer_file: pointer = json.loads(pointer_file.read())
+        except FileNotFoundError: return None
+        except Exception as e: logger.warning(f"Ponteiro de snapshot em {self.directory} ilegível: {e}"); return None
+        if pointer.get("format") != SNAPSHOT_FORMAT:
+            logger.info(f"Snapshot do fluxo {pointer.get('flow_id')} gerado por outra versão do compilador ({pointer.get('format')}). Ignorado."); return None
+        return self.load(pointer.get("flow_id"), pointer.get("version"))
+
+
+def create_snapshot_store_from_env() -> FlowSnapshotStore:
+    # Desligados por padrão: FLOW_SNAPSHOT_DIR (diretório privado do serviço) e FLOW_SNAPSHOT_KEY (segredo do HMAC) ligam
+    directory = os.environ.get("FLOW_SNAPSHOT_DIR"); key = os.environ.get("FLOW_SNAPSHOT_KEY")
+    if directory and not key: logger.warning("FLOW_SNAPSHOT_DIR definido sem FLOW_SNAPSHOT_KEY: snapshots do fluxo desligados.")
+    return FlowSnapshotStore(directory, key.encode("utf-8") if key else None, int(os.environ.get("FLOW_SNAPSHOT_VERSIONS", "2")))
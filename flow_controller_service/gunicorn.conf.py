@@ -0,0 +1,67 @@
+# flow_controller_service/gunicorn.conf.py
+# Lido automaticamente pelo gunicorn (./gunicorn.conf.py) ao rodar "gunicorn flow_controller:app".
+import multiprocessing
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+
+# Com o session store em memória cada worker teria suas próprias sessões (e seus próprios timers): a segunda mensagem
+# de um contato pode cair num worker que nunca o viu. Nesse caso o master sobe com 1 worker só, mesmo com WEB_CONCURRENCY/-w maior.
+# Com SESSION_STORE_BACKEND=redis|mysql as sessões são compartilhadas e dá para escalar por cores.
+# O mesmo vale para os resultados dos jobs assíncronos (ASYNC_RESULT_BACKEND, padrão = backend das sessões).
+_session_backend = os.environ.get("SESSION_STORE_BACKEND", "memory").lower()
+_local_state = [name for name, backend in (("SESSION_STORE_BACKEND", _session_backend), ("TIMER_STORE_BACKEND", (os.environ.get("TIMER_STORE_BACKEND") or _session_backend).lower()))
+                if backend == "memory"]
+_shared_results = (os.environ.get("ASYNC_RESULT_BACKEND") or _session_backend).lower() != "memory"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1 if not _local_state and _shared_results else 1))
+if _local_state and workers > 1:
+    print(f"[gunicorn.conf] {' e '.join(_local_state)}=memory: {workers} workers dividiriam sessões/timers entre processos. Subindo com 1 worker.", flush=True)
+    workers = 1
+elif workers > 1 and not _shared_results:
+    print(f"[gunicorn.conf] AVISO: {workers} workers com resultados assíncronos em memória: GET /result/<job_id> pode responder 404 em outro worker.", flush=True)
+
+# Esperas longas pela API de IA não podem prender o worker inteiro: por padrão cada worker atende
+# várias requisições em threads (gthread). Com GUNICORN_WORKER_CLASS=gevent (pacote gevent instalado)
+# o I/O vira cooperativo e um worker segura milhares de chamadas de IA em andamento.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+
+# O master importa o app uma vez e os workers herdam tudo por fork/copy-on-write. O master só instala o fluxo do snapshot em
+# disco (FLOW_SNAPSHOT_DIR/FLOW_SNAPSHOT_KEY); sem snapshot ele não toca no MySQL e cada worker carrega o fluxo no post_worker_init.
+# As threads de background (poller, sweeper, flusher de métricas, timers, checagem de DNS) sobem em cada worker:
+# o fork zera o estado por processo (process_local.after_fork) e post_worker_init sobe tudo de novo no worker.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+os.environ.setdefault("FLOW_BACKGROUND_START", "post_worker_init")
+
+# /metrics soma os snapshots de todos os workers gravados neste diretório (um arquivo por pid)
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "flow_controller_metrics"))
+
+
+def on_starting(server):
+    from metrics import create_registry_from_env
+    create_registry_from_env().reset_directory()
+    _force_single_worker(server)
+
+
+def nworkers_changed(server, new_value, old_value):
+    _force_single_worker(server)  # TTIN também não pode passar de 1 worker com estado em memória
+
+
+def _force_single_worker(server):
+    # -w na linha de comando sobrescreve o workers deste arquivo: a trava vale para o número efetivo do master
+    if _local_state and server.num_workers > 1:
+        server.log.error(f"{' e '.join(_local_state)}=memory: sessões/timers ficam em cada worker. Ignorando {server.num_workers} workers e rodando com 1.")
+        server.num_workers = 1
+
+
+def post_worker_init(worker):
+    import flow_controller
+    flow_controller.start_background_work()
+
+
+def child_exit(server, worker):
+    from metrics import create_registry_from_env
+    create_registry_from_env().remove_pid(worker.pid)
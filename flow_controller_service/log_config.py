@@ -0,0 +1,161 @@
+# flow_controller_service/log_config.py
+# Configuração de logging do serviço: formato texto (padrão) ou JSON (LOG_FORMAT=json), handlers
+# assíncronos via fila (LOG_ASYNC, o I/O de stdout sai da thread da requisição), amostragem por
+# requisição (LOG_SAMPLE_RATE vale para tudo abaixo de WARNING) e um único evento-resumo por
+# mensagem no lugar das linhas por hop. Segredos (apiKey, tokens, senhas) são mascarados.
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+from contextlib import contextmanager
+
+from process_local import ProcessOnce
+
+REDACTED = "***"
+SECRET_KEY_PATTERN = re.compile(r"api[_-]?key|token|secret|passw(or)?d|authorization", re.IGNORECASE)
+# Segredos embutidos em texto livre: "apiKey": "...", apiKey='...', Bearer ..., chaves estilo sk-...
+SECRET_TEXT_PATTERNS = (
+    re.compile(r"""(?P<key>["']?(?:api[_-]?key|token|secret|passw(?:or)?d)["']?\s*[:=]\s*)(?P<quote>["']?)[^"',}\s]+""", re.IGNORECASE),
+    re.compile(r"(?P<key>Bearer\s+)(?P<quote>)[A-Za-z0-9._~+/=-]+"),
+    re.compile(r"(?P<key>)(?P<quote>)\bsk-[A-Za-z0-9_-]{16,}"),
+)
+STANDARD_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "log_secrets"}
+
+_request = contextvars.ContextVar("flow_request_log", default=None)
+
+
+def redact(value, secret_values: frozenset = frozenset()):
+    # Mascara recursivamente chaves sensíveis e valores marcados como segredo (ex.: a variável apontada por apiKeyVariable)
+    if isinstance(value, dict):
+        return {k: (REDACTED if isinstance(k, str) and SECRET_KEY_PATTERN.search(k) else redact(v, secret_values)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return [redact(v, secret_values) for v in value]
+    if isinstance(value, str): return redact_text(value, secret_values)
+    return value
+
+
+def redact_text(text: str, secret_values: frozenset = frozenset()) -> str:
+    for secret in secret_values:
+        if secret and secret in text: text = text.replace(secret, REDACTED)
+    for pattern in SECRET_TEXT_PATTERNS: text = pattern.sub(lambda m: f"{m.group('key')}{m.group('quote')}{REDACTED}", text)
+    return text
+
+
+class RequestContext:
+    __slots__ = ("sampled", "fields", "secrets", "started")
+
+    def __init__(self, sampled: bool, fields: dict):
+        self.sampled = sampled; self.fields = fields; self.secrets = set(); self.started = time.perf_counter()
+
+
+@contextmanager
+def request_log_context(logger: logging.Logger, event: str, sample_rate: float | None = None, **fields):
+    # Abre o contexto de log de uma mensagem; ao sair emite um único evento-resumo com os campos acumulados
+    sample_rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    context = RequestContext(sample_rate >= 1 or random.random() < sample_rate, dict(fields))
+    token = _request.set(context)
+    try: yield context.fields
+    finally:
+        context.fields["duration_ms"] = round((time.perf_counter() - context.started) * 1000, 3)
+        if logger.isEnabledFor(logging.INFO): logger.info(event, extra={"event_fields": context.fields}, stacklevel=3)
+        _request.reset(token)
+
+
+def add_request_fields(**fields):
+    context = _request.get()
+    if context is not None: context.fields.update(fields)
+
+
+def mark_secret(value):
+    # Valor que nunca deve aparecer nos logs desta requisição (ex.: API key lida das variáveis do fluxo)
+    context = _request.get()
+    if context is not None and isinstance(value, str) and len(value) >= 4: context.secrets.add(value)
+
+
+class RequestFilter(logging.Filter):
+    # Roda na thread da requisição: amostragem (só abaixo de WARNING) e cópia dos segredos marcados para o RedactFilter
+    def filter(self, record):
+        context = _request.get()
+        if context is not None and not context.sampled and record.levelno < logging.WARNING: return False
+        if context is not None and context.secrets: record.log_secrets = frozenset(context.secrets)
+        return True
+
+
+class RedactFilter(logging.Filter):
+    # Roda junto da formatação (na thread do listener com LOG_ASYNC): mascara segredos no texto final e nos campos do evento
+    def filter(self, record):
+        secrets = getattr(record, "log_secrets", frozenset())
+        message = record.getMessage(); redacted = redact_text(message, secrets)
+        if redacted != message: record.msg = redacted; record.args = None
+        fields = getattr(record, "event_fields", None)
+        if fields is not None: record.event_fields = redact(fields, secrets)
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "event_fields", None)
+        if fields: text += " | " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}", "level": record.levelname,
+                 "logger": record.name, "msg": record.getMessage(), "module": record.module, "func": record.funcName, "line": record.lineno,
+                 "pid": record.process, "thread": record.threadName}
+        fields = getattr(record, "event_fields", None)
+        if fields: entry.update(fields)
+        extra = {k: v for k, v in vars(record).items() if k not in STANDARD_RECORD_FIELDS and k != "event_fields"}
+        if extra: entry.update(redact(extra))
+        if record.exc_info: entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ProcessQueueHandler(logging.handlers.QueueHandler):
+    # A thread do QueueListener não sobrevive a fork: sobe (de novo) no primeiro log de cada processo
+    def __init__(self, target_handler: logging.Handler, max_queued: int = 10000):
+        super().__init__(queue.Queue(max_queued)); self.target_handler = target_handler
+        self._listener = None; self._listener_started = ProcessOnce(); self.dropped = 0
+
+    def _start_listener(self):
+        self.queue = queue.Queue(self.queue.maxsize)
+        self._listener = logging.handlers.QueueListener(self.queue, self.target_handler, respect_handler_level=True)
+        self._listener.start()
+
+    def prepare(self, record):
+        # O registro vai cru para a fila: formatação e mascaramento ficam na thread do listener, fora da requisição.
+        # Os args são formatados lá, então não passe objetos que a requisição ainda vai alterar.
+        return record
+
+    def enqueue(self, record):
+        try: self.queue.put_nowait(record)
+        except queue.Full: self.dropped += 1  # Sob rajada, perder log é melhor que travar a requisição
+
+    def emit(self, record):
+        self._listener_started.run(self._start_listener); super().emit(record)
+
+    def stop(self):
+        if self._listener is not None and self._listener_started.done: self._listener.stop(); self._listener = None
+
+
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+
+
+def configure_logging(logger: logging.Logger, text_format: str) -> logging.Handler | None:
+    # LOG_FORMAT=text|json, LOG_ASYNC=true|false, LOG_LEVEL. Retorna o handler instalado (None se já havia um).
+    logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    if logger.hasHandlers(): return None
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if os.environ.get("LOG_FORMAT", "text").lower() == "json" else TextFormatter(text_format))
+    handler = ProcessQueueHandler(stream_handler, int(os.environ.get("LOG_QUEUE_SIZE", "10000"))) if os.environ.get("LOG_ASYNC", "true").lower() == "true" else stream_handler
+    handler.addFilter(RequestFilter()); stream_handler.addFilter(RedactFilter())  # Nesta ordem quando os dois são o mesmo handler (LOG_ASYNC=false)
+    logger.addHandler(handler)
+    if isinstance(handler, ProcessQueueHandler): atexit.register(handler.stop)  # Esvazia a fila ao encerrar
+    return handler
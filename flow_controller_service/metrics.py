@@ -0,0 +1,268 @@
+# flow_controller_service/metrics.py
+# Métricas em memória (contadores, gauges e histogramas) exportadas no formato texto do Prometheus
+# em /metrics, sem dependência externa. Com vários workers do gunicorn, cada processo grava um
+# snapshot em METRICS_DIR (metrics_<pid>.json) e o scrape soma os snapshots de todos. Também traz
+# o perfilador por amostragem (PROFILE_SAMPLE_RATE) para uma fração das requisições.
+import bisect
+import cProfile
+import functools
+import glob
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import ContextDecorator
+
+from process_local import ProcessOnce
+
+logger = logging.getLogger("flow_controller.metrics")
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels: dict):
+        self._histogram = histogram; self._labels = labels
+
+    def _recreate_cm(self):
+        # Como decorator, cada chamada precisa do seu próprio instante inicial (chamadas concorrentes em threads)
+        return _Timer(self._histogram, self._labels)
+
+    def __enter__(self):
+        self._started = time.perf_counter(); return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels); return False
+
+
+class _Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name; self.documentation = documentation; self.labelnames = tuple(labelnames)
+        self._values = {}  # tupla de valores de label -> valor
+        self._lock = threading.Lock(); self._function = None
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def set_function(self, function):
+        # Valor (sem labels) lido na hora do snapshot; None = sem amostra
+        self._function = function
+
+    def samples(self) -> dict:
+        if self._function is not None:
+            try: value = self._function()
+            except Exception as e: logger.debug(f"Métrica {self.name}: falha ao ler valor: {e}"); value = None
+            if value is not None:
+                with self._lock: self._values[()] = value
+        with self._lock: return {json.dumps(key): value if not isinstance(value, list) else list(value) for key, value in self._values.items()}
+
+
+class Counter(_Metric):
+    # Com set_function espelha um total monotônico mantido fora do registro (ex.: sessões expiradas do session store)
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), multiprocess_mode: str = "sum"):
+        # multiprocess_mode: "sum" (ex.: sessões em memória de cada worker) ou "max" (ex.: tamanho do fluxo carregado)
+        super().__init__(name, documentation, labelnames); self.multiprocess_mode = multiprocess_mode
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock: self._values[key] = value
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames); self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels); index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None: counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]  # buckets não cumulativos, +Inf, soma
+            counts[index] += 1; counts[-1] += value
+
+    def time(self, **labels) -> _Timer:
+        # Context manager e decorator
+        return _Timer(self, labels)
+
+
+class MetricsRegistry:
+    def __init__(self, directory: str | None = None, flush_interval: float = 5.0):
+        self.directory = directory; self.flush_interval = flush_interval
+        self._metrics = {}; self._lock = threading.Lock(); self._flusher = ProcessOnce()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None: return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), multiprocess_mode="sum") -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, multiprocess_mode))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> dict:
+        with self._lock: metrics = list(self._metrics.values())
+        return {metric.name: {"type": metric.metric_type, "help": metric.documentation, "labels": list(metric.labelnames),
+                              "buckets": list(getattr(metric, "buckets", ())), "mode": getattr(metric, "multiprocess_mode", None),
+                              "samples": metric.samples()} for metric in metrics}
+
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"metrics_{pid}.json")
+
+    def flush(self):
+        # Grava o snapshot deste processo (arquivo temporário + rename: o scrape nunca lê arquivo pela metade)
+        if not self.directory: return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._snapshot_path(os.getpid()); tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f: json.dump({"pid": os.getpid(), "metrics": self.snapshot()}, f)
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try: self.flush()
+            except Exception as e: logger.warning(f"Métricas: falha ao gravar snapshot: {e}")
+
+    def start_flusher(self):
+        # Uma thread por processo (threads não sobrevivem a fork)
+        if not self.directory or self.flush_interval <= 0: return
+        self._flusher.run(lambda: threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True).start())
+
+    def _collect_all(self) -> list:
+        if not self.directory: return [(os.getpid(), True, self.snapshot())]
+        self.flush(); collected = []
+        for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+            try:
+                with open(path) as f: data = json.load(f)
+            except (OSError, ValueError): continue
+            collected.append((data["pid"], _pid_alive(data["pid"]), data["metrics"]))
+        return collected
+
+    def render(self) -> str:
+        merged = {}
+        for _, alive, metrics in self._collect_all():
+            for name, metric in metrics.items():
+                # Contadores/histogramas de workers mortos cujo arquivo ainda não foi removido (child_exit) continuam somando; gauges deles não
+                if metric["type"] == "gauge" and not alive: continue
+                target = merged.setdefault(name, dict(metric, samples={}))
+                for key, value in metric["samples"].items():
+                    current = target["samples"].get(key)
+                    if current is None: target["samples"][key] = value
+                    elif metric["type"] == "histogram": target["samples"][key] = [a + b for a, b in zip(current, value)]
+                    elif metric["type"] == "gauge" and metric["mode"] == "max": target["samples"][key] = max(current, value)
+                    else: target["samples"][key] = current + value
+        lines = []
+        for name in sorted(merged):
+            metric = merged[name]; labelnames = metric["labels"]
+            lines.append(f"# HELP {name} {metric['help']}"); lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(metric["samples"].items()):
+                labels = list(zip(labelnames, json.loads(key)))
+                if metric["type"] != "histogram": lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}"); continue
+                cumulative = 0
+                for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + [('le', bound if bound == '+Inf' else _format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def remove_pid(self, pid: int):
+        # Chamado no master do gunicorn quando um worker sai: o snapshot dele não fica somando (nem é herdado por um pid reciclado)
+        if not self.directory: return
+        for path in (self._snapshot_path(pid), f"{self._snapshot_path(pid)}.tmp"):
+            try: os.remove(path)
+            except OSError: pass
+
+    def reset_directory(self):
+        # Chamado no master do gunicorn ao subir: descarta snapshots de execuções anteriores
+        if not self.directory: return
+        for path in glob.glob(os.path.join(self.directory, "metrics_*.json*")):
+            try: os.remove(path)
+            except OSError: pass
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid(): return True
+    try: os.kill(pid, 0); return True
+    except ProcessLookupError: return False
+    except PermissionError: return True
+
+
+def _format_labels(labels: list) -> str:
+    if not labels: return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels) + "}"
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestProfiler:
+    # cProfile em uma fração das requisições; cada amostra vira um arquivo .prof (abrir com pstats/snakeviz)
+    def __init__(self, sample_rate: float = 0.0, directory: str | None = None, max_files: int = 200):
+        self.sample_rate = sample_rate; self.max_files = max_files
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "flow_controller_profiles")
+
+    def start(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate: return None
+        profile = cProfile.Profile()
+        try: profile.enable()
+        except ValueError: return None  # Outro perfilador ativo nesta thread
+        return profile
+
+    def profiled(self, label: str):
+        # Decorator: perfila uma amostra das chamadas da função
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                profile = self.start()
+                try: return fn(*args, **kwargs)
+                finally: self.finish(profile, label)
+            return wrapper
+        return decorator
+
+    def finish(self, profile, label: str):
+        if profile is None: return
+        profile.disable()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            existing = sorted(glob.glob(os.path.join(self.directory, "*.prof")))
+            for old_path in existing[:max(0, len(existing) - self.max_files + 1)]: os.remove(old_path)
+            path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{label}.prof")
+            profile.dump_stats(path); logger.debug(f"Perfil da requisição salvo em {path}")
+        except OSError as e: logger.warning(f"Perfilador: falha ao salvar perfil: {e}")
+
+
+def create_registry_from_env() -> MetricsRegistry:
+    return MetricsRegistry(os.environ.get("METRICS_DIR") or None, float(os.environ.get("METRICS_FLUSH_INTERVAL", "5")))
+
+
+def create_profiler_from_env() -> RequestProfiler:
+    return RequestProfiler(float(os.environ.get("PROFILE_SAMPLE_RATE", "0")), os.environ.get("PROFILE_DIR") or None,
+                           int(os.environ.get("PROFILE_MAX_FILES", "200")))
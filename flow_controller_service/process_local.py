@@ -0,0 +1,49 @@
+# flow_controller_service/process_local.py
+# Estado que não atravessa fork (threads, locks, sessões HTTP): com preload_app o master do gunicorn importa
+# tudo e os workers herdam por fork. after_fork registra quem precisa se refazer no filho (os.register_at_fork)
+# e ProcessOnce roda uma inicialização (ex.: subir as threads de background) uma única vez por processo.
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger("flow_controller.process_local")
+
+_after_fork = []  # referências para callables sem argumentos; métodos ficam em WeakMethod e não prendem o objeto
+
+
+def after_fork(callback):
+    # Roda no processo filho logo após o fork, antes de qualquer requisição
+    _after_fork.append(weakref.WeakMethod(callback) if hasattr(callback, "__self__") else (lambda: callback))
+    return callback
+
+
+def _run_after_fork():
+    alive = []
+    for reference in _after_fork:
+        callback = reference()
+        if callback is None: continue
+        alive.append(reference)
+        try: callback()
+        except Exception as e: logger.error(f"Reinicialização pós-fork falhou ({callback}): {e}", exc_info=True)
+    _after_fork[:] = alive
+
+
+if hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=_run_after_fork)
+
+
+class ProcessOnce:
+    # fn roda uma vez por processo; chamadas concorrentes esperam a primeira terminar. O fork zera o estado no filho.
+    def __init__(self):
+        self.done = False; self._lock = threading.Lock()
+        after_fork(self._reset)
+
+    def _reset(self):
+        self.done = False; self._lock = threading.Lock()  # O lock pode ter sido herdado travado por outra thread do pai
+
+    def run(self, fn) -> bool:
+        if self.done: return False
+        with self._lock:
+            if self.done: return False
+            fn(); self.done = True
+        return True
@@ -0,0 +1,341 @@
+# flow_controller_service/session_store.py
+# Armazenamento das sessões de conversa (current_node_id, variables, history).
+# Toda sessão tem um número de versão: load() devolve (sessão, versão) e save()/delete()
+# só têm efeito se a versão ainda for a esperada (lock otimista por sender). Assim várias
+# threads, workers do gunicorn ou réplicas podem compartilhar o mesmo backend sem que duas
+# mensagens simultâneas do mesmo sender se sobrescrevam.
+# Memória limitada: histórico em buffer circular (SESSION_HISTORY_MAX), expiração por inatividade
+# (SESSION_IDLE_TTL, com varredura em background) e, em memória, teto de sessões com evicção LRU.
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from process_local import ProcessOnce
+
+logger = logging.getLogger("flow_controller.session_store")
+
+
+def trim_history(session: dict, history_max: int) -> dict:
+    # Só as últimas history_max entradas são persistidas (o engine acrescenta pelo menos uma por hop)
+    history = session.get("history")
+    if history and len(history) > history_max: session = dict(session); session["history"] = history[-history_max:] if history_max > 0 else []
+    return session
+
+
+# Formas de entrada de histórico que o engine grava; em memória viram tuplas (tipo, nó, trigger)
+HISTORY_SHAPES = (("transitioned_to_node", "via_trigger"), ("node_before_input", "trigger_received"))
+
+
+def _pack_history_entry(entry):
+    if isinstance(entry, dict) and len(entry) == 2:
+        for kind, (node_key, trigger_key) in enumerate(HISTORY_SHAPES):
+            if node_key in entry and trigger_key in entry: return (kind, entry[node_key], entry[trigger_key])
+    return entry
+
+
+def _unpack_history_entry(entry):
+    if isinstance(entry, tuple):
+        node_key, trigger_key = HISTORY_SHAPES[entry[0]]
+        return {node_key: entry[1], trigger_key: entry[2]}
+    return entry
+
+
+class Session:
+    # Representação compacta de uma sessão residente em memória; o engine sempre recebe um dict novo (to_dict)
+    __slots__ = ("flow_id", "flow_version", "current_node_id", "variables", "history", "extra", "last_seen")
+
+    def __init__(self, session: dict, history_max: int):
+        session = dict(session)
+        self.flow_id = session.pop("flow_id", None); self.flow_version = session.pop("flow_version", None)
+        self.current_node_id = session.pop("current_node_id", None); self.variables = dict(session.pop("variables", None) or {})
+        history = session.pop("history", None) or ()
+        self.history = tuple(_pack_history_entry(entry) for entry in (history[-history_max:] if history_max > 0 else ()))
+        self.extra = session or None; self.last_seen = time.monotonic()
+
+    def to_dict(self) -> dict:
+        session = {"flow_id": self.flow_id, "current_node_id": self.current_node_id, "variables": dict(self.variables),
+                   "history": [_unpack_history_entry(entry) for entry in self.history]}
+        if self.flow_version is not None: session["flow_version"] = self.flow_version
+        if self.extra: session.update(self.extra)
+        return session
+
+
+class SessionStore:
+    backend_name = "abstract"
+    idle_ttl = 0.0; history_max = 50
+    expired = 0; evicted = 0
+
+    def load(self, sender_id: str) -> tuple[dict | None, int]:
+        # Retorna (sessão, versão). Sessão inexistente => (None, 0)
+        raise NotImplementedError
+
+    def save(self, sender_id: str, session: dict, expected_version: int) -> bool:
+        # Grava somente se a versão atual for expected_version (0 = sessão ainda não existe)
+        raise NotImplementedError
+
+    def delete(self, sender_id: str, expected_version: int | None = None) -> bool:
+        raise NotImplementedError
+
+    def clear(self) -> int:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        # Remove sessões inativas há mais de idle_ttl; backends com expiração nativa não precisam
+        return 0
+
+    def stats(self) -> dict:
+        return {"backend": self.backend_name, "idle_ttl": self.idle_ttl, "history_max": self.history_max,
+                "expired": self.expired, "evicted": self.evicted}
+
+
+class InMemorySessionStore(SessionStore):
+    backend_name = "memory"
+
+    def __init__(self, idle_ttl: float = 0.0, max_entries: int = 0, history_max: int = 50):
+        # idle_ttl/max_entries = 0 desligam expiração/teto
+        self.idle_ttl = idle_ttl; self.max_entries = max_entries; self.history_max = history_max
+        self._sessions = collections.OrderedDict()  # sender_id -> (versão, Session); ordem = uso mais recente no fim
+        self._lock = threading.Lock()
+        self.expired = 0; self.evicted = 0
+
+    def _is_expired(self, stored: Session, now: float) -> bool:
+        return self.idle_ttl > 0 and now - stored.last_seen > self.idle_ttl
+
+    def load(self, sender_id):
+        with self._lock:
+            entry = self._sessions.get(sender_id)
+            if entry is None: return None, 0
+            if self._is_expired(entry[1], time.monotonic()):
+                self.expired += 1; del self._sessions[sender_id]; return None, 0  # Expirada: a conversa recomeça do início
+            self._sessions.move_to_end(sender_id)
+        return entry[1].to_dict(), entry[0]
+
+    def save(self, sender_id, session, expected_version):
+        stored = Session(session, self.history_max)
+        with self._lock:
+            current_version = self._sessions.get(sender_id, (0, None))[0]
+            if current_version != expected_version: return False
+            self._sessions[sender_id] = (current_version + 1, stored); self._sessions.move_to_end(sender_id)
+            while self.max_entries > 0 and len(self._sessions) > self.max_entries:
+                evicted_sender, _ = self._sessions.popitem(last=False); self.evicted += 1
+                logger.debug(f"Sessão {evicted_sender} removida pelo limite de {self.max_entries} sessões em memória (LRU).")
+            return True
+
+    def delete(self, sender_id, expected_version=None):
+        with self._lock:
+            entry = self._sessions.get(sender_id)
+            if entry is None: return expected_version in (None, 0)
+            if expected_version is not None and entry[0] != expected_version: return False
+            del self._sessions[sender_id]
+            return True
+
+    def clear(self):
+        with self._lock: removed = len(self._sessions); self._sessions.clear()
+        return removed
+
+    def count(self):
+        return len(self._sessions)
+
+    def sweep(self):
+        if self.idle_ttl <= 0: return 0
+        now = time.monotonic(); removed = 0
+        with self._lock:
+            # Menos recentes no início: para na primeira sessão ainda dentro do TTL
+            while self._sessions:
+                sender_id, (_, stored) = next(iter(self._sessions.items()))
+                if not self._is_expired(stored, now): break
+                del self._sessions[sender_id]; removed += 1
+            self.expired += removed
+        return removed
+
+    def stats(self):
+        stats = super().stats(); stats.update({"live": len(self._sessions), "max_entries": self.max_entries})
+        return stats
+
+
+class RedisSessionStore(SessionStore):
+    # Funciona com qualquer cliente compatível com redis-py (inclusive stand-ins locais como fakeredis)
+    backend_name = "redis"
+
+    def __init__(self, client, key_prefix: str = "flow_session:", idle_ttl: float = 0.0, history_max: int = 50):
+        # Expiração nativa (SET EX, renovado a cada save); evicção fica com a política maxmemory do Redis
+        from redis.exceptions import WatchError
+        self._client = client; self._prefix = key_prefix; self._watch_error = WatchError
+        self.idle_ttl = idle_ttl; self.history_max = history_max
+
+    def _key(self, sender_id):
+        return f"{self._prefix}{sender_id}"
+
+    def load(self, sender_id):
+        raw = self._client.get(self._key(sender_id))
+        if raw is None: return None, 0
+        stored = json.loads(raw)
+        return stored["session"], stored["version"]
+
+    def _compare_and_set(self, sender_id, expected_version, new_value: str | None) -> bool:
+        key = self._key(sender_id)
+        with self._client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                raw = pipe.get(key)
+                current_version = json.loads(raw)["version"] if raw is not None else 0
+                if expected_version is not None and current_version != expected_version: return False
+                pipe.multi()
+                if new_value is None: pipe.delete(key)
+                else: pipe.set(key, new_value, ex=int(self.idle_ttl) if self.idle_ttl > 0 else None)
+                pipe.execute()
+                return True
+            except self._watch_error:
+                return False
+
+    def save(self, sender_id, session, expected_version):
+        value = json.dumps({"version": expected_version + 1, "session": trim_history(session, self.history_max)}, default=str)
+        return self._compare_and_set(sender_id, expected_version, value)
+
+    def delete(self, sender_id, expected_version=None):
+        return self._compare_and_set(sender_id, expected_version, None)
+
+    def clear(self):
+        removed = 0
+        for key in self._client.scan_iter(match=f"{self._prefix}*"): removed += self._client.delete(key)
+        return removed
+
+    def count(self):
+        return sum(1 for _ in self._client.scan_iter(match=f"{self._prefix}*"))
+
+
+class MySQLSessionStore(SessionStore):
+    # connection_factory: context manager que entrega uma conexão mysql.connector aberta
+    backend_name = "mysql"
+
+    def __init__(self, connection_factory, table: str = "flow_sessions", idle_ttl: float = 0.0, history_max: int = 50):
+        self._connection = connection_factory; self._table = table
+        self.idle_ttl = idle_ttl; self.history_max = history_max; self.expired = 0
+        self._table_ready = False  # DDL no primeiro uso: importar o serviço com o MySQL fora do ar não derruba a subida
+
+    def ensure_table(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self._table} (
+                    sender_id VARCHAR(191) NOT NULL PRIMARY KEY,
+                    state LONGTEXT NOT NULL,
+                    version BIGINT NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    KEY idx_updated_at (updated_at)
+                ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci""")
+                conn.commit()
+            finally: cursor.close()
+        self._table_ready = True
+
+    def _execute(self, query: str, params: tuple = (), fetch: bool = False):
+        if not self._table_ready: self.ensure_table()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params)
+                result = cursor.fetchone() if fetch else cursor.rowcount
+                conn.commit()  # Também após SELECT: não deixa snapshot REPEATABLE READ aberto na conexão
+                return result
+            finally: cursor.close()
+
+    def load(self, sender_id):
+        row = self._execute(f"SELECT state, version, TIMESTAMPDIFF(SECOND, updated_at, NOW()) FROM {self._table} WHERE sender_id = %s", (sender_id,), fetch=True)
+        if not row: return None, 0
+        # Expirada mas ainda não varrida: a conversa recomeça; a versão da linha segue valendo para o CAS do save
+        if self.idle_ttl > 0 and row[2] is not None and row[2] > self.idle_ttl: return None, int(row[1])
+        state = row[0].decode("utf-8") if isinstance(row[0], (bytes, bytearray)) else row[0]
+        return json.loads(state), int(row[1])
+
+    def save(self, sender_id, session, expected_version):
+        state = json.dumps(trim_history(session, self.history_max), default=str)
+        if expected_version == 0:
+            return self._execute(f"INSERT IGNORE INTO {self._table} (sender_id, state, version) VALUES (%s, %s, 1)", (sender_id, state)) == 1
+        return self._execute(f"UPDATE {self._table} SET state = %s, version = version + 1 WHERE sender_id = %s AND version = %s",
+                             (state, sender_id, expected_version)) == 1
+
+    def delete(self, sender_id, expected_version=None):
+        if expected_version is None:
+            self._execute(f"DELETE FROM {self._table} WHERE sender_id = %s", (sender_id,)); return True
+        if expected_version == 0: return self.load(sender_id)[0] is None
+        return self._execute(f"DELETE FROM {self._table} WHERE sender_id = %s AND version = %s", (sender_id, expected_version)) == 1
+
+    def clear(self):
+        return self._execute(f"DELETE FROM {self._table}")
+
+    def count(self):
+        row = self._execute(f"SELECT COUNT(*) FROM {self._table}", fetch=True)
+        return int(row[0]) if row else 0
+
+    def sweep(self):
+        if self.idle_ttl <= 0: return 0
+        removed = self._execute(f"DELETE FROM {self._table} WHERE updated_at < NOW() - INTERVAL %s SECOND", (int(self.idle_ttl),))
+        self.expired += removed
+        return removed
+
+
+class SessionLocks:
+    # Um lock por chave de sessão: mensagens do mesmo contato não correm em paralelo neste processo, então o CAS só
+    # reprocessa (e refaz chamadas de IA) em conflito entre processos/réplicas. Contatos diferentes nunca esperam um
+    # pelo outro, nem durante uma chamada de IA lenta. O lock sai do dicionário quando ninguém mais o usa.
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # session_key -> [lock, quantidade de threads usando ou esperando]
+
+    @contextlib.contextmanager
+    def hold(self, session_key: str):
+        with self._guard:
+            entry = self._locks.get(session_key)
+            if entry is None: entry = self._locks[session_key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]: yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0: del self._locks[session_key]
+
+    def __len__(self) -> int:
+        with self._guard: return len(self._locks)
+
+
+_sweeper = ProcessOnce()
+
+
+def _sweeper_loop(store: SessionStore, interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            removed = store.sweep()
+            if removed: logger.info(f"Varredura de sessões: {removed} sessões inativas removidas ({store.backend_name}).")
+        except Exception as e: logger.warning(f"Varredura de sessões falhou ({store.backend_name}): {e}")
+
+
+def start_session_sweeper(store: SessionStore, interval: float | None = None):
+    # Uma thread por processo (threads não sobrevivem a fork); SESSION_SWEEP_INTERVAL=0 desliga
+    interval = float(os.environ.get("SESSION_SWEEP_INTERVAL", "60")) if interval is None else interval
+    if interval <= 0 or store.idle_ttl <= 0: return
+    _sweeper.run(lambda: threading.Thread(target=_sweeper_loop, args=(store, interval), name="session-sweeper", daemon=True).start())
+
+
+def create_session_store(backend: str | None = None, mysql_connection_factory=None) -> SessionStore:
+    backend = (backend or os.environ.get("SESSION_STORE_BACKEND", "memory")).lower()
+    idle_ttl = float(os.environ.get("SESSION_IDLE_TTL", "86400")); history_max = int(os.environ.get("SESSION_HISTORY_MAX", "50"))
+    if backend == "memory":
+        return InMemorySessionStore(idle_ttl, int(os.environ.get("SESSION_MAX_ENTRIES", "100000")), history_max)
+    if backend == "redis":
+        try: import redis
+        except ImportError as e: raise RuntimeError("SESSION_STORE_BACKEND=redis requer o pacote 'redis' instalado.") from e
+        redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+        return RedisSessionStore(redis.Redis.from_url(redis_url), os.environ.get("SESSION_KEY_PREFIX", "flow_session:"), idle_ttl, history_max)
+    if backend == "mysql":
+        if mysql_connection_factory is None: raise RuntimeError("SESSION_STORE_BACKEND=mysql requer uma fábrica de conexões MySQL.")
+        return MySQLSessionStore(mysql_connection_factory, os.environ.get("SESSION_TABLE", "flow_sessions"), idle_ttl, history_max)
+    raise ValueError(f"SESSION_STORE_BACKEND desconhecido: '{backend}' (use memory, redis ou mysql).")
@@ -0,0 +1,46 @@
+# flow_controller_service/tests/conftest.py
+# flow_controller importado uma única vez contra a tabela flows em memória do harness de carga
+# (sem MySQL nem API de IA reais); threads de background desligadas, os testes dirigem tudo.
+import os
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR); sys.path.insert(0, os.path.join(SERVICE_DIR, "bench"))
+for name, value in (("FLOW_POLL_INTERVAL", "0"), ("FLOW_SNAPSHOT_DIR", ""), ("TIMER_POLL_INTERVAL", "0"), ("SESSION_SWEEP_INTERVAL", "0"),
+                    ("METRICS_DIR", ""), ("LOG_LEVEL", "WARNING"), ("LOG_ASYNC", "false"), ("V50MCP_AI_QUERY_API_URL", "http://ia.teste/api/ai/query")):
+    os.environ.setdefault(name, value)
+
+from load_harness import FlowsTable, install_fake_mysql  # noqa: E402
+
+flows_table = FlowsTable()
+install_fake_mysql(flows_table)
+
+
+@pytest.fixture(scope="session")
+def fc():
+    import flow_controller
+    return flow_controller
+
+
+@pytest.fixture
+def install_flow(fc):
+    from flow_graph import compile_flow
+    def install(elements: dict, flow_id=1):
+        flow = compile_flow(flow_id, "Fluxo de teste", elements); fc.flow_registry.put(flow); fc.current_flow = flow
+        return flow
+    return install
+
+
+def _chain(*nodes, edges=()) -> dict:
+    # Fluxo linear: cada nó liga no seguinte pela edge padrão, mais as edges extras (source, target, handle)
+    elements = {"nodes": [{"id": node_id, "type": node_type, "data": data} for node_id, node_type, data in nodes], "edges": []}
+    for (source, *_), (target, *_) in zip(nodes, nodes[1:]): elements["edges"].append({"source": source, "target": target})
+    for source, target, handle in edges: elements["edges"].append({"source": source, "target": target, "sourceHandle": handle})
+    return elements
+
+
+@pytest.fixture
+def chain():
+    return _chain
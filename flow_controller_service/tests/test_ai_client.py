@@ -0,0 +1,118 @@
+# flow_controller_service/tests/test_ai_client.py
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from ai_client import AIQueryClient, AIResponseCache, AIUpstreamUnavailable, CircuitBreaker
+
+
+def _response(status: int, body=b'{"success": true, "response": "ok"}') -> requests.Response:
+    response = requests.Response(); response.status_code = status; response._content = body if isinstance(body, bytes) else json.dumps(body).encode()
+    return response
+
+
+class FakeSession:
+    def __init__(self, *statuses):
+        self.responses = [status if isinstance(status, requests.Response) else _response(status) for status in statuses]; self.calls = 0
+
+    def post(self, url, json=None, timeout=None):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def _client(session, **kwargs) -> AIQueryClient:
+    client = AIQueryClient(max_retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.01), **kwargs)
+    client._get_session = lambda: session
+    return client
+
+
+def _open_breaker(client):
+    with pytest.raises(requests.exceptions.HTTPError): client.query("http://ia", {})
+    assert client.breaker.state in ("open", "half_open")
+    time.sleep(0.02)
+
+
+def test_half_open_probe_with_4xx_closes_breaker():
+    session = FakeSession(503, 400, 200); client = _client(session)
+    _open_breaker(client)
+    with pytest.raises(requests.exceptions.HTTPError): client.query("http://ia", {})  # 4xx: upstream respondeu
+    assert client.breaker.state == "closed"
+    assert client.query("http://ia", {}) == {"success": True, "response": "ok"}
+    assert session.calls == 3
+
+
+def test_half_open_probe_with_invalid_json_does_not_wedge_breaker():
+    session = FakeSession(503, _response(200, b"<html>"), 200); client = _client(session)
+    _open_breaker(client)
+    with pytest.raises(ValueError): client.query("http://ia", {})
+    assert client.query("http://ia", {})["response"] == "ok"
+
+
+def test_half_open_probe_without_semaphore_slot_releases_probe():
+    session = FakeSession(503, 200); client = _client(session, max_concurrency=1, queue_timeout=0.01)
+    _open_breaker(client)
+    client._slots.acquire()  # Vaga ocupada: a chamada de teste desiste antes de chegar ao upstream
+    with pytest.raises(AIUpstreamUnavailable): client.query("http://ia", {})
+    client._slots.release()
+    assert client.query("http://ia", {})["response"] == "ok"
+
+
+def test_only_one_probe_in_half_open():
+    release = threading.Event(); session = FakeSession(503, 200)
+    original_post = session.post
+    def slow_post(*args, **kwargs):
+        if session.calls >= 1: release.wait(1)
+        return original_post(*args, **kwargs)
+    session.post = slow_post; client = _client(session)
+    _open_breaker(client)
+    probe = threading.Thread(target=client.query, args=("http://ia", {})); probe.start()
+    time.sleep(0.02)
+    with pytest.raises(AIUpstreamUnavailable): client.query("http://ia", {})
+    release.set(); probe.join()
+    assert client.breaker.state == "closed"
+
+
+OK = {"success": True, "response": "ok"}
+
+
+def test_cache_entry_expires_after_its_ttl():
+    cache = AIResponseCache(default_ttl=60); calls = []
+    fetch = lambda: calls.append(1) or dict(OK)
+    assert cache.get_or_query("k", 0.05, fetch)[1] == "miss"
+    assert cache.get_or_query("k", 0.05, fetch)[1] == "hit"
+    time.sleep(0.08)
+    assert cache.get_or_query("k", 0.05, fetch)[1] == "miss"
+    assert len(calls) == 2 and cache.stats()["expired"] == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = AIResponseCache(max_entries=2)
+    for key in ("a", "b"): cache.get_or_query(key, None, lambda: dict(OK))
+    cache.get_or_query("a", None, lambda: pytest.fail("a deveria estar em cache"))  # "a" passa a ser o mais recente
+    cache.get_or_query("c", None, lambda: dict(OK))
+    assert cache.get_or_query("a", None, lambda: pytest.fail("a foi removido"))[1] == "hit"
+    assert cache.get_or_query("b", None, lambda: dict(OK))[1] == "miss"
+    assert cache.stats()["evicted"] == 2
+
+
+def test_concurrent_callers_of_the_same_key_share_one_fetch():
+    cache = AIResponseCache(); calls = []; release = threading.Event(); outcomes = []
+    def fetch():
+        calls.append(1); release.wait(2)
+        return dict(OK)
+    threads = [threading.Thread(target=lambda: outcomes.append(cache.get_or_query("k", None, fetch)[1])) for _ in range(5)]
+    [thread.start() for thread in threads]
+    time.sleep(0.1); release.set(); [thread.join() for thread in threads]
+    assert len(calls) == 1 and sorted(outcomes) == ["coalesced"] * 4 + ["miss"]
+
+
+def test_errors_and_failed_responses_are_not_cached():
+    cache = AIResponseCache()
+    def boom(): raise AIUpstreamUnavailable("fora")
+    with pytest.raises(AIUpstreamUnavailable): cache.get_or_query("k", None, boom)
+    assert cache.get_or_query("k", None, lambda: {"success": False, "error": "quota"})[1] == "miss"
+    assert cache.get_or_query("k", None, lambda: dict(OK))[1] == "miss"
+    assert cache.get_or_query("k", None, boom)[1] == "hit" and cache.stats()["entries"] == 1
@@ -0,0 +1,72 @@
+# flow_controller_service/tests/test_async_jobs.py
+import pytest
+
+from async_jobs import RedisJobStore, callback_url_allowed
+
+
+def _simple_flow(chain):
+    return chain(("start", "startNode", {}), ("ask", "waitInput", {"variableName": "x", "message": "Seu nome?"}))
+
+
+def test_async_false_string_runs_synchronously(fc, install_flow, chain):
+    install_flow(_simple_flow(chain))
+    response = fc.app.test_client().post("/process_message", json={"sender_id": "async-1", "message": "oi", "async": "false"})
+    assert response.status_code == 200 and "job_id" not in response.get_json()
+    response = fc.app.test_client().post("/process_message", json={"sender_id": "async-1", "message": "oi", "async": "talvez"})
+    assert response.status_code == 400
+
+
+def test_callback_url_outside_allow_list_is_rejected(fc, install_flow, chain, monkeypatch):
+    install_flow(_simple_flow(chain))
+    monkeypatch.setattr(fc, "ASYNC_CALLBACK_ALLOWED_URLS", ["https://hooks.exemplo.com/flow"])
+    monkeypatch.setattr(fc.callback_sender, "send", lambda url, payload: True)
+    client = fc.app.test_client()
+    response = client.post("/process_message", json={"sender_id": "async-2", "message": "oi", "async": True, "callback_url": "http://169.254.169.254/latest"})
+    assert response.status_code == 400
+    response = client.post("/process_message", json={"sender_id": "async-2", "message": "oi", "async": True, "callback_url": "https://hooks.exemplo.com/flow/abc"})
+    assert response.status_code == 202
+
+
+def test_callback_url_allowed_matches_host_and_path_prefix():
+    allowed = ["https://hooks.exemplo.com/flow"]
+    assert callback_url_allowed("https://hooks.exemplo.com/flow", allowed)
+    assert callback_url_allowed("https://hooks.exemplo.com/flow/x?y=1", allowed)
+    assert not callback_url_allowed("https://hooks.exemplo.com/flowx", allowed)
+    assert not callback_url_allowed("https://hooks.exemplo.com.evil.net/flow", allowed)
+    assert not callback_url_allowed("http://hooks.exemplo.com/flow", allowed)
+
+
+def test_redis_job_store_is_shared_between_instances():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    producer = RedisJobStore(fakeredis.FakeRedis(server=server)); reader = RedisJobStore(fakeredis.FakeRedis(server=server))
+    producer.create("j1", "s1"); producer.update("j1", status="done", status_code=200, result={"response_payload": {"text": "oi"}})
+    job = reader.get("j1")
+    assert job["status"] == "done" and job["result"] == {"response_payload": {"text": "oi"}}
+    reader.update("desconhecido", status="done")
+    assert reader.get("desconhecido") is None
+
+
+class _BrokenJobStore:
+    backend_name = "redis"
+    def __init__(self, fail_create=False): self.fail_create = fail_create
+    def create(self, job_id, sender_id):
+        if self.fail_create: raise ConnectionError("redis fora")
+    def update(self, job_id, **fields): raise ConnectionError("redis fora")
+    def get(self, job_id): return None
+
+
+def test_result_store_failure_still_sends_callback(fc, install_flow, chain, monkeypatch):
+    install_flow(_simple_flow(chain))
+    sent = []
+    monkeypatch.setattr(fc, "async_job_store", _BrokenJobStore())
+    monkeypatch.setattr(fc.callback_sender, "send", lambda url, payload: sent.append(payload) or True)
+    fc.run_message_job("j-falho", "async-3", "oi", "https://hooks.exemplo.com/flow")
+    assert len(sent) == 1 and sent[0]["status_code"] == 200 and sent[0]["response_payload"]["text"] == "Seu nome?"
+
+
+def test_result_store_create_failure_is_a_clean_503(fc, install_flow, chain, monkeypatch):
+    install_flow(_simple_flow(chain))
+    monkeypatch.setattr(fc, "async_job_store", _BrokenJobStore(fail_create=True))
+    response = fc.app.test_client().post("/process_message", json={"sender_id": "async-4", "message": "oi", "async": True})
+    assert response.status_code == 503 and "error" in response.get_json()
@@ -0,0 +1,61 @@
+# flow_controller_service/tests/test_batch.py
+import threading
+import time
+
+
+def _two_step_flow(chain):
+    return chain(("start", "startNode", {}), ("nome", "waitInput", {"variableName": "nome", "message": "Seu nome?"}),
+                 ("idade", "waitInput", {"variableName": "idade", "message": "Idade, {{nome}}?"}), ("fim", "endFlow", {"text": "Tchau {{nome}}"}))
+
+
+def _post(fc, messages):
+    response = fc.app.test_client().post("/process_messages", json={"messages": messages})
+    assert response.status_code == 200
+    return response.get_json()["results"]
+
+
+def test_batch_groups_by_sender_and_keeps_order(fc, install_flow, chain, monkeypatch):
+    install_flow(_two_step_flow(chain))
+    submitted = []; real_submit = fc.message_executor.submit
+    monkeypatch.setattr(fc.message_executor, "submit", lambda sender_id, fn: submitted.append(sender_id) or real_submit(sender_id, fn))
+    results = _post(fc, [{"sender_id": "lote-a", "message": "oi"}, {"sender_id": "lote-b", "message": "oi"}, {"sender_id": "lote-a", "message": "Ana"},
+                         {"sender_id": "lote-b", "message": "Bia"}, {"sender_id": "lote-a", "message": "30"}])
+    assert sorted(submitted) == ["lote-a", "lote-b"]  # Um job por sender
+    assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+    assert [result["sender_id"] for result in results] == ["lote-a", "lote-b", "lote-a", "lote-b", "lote-a"]
+    # O waitInput repete o prompt ao receber a resposta; "Idade, Ana?" só sai se "Ana" rodou antes de "30"
+    assert [result["response_payload"]["text"] for result in results] == ["Seu nome?", "Seu nome?", "Seu nome?", "Seu nome?", "Idade, Ana?"]
+    session = fc.session_store.load("lote-b")[0]
+    assert session["current_node_id"] == "idade" and session["variables"] == {"nome": "Bia"}
+
+
+def test_bad_item_does_not_fail_the_batch(fc, install_flow, chain, monkeypatch):
+    install_flow(_two_step_flow(chain))
+    real_handle = fc.handle_incoming_message
+    def handle(sender_id, *args, **kwargs):
+        if sender_id == "lote-quebrado": raise RuntimeError("falha no item")
+        return real_handle(sender_id, *args, **kwargs)
+    monkeypatch.setattr(fc, "handle_incoming_message", handle)
+    results = _post(fc, [{"message": "sem sender"}, {"sender_id": "lote-quebrado", "message": "oi"}, {"sender_id": "lote-c", "message": "oi"}])
+    assert [result["status_code"] for result in results] == [400, 500, 200]
+    assert results[2]["response_payload"]["text"] == "Seu nome?"
+
+
+def test_deadline_cancels_unstarted_items_and_tracks_running_ones(fc, install_flow, chain, monkeypatch):
+    install_flow(chain(("start", "startNode", {}), ("key", "setVariable", {"variableName": "k", "value": "sk-teste"}),
+                       ("gpt", "gptQuery", {"prompt": "Oi", "apiKeyVariable": "k", "saveResponseTo": "r"}),
+                       ("ask", "waitInput", {"variableName": "x", "message": "IA: {{r}}"})))
+    release = threading.Event()
+    monkeypatch.setattr(fc.ai_client, "query", lambda url, payload: release.wait(5) and {"success": True, "response": "tarde"})
+    monkeypatch.setattr(fc, "BATCH_TIMEOUT", 0.2)
+    try: results = _post(fc, [{"sender_id": "lote-lento", "message": "oi"}, {"sender_id": "lote-lento", "message": "segunda"}])
+    finally: release.set()
+    assert results[0]["status_code"] == 202 and results[0]["result_url"] == f"/result/{results[0]['job_id']}"
+    assert results[1]["status_code"] == 504 and results[1]["cancelled"]
+    for _ in range(100):
+        job = fc.async_job_store.get(results[0]["job_id"])
+        if job["status"] == "done": break
+        time.sleep(0.02)
+    assert job["result"]["response_payload"]["text"] == "IA: tarde"
+    time.sleep(0.1)
+    assert fc.session_store.load("lote-lento")[0]["current_node_id"] == "ask"  # A segunda mensagem nunca rodou
@@ -0,0 +1,52 @@
+# flow_controller_service/tests/test_campaign_flow.py
+from conftest import _chain, flows_table
+
+
+def test_campaign_resolves_only_active_flows(fc, monkeypatch):
+    monkeypatch.setattr(flows_table, "rows", {flow_id: dict(row) for flow_id, row in flows_table.rows.items()})
+    elements = _chain(("start", "startNode", {}))
+    flows_table.add(801, elements, status="inactive", campaign_id="camp-draft")
+    assert fc.resolve_campaign_flow_id("camp-draft") is None
+    flows_table.add(802, elements, status="active", campaign_id="camp-live")
+    assert fc.resolve_campaign_flow_id("camp-live") == 802
+
+
+def _ask_flow(message):
+    return _chain(("start", "startNode", {}), ("ask", "waitInput", {"variableName": "x", "message": message}))
+
+
+def test_entry_flow_id_serves_only_active_flows(fc, monkeypatch):
+    monkeypatch.setattr(flows_table, "rows", {flow_id: dict(row) for flow_id, row in flows_table.rows.items()})
+    flows_table.add(811, _ask_flow("Rascunho"), status="inactive")
+    response, status = fc.handle_incoming_message("rota-1", "oi", flow_id=811)
+    assert status == 404 and fc.session_store.load("flow:811:rota-1")[0] is None
+    flows_table.add(812, _ask_flow("Fluxo 812"), status="active")
+    response, status = fc.handle_incoming_message("rota-1", "oi", flow_id="812")
+    assert status == 200 and response["response_payload"]["text"] == "Fluxo 812"
+    assert fc.session_store.load("flow:812:rota-1")[0]["flow_id"] == 812
+
+
+def test_entry_campaign_id_routes_to_its_flow(fc, monkeypatch):
+    monkeypatch.setattr(flows_table, "rows", {flow_id: dict(row) for flow_id, row in flows_table.rows.items()})
+    flows_table.add(821, _ask_flow("Campanha X"), status="active", campaign_id="camp-x")
+    response, status = fc.handle_incoming_message("rota-2", "oi", campaign_id="camp-x")
+    assert status == 200 and response["response_payload"]["text"] == "Campanha X"
+    assert fc.session_store.load("campaign:camp-x:rota-2")[0]["flow_id"] == 821
+    assert fc.handle_incoming_message("rota-2", "oi", campaign_id="camp-inexistente")[1] == 404
+
+
+def test_no_routing_key_uses_the_active_flow(fc, install_flow):
+    install_flow(_ask_flow("Fluxo padrão"), flow_id=830)
+    response, status = fc.handle_incoming_message("rota-3", "oi")
+    assert status == 200 and response["response_payload"]["text"] == "Fluxo padrão"
+    assert fc.session_store.load("rota-3")[0]["flow_id"] == 830
+
+
+def test_go_to_flow_may_target_an_inactive_flow(fc, install_flow, monkeypatch):
+    monkeypatch.setattr(flows_table, "rows", {flow_id: dict(row) for flow_id, row in flows_table.rows.items()})
+    flows_table.add(841, _ask_flow("Subfluxo"), status="inactive")
+    install_flow(_chain(("start", "startNode", {}), ("pular", "goToFlow", {"targetFlowId": 841})), flow_id=840)
+    response, status = fc.handle_incoming_message("rota-4", "oi")
+    assert status == 200 and response["response_payload"]["text"] == "Subfluxo"
+    session = fc.session_store.load("rota-4")[0]
+    assert session["flow_id"] == 841 and session["current_node_id"] == "ask"
@@ -0,0 +1,54 @@
+# flow_controller_service/tests/test_conditions.py
+import pytest
+
+from conditions import compile_condition
+
+
+def _check(comparison, value, variables, variable_name="v"):
+    predicate, error = compile_condition({"variableName": variable_name, "comparison": comparison, "value": value})
+    assert error is None
+    return predicate(variables)
+
+
+@pytest.mark.parametrize("comparison, value, actual, expected", [
+    ("equals", "Sim", "sim", True), ("equals", "sim", "não", False),
+    ("notEquals", "sim", "não", True), ("notEquals", "SIM", "sim", False),
+    ("contains", "bol", "Futebol", True), ("contains", "xyz", "Futebol", False),
+    ("startsWith", "fut", "Futebol", True), ("startsWith", "bol", "Futebol", False),
+    ("endsWith", "BOL", "Futebol", True), ("endsWith", "fut", "Futebol", False),
+    ("greaterThan", "10", "10.5", True), ("greaterThan", "10", "10", False),
+    ("lessThan", "10", "9", True), ("lessThan", "10", "10", False),
+    ("greaterOrEquals", "10", "10", True), ("greaterOrEquals", "10", "9.99", False),
+    ("lessOrEquals", "10", "10", True), ("lessOrEquals", "10", "11", False),
+    ("regex", r"^\d{5}-\d{3}$", "01310-100", True), ("regex", r"^\d+$", "abc", False),
+    ("regex", "[i]^ABC", "abcdef", True),
+])
+def test_each_comparison_operator(comparison, value, actual, expected):
+    assert _check(comparison, value, {"v": actual}) is expected
+
+
+def test_is_set_and_is_not_set():
+    for actual, is_set in (("x", True), ("", False), ("None", False), (None, False)):
+        variables = {} if actual is None else {"v": actual}
+        assert _check("isSet", None, variables) is is_set
+        assert _check("isNotSet", None, variables) is (not is_set)
+
+
+def test_missing_variable_and_non_numeric_values_are_false():
+    assert _check("equals", "x", {}) is False
+    assert _check("greaterThan", "10", {"v": "muito"}) is False
+
+
+def test_templates_in_name_and_value_are_resolved():
+    assert _check("equals", "{{esperado}}", {"campo": "idade", "idade": "30", "esperado": "30"}, variable_name="{{campo}}")
+    assert _check("lessThan", "{{limite}}", {"v": "5", "limite": "7"})
+
+
+@pytest.mark.parametrize("data", [
+    {"variableName": "v"}, {"comparison": "equals"}, {"variableName": "v", "comparison": "parecido", "value": "x"},
+    {"variableName": "v", "comparison": "greaterThan"}, {"variableName": "v", "comparison": "greaterThan", "value": "dez"},
+    {"variableName": "v", "comparison": "regex", "value": "("},
+])
+def test_invalid_configuration_is_a_load_error(data):
+    predicate, error = compile_condition(data)
+    assert error and predicate({"v": "1"}) is False
@@ -0,0 +1,65 @@
+# flow_controller_service/tests/test_flow_graph.py
+import random
+
+import pytest
+
+from flow_graph import compile_flow
+from load_harness import generate_flow
+
+DEFAULT_HANDLES = ("source", "source-bottom", "source-default", "source-success")
+TRIGGERS = (None, "", "_internal_start_flow_", "_internal_transition_", "_internal_error_", "source-received", "source-error",
+            "source", "source-success", "true", "false", "btn-1", "btn-2", "texto livre", 42, {"id": "btn-1"})
+
+
+def _old_next_node_id(elements: dict, current_node_id: str, trigger_value, node_type_of_source):
+    # Varredura linear das edges feita antes da compilação do grafo, referência de equivalência
+    outgoing_edges = [edge for edge in elements.get("edges", []) if isinstance(edge, dict) and edge.get('source') == current_node_id]
+    if trigger_value and trigger_value not in ["_internal_start_flow_", "_internal_transition_", "_internal_error_"]:
+        for edge in outgoing_edges:
+            if edge.get('sourceHandle') == trigger_value: return edge.get('target')
+    if node_type_of_source == "waitInput" and trigger_value not in [None, "_internal_start_flow_", "_internal_transition_"]:
+        edge = next((e for e in outgoing_edges if e.get('sourceHandle') == 'source-received'), None)
+        if edge: return edge.get('target')
+    if trigger_value == "_internal_error_":
+        error_edge = next((edge for edge in outgoing_edges if edge.get('sourceHandle') == 'source-error'), None)
+        if error_edge: return error_edge.get('target')
+    default_edges = [edge for edge in outgoing_edges if not edge.get('sourceHandle') or edge.get('sourceHandle') in DEFAULT_HANDLES]
+    return default_edges[0].get('target') if default_edges else None
+
+
+def _tricky_flow() -> dict:
+    # Handles duplicados, várias edges padrão, received/error junto com handles de botão e entradas inválidas na lista
+    nodes = [{"id": node_id, "type": node_type, "data": {}} for node_id, node_type in
+             (("start", "startNode"), ("ask", "waitInput"), ("menu", "buttonMessage"), ("gpt", "gptQuery"), ("a", "textMessage"),
+              ("b", "textMessage"), ("c", "textMessage"), ("fim", "endFlow"))]
+    edges = [{"source": "start", "target": "ask"},
+             {"source": "ask", "sourceHandle": "source-received", "target": "menu"}, {"source": "ask", "sourceHandle": "btn-1", "target": "a"},
+             {"source": "ask", "sourceHandle": "source-received", "target": "b"}, {"source": "ask", "sourceHandle": "source", "target": "c"},
+             {"source": "menu", "sourceHandle": "btn-1", "target": "a"}, {"source": "menu", "sourceHandle": "btn-1", "target": "b"},
+             {"source": "menu", "sourceHandle": "btn-2", "target": "c"}, {"source": "menu", "sourceHandle": "source-default", "target": "fim"},
+             {"source": "menu", "target": "a"},
+             {"source": "gpt", "sourceHandle": "source-error", "target": "b"}, {"source": "gpt", "sourceHandle": "source-success", "target": "a"},
+             {"source": "a", "sourceHandle": "source-bottom", "target": "fim"}, {"source": "b", "sourceHandle": "desconhecido", "target": "fim"},
+             "edge inválida", {"target": "fim"}, {"source": "c"}]
+    return {"nodes": nodes, "edges": edges}
+
+
+def _assert_equivalent(elements: dict):
+    flow = compile_flow(1, "Equivalência", elements)
+    handles = {edge.get("sourceHandle") for edge in elements["edges"] if isinstance(edge, dict)}
+    for node in elements["nodes"]:
+        for trigger in TRIGGERS + tuple(handles):
+            for node_type in (node["type"], "waitInput", None):
+                expected = _old_next_node_id(elements, node["id"], trigger, node_type)
+                assert flow.next_node_id(node["id"], trigger, node_type) == expected, (node["id"], trigger, node_type)
+
+
+def test_compiled_lookup_matches_linear_scan_on_edge_cases():
+    _assert_equivalent(_tricky_flow())
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_compiled_lookup_matches_linear_scan_on_generated_flows(seed):
+    elements = generate_flow(node_count=60, extra_edges=40, seed=seed)
+    random.Random(seed).shuffle(elements["edges"])  # A ordem das edges decide entre duplicadas nos dois lados
+    _assert_equivalent(elements)
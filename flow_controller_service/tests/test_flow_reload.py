@@ -0,0 +1,67 @@
+# flow_controller_service/tests/test_flow_reload.py
+import datetime
+
+import pytest
+
+from conftest import _chain, flows_table
+
+
+def _flow(a_text, first_node="a"):
+    return _chain(("start", "startNode", {}), (first_node, "waitInput", {"variableName": "x", "message": a_text}),
+                  ("b", "waitInput", {"variableName": "y", "message": "B"}))
+
+
+@pytest.fixture
+def reload_flow(fc, monkeypatch):
+    # Fluxo ativo 900 na tabela flows; cada chamada grava uma versão nova e roda o poller (refresh_flows_if_changed)
+    monkeypatch.setattr(flows_table, "rows", {})
+    monkeypatch.setattr(fc, "current_flow", fc.current_flow)
+    stamp = [datetime.datetime(2026, 1, 1)]
+    def publish(elements):
+        flows_table.add(900, elements, status="active")
+        stamp[0] += datetime.timedelta(seconds=1); flows_table.rows[900]["updated_at"] = stamp[0]
+        fc.refresh_flows_if_changed()
+        return fc.current_flow
+    return publish
+
+
+def test_in_flight_session_stays_on_its_pinned_version(fc, reload_flow):
+    v1 = reload_flow(_flow("A v1"))
+    fc.handle_incoming_message("reload-1", "oi")
+    v2 = reload_flow(_flow("A v2"))
+    assert v2.version != v1.version and fc.current_flow is v2
+    response, _ = fc.handle_incoming_message("reload-1", "resposta")
+    assert response["response_payload"]["text"] == "A v1"
+    assert fc.session_store.load("reload-1")[0]["flow_version"] == v1.version
+    fc.handle_incoming_message("reload-2", "oi")  # Sessão nova já começa na versão nova
+    assert fc.session_store.load("reload-2")[0]["flow_version"] == v2.version
+
+
+def test_session_migrates_when_its_node_exists_in_the_new_version(fc, reload_flow, monkeypatch):
+    reload_flow(_flow("A v1")); fc.handle_incoming_message("reload-3", "oi")
+    v2 = reload_flow(_flow("A v2"))
+    monkeypatch.setattr(fc, "FLOW_SESSION_PINNING", False)
+    response, _ = fc.handle_incoming_message("reload-3", "resposta")
+    assert response["response_payload"]["text"] == "A v2"
+    session = fc.session_store.load("reload-3")[0]
+    assert session["flow_version"] == v2.version and session["current_node_id"] == "b"
+
+
+def test_migration_after_old_version_is_no_longer_retained(fc, reload_flow):
+    reload_flow(_flow("A v1")); fc.handle_incoming_message("reload-4", "oi")
+    for text in ("A v2", "A v3", "A v4"): latest = reload_flow(_flow(text))  # FLOW_VERSIONS_RETAINED=2: v1 sai da memória
+    response, _ = fc.handle_incoming_message("reload-4", "resposta")
+    assert response["response_payload"]["text"] == "A v4"
+    assert fc.session_store.load("reload-4")[0]["flow_version"] == latest.version
+
+
+def test_session_restarts_when_its_node_was_removed(fc, reload_flow, monkeypatch):
+    reload_flow(_flow("A v1")); fc.handle_incoming_message("reload-5", "oi")
+    v2 = reload_flow(_flow("Novo início", first_node="novo"))
+    monkeypatch.setattr(fc, "FLOW_SESSION_PINNING", False)
+    resets_before = fc.SESSION_RESETS.samples().get('["flow_version_changed"]', 0)
+    response, _ = fc.handle_incoming_message("reload-5", "resposta")
+    assert response["response_payload"]["text"] == "Novo início"
+    session = fc.session_store.load("reload-5")[0]
+    assert session["flow_version"] == v2.version and session["current_node_id"] == "novo"
+    assert fc.SESSION_RESETS.samples()['["flow_version_changed"]'] == resets_before + 1
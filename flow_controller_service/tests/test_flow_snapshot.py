@@ -0,0 +1,56 @@
+# flow_controller_service/tests/test_flow_snapshot.py
+import os
+
+from conftest import _chain
+from flow_graph import compile_flow
+from flow_snapshot import FlowSnapshotStore, create_snapshot_store_from_env
+
+
+def _store(tmp_path, key=b"chave-de-teste"):
+    directory = tmp_path / "snapshots"; directory.mkdir(mode=0o700); os.chmod(directory, 0o700)
+    return FlowSnapshotStore(str(directory), key), directory
+
+
+def _flow():
+    return compile_flow(7, "Fluxo", _chain(("start", "startNode", {}), ("c", "condition", {"variableName": "x", "comparison": "equals", "value": "1"})), version="v1")
+
+
+def test_signed_snapshot_round_trip(tmp_path):
+    store, _ = _store(tmp_path)
+    assert store.save(_flow())
+    loaded = store.load_active()
+    assert loaded is not None and loaded.id == 7 and loaded.version == "v1"
+    predicate = loaded.get_node("c").predicate
+    assert predicate({"x": "1"}) and not predicate({"x": "2"})
+
+
+def test_tampered_or_foreign_key_snapshot_is_not_unpickled(tmp_path):
+    store, directory = _store(tmp_path); store.save(_flow())
+    assert FlowSnapshotStore(str(directory), b"outra-chave").load_active() is None
+    path = next(directory.glob("flow-*.pkl")); raw = bytearray(path.read_bytes()); raw[-1] ^= 0xFF; path.write_bytes(bytes(raw))
+    assert store.load_active() is None
+
+
+def test_shared_directory_is_refused(tmp_path):
+    store, directory = _store(tmp_path); store.save(_flow())
+    os.chmod(directory, 0o777)
+    assert store.load_active() is None
+
+
+def test_snapshots_disabled_without_dir_and_key(monkeypatch):
+    monkeypatch.delenv("FLOW_SNAPSHOT_DIR", raising=False); monkeypatch.setenv("FLOW_SNAPSHOT_KEY", "k")
+    assert create_snapshot_store_from_env().directory is None
+    monkeypatch.setenv("FLOW_SNAPSHOT_DIR", "/tmp/qualquer"); monkeypatch.delenv("FLOW_SNAPSHOT_KEY")
+    assert create_snapshot_store_from_env().directory is None
+
+
+def test_master_without_snapshot_defers_the_mysql_load(fc, monkeypatch):
+    monkeypatch.setattr(fc.flow_snapshots, "load_active", lambda: None)
+    monkeypatch.setattr(fc, "current_flow", fc.CompiledFlow.empty())
+    def no_db(*args): raise AssertionError("o master não deveria consultar o MySQL")
+    monkeypatch.setattr(fc, "load_flow_from_db", no_db)
+    assert fc.init_flow(load_from_db=False) is False
+    loads = []
+    monkeypatch.setattr(fc, "load_flow_from_db", lambda: loads.append(1) or True)
+    fc.ensure_flow_loaded()  # post_worker_init, já no worker
+    assert loads == [1]
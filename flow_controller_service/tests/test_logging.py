@@ -0,0 +1,43 @@
+# flow_controller_service/tests/test_logging.py
+import io
+import logging
+
+from log_config import ProcessQueueHandler, RedactFilter, RequestFilter, TextFormatter, mark_secret, request_log_context
+
+API_KEY = "chave-" + "x7" * 30
+
+
+def _capture(logger: logging.Logger):
+    stream = io.StringIO(); handler = logging.StreamHandler(stream); handler.setFormatter(TextFormatter("%(message)s"))
+    handler.addFilter(RequestFilter()); handler.addFilter(RedactFilter())
+    logger.addHandler(handler)
+    return stream, handler
+
+
+def test_queue_handler_defers_formatting_to_listener():
+    target = logging.StreamHandler(io.StringIO()); handler = ProcessQueueHandler(target)
+    record = logging.LogRecord("flow_controller.teste", logging.INFO, __file__, 1, "valor %s", ("x",), None)
+    prepared = handler.prepare(record)
+    assert prepared.msg == "valor %s" and prepared.args == ("x",)
+
+
+def test_secret_redacted_in_listener_with_request_secrets():
+    logger = logging.getLogger("flow_controller.teste_redact"); logger.setLevel(logging.INFO); logger.propagate = False
+    stream, handler = _capture(logger)
+    try:
+        with request_log_context(logger, "evento"):
+            mark_secret(API_KEY); logger.info("chave %s", API_KEY)
+    finally: logger.removeHandler(handler)
+    assert API_KEY not in stream.getvalue() and "***" in stream.getvalue()
+
+
+def test_set_variable_api_key_never_logged(fc, install_flow, chain, monkeypatch):
+    install_flow(chain(("start", "startNode", {}), ("key", "setVariable", {"variableName": "k", "value": API_KEY}),
+                       ("gpt", "gptQuery", {"prompt": "Oi", "apiKeyVariable": "k", "saveResponseTo": "r"}),
+                       ("ask", "waitInput", {"variableName": "x", "message": "IA: {{r}}"})))
+    monkeypatch.setattr(fc.ai_client, "query", lambda url, payload: {"success": True, "response": "ok"})
+    stream, handler = _capture(fc.logger); level = fc.logger.level; fc.logger.setLevel(logging.DEBUG)
+    try: fc.handle_incoming_message("log-1", "oi")
+    finally: fc.logger.removeHandler(handler); fc.logger.setLevel(level)
+    assert "SetVariable" in stream.getvalue()
+    assert API_KEY[:20] not in stream.getvalue()
@@ -0,0 +1,37 @@
+# flow_controller_service/tests/test_metrics.py
+import os
+
+from session_store import InMemorySessionStore
+
+
+def test_session_evictions_and_expirations_are_exported(fc, monkeypatch):
+    store = InMemorySessionStore(idle_ttl=0, max_entries=2)
+    for sender_id in ("m1", "m2", "m3", "m4"): store.save(sender_id, {"variables": {}}, 0)
+    store.expired = 5
+    monkeypatch.setattr(fc, "session_store", store)
+    rendered = fc.app.test_client().get("/metrics").get_data(as_text=True)
+    assert "flow_sessions_evicted_total 2" in rendered.splitlines()
+    assert "flow_sessions_expired_total 5" in rendered.splitlines()
+
+
+def _error_routes(fc) -> float:
+    return fc.ERROR_EDGE_ROUTES.samples().get('["gptQuery"]', 0)
+
+
+def test_error_edge_counted_only_when_error_handle_taken(fc, install_flow, chain):
+    nodes = (("start", "startNode", {}), ("gpt", "gptQuery", {"prompt": "Oi", "apiKeyVariable": "sem_chave", "saveResponseTo": "r"}),
+             ("ask", "waitInput", {"variableName": "x", "message": "Seguiu"}), ("err", "textMessage", {"text": "Erro"}))
+    install_flow(chain(*nodes[:3]))
+    before = _error_routes(fc); fc.handle_incoming_message("edge-1", "oi")
+    assert _error_routes(fc) == before  # Sem source-error: caiu na edge padrão
+    install_flow(chain(*nodes, edges=(("gpt", "err", "source-error"),)))
+    fc.handle_incoming_message("edge-2", "oi")
+    assert _error_routes(fc) == before + 1
+
+
+def test_remove_pid_drops_worker_snapshot(tmp_path):
+    from metrics import MetricsRegistry
+    registry = MetricsRegistry(str(tmp_path)); registry.counter("flow_teste_total", "Teste.").inc()
+    registry.flush(); (tmp_path / "metrics_999999.json").write_text('{"pid": 999999, "metrics": {}}')
+    registry.remove_pid(999999)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [f"metrics_{os.getpid()}.json"]
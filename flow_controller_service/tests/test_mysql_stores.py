@@ -0,0 +1,41 @@
+# flow_controller_service/tests/test_mysql_stores.py
+from contextlib import contextmanager
+
+import pytest
+
+from async_jobs import MySQLJobStore
+from session_store import MySQLSessionStore
+from timer_scheduler import MySQLTimerStore
+
+
+class RecordingCursor:
+    def __init__(self, queries): self._queries = queries; self.rowcount = 0
+    def execute(self, query, params=()): self._queries.append(query.split()[0].upper())
+    def fetchone(self): return None
+    def fetchall(self): return []
+    def close(self): pass
+
+
+class Database:
+    def __init__(self): self.up = False; self.queries = []
+
+    @contextmanager
+    def connection(self):
+        if not self.up: raise ConnectionError("MySQL fora do ar")
+        yield self
+
+    def cursor(self): return RecordingCursor(self.queries)
+    def commit(self): pass
+    def rollback(self): pass
+
+
+@pytest.mark.parametrize("build, use", [
+    (lambda db: MySQLSessionStore(db.connection), lambda store: store.load("s1")),
+    (lambda db: MySQLTimerStore(db.connection), lambda store: store.pop_due(0, 10)),
+    (lambda db: MySQLJobStore(db.connection), lambda store: store.get("j1")),
+])
+def test_tables_are_created_on_first_use_not_at_construction(build, use):
+    db = Database(); store = build(db)  # MySQL fora do ar na subida: construir não pode falhar
+    with pytest.raises(ConnectionError): use(store)
+    db.up = True; use(store); use(store)
+    assert db.queries.count("CREATE") == 1 and db.queries[0] == "CREATE"
@@ -0,0 +1,22 @@
+# flow_controller_service/tests/test_process_local.py
+import os
+
+import pytest
+
+from process_local import ProcessOnce, after_fork
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requer os.fork")
+def test_process_once_runs_again_in_forked_child():
+    once = ProcessOnce(); calls = []; resets = []
+    class Holder:
+        def reset(self): resets.append(os.getpid())
+    holder = Holder(); after_fork(holder.reset)
+    assert once.run(lambda: calls.append("pai")) and not once.run(lambda: calls.append("de novo"))
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        ok = not once.done and once.run(lambda: None) and not once.run(lambda: None) and resets == [os.getpid()]
+        os.write(write_fd, b"1" if ok else b"0"); os._exit(0)
+    os.close(write_fd); result = os.read(read_fd, 1); os.waitpid(pid, 0)
+    assert result == b"1" and calls == ["pai"] and once.done and resets == []
@@ -0,0 +1,71 @@
+# flow_controller_service/tests/test_session_cas.py
+import threading
+
+
+def _ai_flow(chain):
+    return chain(("start", "startNode", {}), ("key", "setVariable", {"variableName": "k", "value": "sk-teste"}),
+                 ("gpt", "gptQuery", {"prompt": "Oi {{lastInput}}", "apiKeyVariable": "k", "saveResponseTo": "r"}),
+                 ("ask", "waitInput", {"variableName": "x", "message": "IA: {{r}}"}))
+
+
+def test_cas_retry_reuses_paid_ai_response(fc, install_flow, chain, monkeypatch):
+    install_flow(_ai_flow(chain))
+    calls = []
+    monkeypatch.setattr(fc.ai_client, "query", lambda url, payload: calls.append(payload) or {"success": True, "response": "resposta"})
+    real_save = fc.session_store.save; conflicts = []
+    def save_with_one_conflict(session_key, session, version):
+        if not conflicts: conflicts.append(session_key); return False  # Outro processo gravou primeiro
+        return real_save(session_key, session, version)
+    monkeypatch.setattr(fc.session_store, "save", save_with_one_conflict)
+
+    response, status = fc.handle_incoming_message("cas-1", "oi")
+    assert status == 200 and conflicts == ["cas-1"]
+    assert len(calls) == 1
+    assert fc.session_store.load("cas-1")[0]["variables"]["r"] == "resposta"
+
+
+def test_same_sender_is_serialized_in_process(fc, install_flow, chain, monkeypatch):
+    install_flow(_ai_flow(chain))
+    in_flight = []; overlaps = []; lock = threading.Lock()
+    def slow_query(url, payload):
+        with lock:
+            if in_flight: overlaps.append(payload)
+            in_flight.append(payload)
+        threading.Event().wait(0.05)
+        with lock: in_flight.remove(payload)
+        return {"success": True, "response": "ok"}
+    monkeypatch.setattr(fc.ai_client, "query", slow_query)
+    fc.session_store.delete("cas-2", fc.session_store.load("cas-2")[1])
+    threads = [threading.Thread(target=fc.handle_incoming_message, args=("cas-2", "oi")) for _ in range(4)]
+    [t.start() for t in threads]; [t.join() for t in threads]
+    assert overlaps == []
+
+
+def test_different_session_keys_never_wait_on_each_other():
+    from session_store import SessionLocks
+    locks = SessionLocks(); done = threading.Event()
+    def other_senders():
+        for index in range(1000):
+            with locks.hold(f"outro-{index}"): pass
+        done.set()
+    with locks.hold("ocupado"):
+        worker = threading.Thread(target=other_senders, daemon=True); worker.start()
+        assert done.wait(2)
+    assert len(locks) == 0
+
+
+def test_slow_ai_call_does_not_hold_other_senders(fc, install_flow, chain, monkeypatch):
+    install_flow(_ai_flow(chain))
+    release = threading.Event(); entered = threading.Event()
+    def blocking_query(url, payload):
+        entered.set(); release.wait(5)
+        return {"success": True, "response": "ok"}
+    monkeypatch.setattr(fc.ai_client, "query", blocking_query)
+    slow = threading.Thread(target=fc.handle_incoming_message, args=("lento", "oi")); slow.start()
+    try:
+        assert entered.wait(2)
+        monkeypatch.setattr(fc.ai_client, "query", lambda url, payload: {"success": True, "response": "rápido"})
+        response, status = fc.handle_incoming_message("rapido", "oi")
+        assert status == 200 and response["response_payload"]["text"] == "IA: rápido"
+    finally:
+        release.set(); slow.join()
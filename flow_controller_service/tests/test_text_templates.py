@@ -0,0 +1,51 @@
+# flow_controller_service/tests/test_text_templates.py
+import re
+
+import pytest
+
+from text_templates import CompiledTemplate, render_template
+
+
+def _old_process_text_variables(text, user_vars):
+    # Implementação anterior (re.sub repetido até 5 vezes), referência de equivalência
+    if text is None: return None
+    processed_text = str(text)
+    for _ in range(5):
+        new_text = re.sub(r"\{\{(.+?)\}\}", lambda m: str(user_vars.get(m.group(1).strip(), f"{{{{{m.group(1).strip()}}}}}")), processed_text)
+        if new_text == processed_text: break
+        processed_text = new_text
+    return processed_text
+
+
+def test_missing_variable_keeps_the_placeholder():
+    assert CompiledTemplate("Olá {{nome}}, {{ sobrenome }}!").render({"nome": "Ana"}) == "Olá Ana, {{sobrenome}}!"
+
+
+def test_repeated_placeholders_are_all_replaced():
+    template = CompiledTemplate("{{x}}-{{x}}-{{ x }}")
+    assert template.names == ("x", "x", "x") and template.render({"x": 7}) == "7-7-7"
+
+
+def test_non_string_values_are_stringified():
+    assert CompiledTemplate("{{n}} {{f}} {{b}} {{z}} {{l}}").render({"n": 3, "f": 1.5, "b": True, "z": None, "l": [1, 2]}) == "3 1.5 True None [1, 2]"
+
+
+def test_none_text_and_static_text():
+    assert render_template(None, {"x": 1}) is None
+    assert render_template(42, {}) == "42"
+    static = CompiledTemplate("sem variáveis")
+    assert static.is_static and static.render({"x": 1}) == "sem variáveis"
+
+
+@pytest.mark.parametrize("text, variables", [
+    ("Olá {{nome}}", {"nome": "Ana"}),
+    ("{{a}}", {"a": "{{b}}", "b": "{{c}}", "c": "fim"}),
+    ("{{a}}", {"a": "{{a}}"}),
+    ("{{a}}", {"a": "x{{a}}"}),
+    ("{{ a }}{{a}}", {"a": "{{"}),
+    ("{{a}}}}", {"a": "{{b"}),
+    ("chaves {{}} vazias {{ }}", {"": "vazio"}),
+    ("", {}),
+])
+def test_matches_the_old_regex_implementation(text, variables):
+    assert render_template(text, variables) == _old_process_text_variables(text, variables)
@@ -0,0 +1,90 @@
+# flow_controller_service/tests/test_timers.py
+import time
+
+import pytest
+
+from flow_graph import TIMER_TRIGGER
+from timer_scheduler import InMemoryTimerStore, RedisTimerStore, TimerScheduler
+
+
+class InlineExecutor:
+    def submit(self, key, fn):
+        fn()
+
+
+def _delay_flow(chain):
+    return chain(("start", "startNode", {}), ("wait", "delay", {"duration": 1, "unit": "seconds"}),
+                 ("ask", "waitInput", {"variableName": "x", "message": "Depois do delay"}))
+
+
+def test_failed_fire_is_rescheduled_with_backoff():
+    store = InMemoryTimerStore(); calls = []
+    def fire(session_key, timer_id):
+        calls.append(timer_id)
+        if len(calls) == 1: raise RuntimeError("conflito de CAS")
+    scheduler = TimerScheduler(store, fire, InlineExecutor(), poll_interval=0, retry_base=10)
+    store.schedule("s1", "t1", time.time() - 1)
+    scheduler.run_due()
+    assert calls == ["t1"] and store.count() == 1 and store.next_due() > time.time() + 5
+    scheduler.run_due(time.time() + 60)
+    assert calls == ["t1", "t1"] and store.count() == 0 and scheduler.stats()["fired"] == 1
+
+
+def test_retry_does_not_replace_a_newer_timer():
+    store = InMemoryTimerStore()
+    def fire(session_key, timer_id):
+        store.schedule(session_key, "t2", time.time() + 30)  # A sessão agendou outro timer enquanto este falhava
+        raise RuntimeError("falhou")
+    scheduler = TimerScheduler(store, fire, InlineExecutor(), poll_interval=0)
+    store.schedule("s1", "t1", time.time() - 1)
+    scheduler.run_due()
+    assert store.pop_due(time.time() + 60, 10)[0][:2] == ("s1", "t2")
+
+
+def test_failed_session_fire_keeps_the_delay(fc, install_flow, chain, monkeypatch):
+    install_flow(_delay_flow(chain))
+    fc.handle_incoming_message("timer-1", "oi")
+    timer = fc.session_store.load("timer-1")[0]["timer"]
+    scheduler = TimerScheduler(fc.timer_scheduler.store, fc.fire_session_timer, InlineExecutor(), poll_interval=0)
+    real_save = fc.session_store.save
+    def failing_save(*args): raise ConnectionError("backend fora")
+    monkeypatch.setattr(fc.session_store, "save", failing_save)
+    scheduler.run_due(timer["due"] + 1)
+    assert fc.session_store.load("timer-1")[0]["timer"]["id"] == timer["id"]
+    assert fc.timer_scheduler.store.count() >= 1  # Voltou ao índice com backoff
+    monkeypatch.setattr(fc.session_store, "save", real_save)
+    scheduler.run_due(time.time() + 3600)
+    session = fc.session_store.load("timer-1")[0]
+    assert session["current_node_id"] == "ask" and "timer" not in session
+
+
+def test_overdue_delay_resumes_on_next_message(fc, install_flow, chain):
+    install_flow(_delay_flow(chain))
+    fc.handle_incoming_message("timer-2", "oi")
+    response, _ = fc.handle_incoming_message("timer-2", "ainda aí?")
+    assert "response_payload" not in response  # Delay ainda correndo: mensagem ignorada
+    session, version = fc.session_store.load("timer-2"); session["timer"]["due"] = time.time() - 5
+    assert fc.session_store.save("timer-2", session, version)
+    response, _ = fc.handle_incoming_message("timer-2", "ainda aí?")
+    assert response["response_payload"]["text"] == "Depois do delay"
+
+
+def test_timer_literal_from_user_is_rejected(fc, install_flow, chain):
+    install_flow(_delay_flow(chain))
+    fc.handle_incoming_message("timer-3", "oi")
+    response = fc.app.test_client().post("/process_message", json={"sender_id": "timer-3", "message": TIMER_TRIGGER})
+    assert response.status_code == 400
+    assert fc.session_store.load("timer-3")[0]["current_node_id"] == "wait"
+
+
+def test_redis_pop_due_is_atomic_and_single_delivery():
+    fakeredis = pytest.importorskip("fakeredis"); pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    first = RedisTimerStore(fakeredis.FakeRedis(server=server)); second = RedisTimerStore(fakeredis.FakeRedis(server=server))
+    now = time.time()
+    for index in range(3): first.schedule(f"s{index}", f"t{index}", now - index)
+    first.schedule("futuro", "tf", now + 60)
+    popped = first.pop_due(now, 10) + second.pop_due(now, 10)
+    assert sorted((key, timer_id) for key, timer_id, _ in popped) == [("s0", "t0"), ("s1", "t1"), ("s2", "t2")]
+    assert first.count() == 1
+    assert not first.schedule_if_absent("futuro", "outro", now) and first.schedule_if_absent("s0", "t0", now)
@@ -0,0 +1,62 @@
+# flow_controller_service/text_templates.py
+# Templates {{variavel}} pré-compilados. O texto é quebrado uma vez em segmentos
+# literal/variável; renderizar vira um único join. A semântica é a mesma do antigo
+# process_text_variables (re.sub repetido até 5 vezes): variável inexistente continua
+# como {{nome}} e valores que contêm {{...}} são resolvidos nas passadas seguintes.
+import functools
+import os
+import re
+
+VARIABLE_PATTERN = re.compile(r"\{\{(.+?)\}\}")
+MAX_RESOLUTION_PASSES = 5
+_MISSING = object()
+
+
+class CompiledTemplate:
+    __slots__ = ("source", "literals", "names", "placeholders")
+
+    def __init__(self, source: str):
+        self.source = source
+        literals = []; names = []; position = 0
+        for match in VARIABLE_PATTERN.finditer(source):
+            literals.append(source[position:match.start()]); names.append(match.group(1).strip()); position = match.end()
+        literals.append(source[position:])
+        self.literals = tuple(literals); self.names = tuple(names)
+        self.placeholders = tuple(f"{{{{{name}}}}}" for name in names)
+
+    @property
+    def is_static(self) -> bool:
+        return not self.names
+
+    def render_once(self, variables: dict) -> str:
+        literals = self.literals
+        parts = [literals[0]]
+        for index, name in enumerate(self.names):
+            value = variables.get(name, _MISSING)
+            parts.append(self.placeholders[index] if value is _MISSING else str(value))
+            parts.append(literals[index + 1])
+        return "".join(parts)
+
+    def render(self, variables: dict) -> str:
+        if not self.names: return self.source
+        current = self.source; template = self
+        for _ in range(MAX_RESOLUTION_PASSES):
+            rendered = template.render_once(variables)
+            if rendered == current: break
+            current = rendered
+            if "{{" not in current: break  # Sem marcador, a próxima passada não mudaria nada
+            template = compile_template(current)
+        return current
+
+
+@functools.lru_cache(maxsize=int(os.environ.get("TEMPLATE_CACHE_SIZE", "4096")))
+def compile_template(text: str) -> CompiledTemplate:
+    # LRU para textos dinâmicos (valores de variáveis, passadas de resolução aninhada)
+    return CompiledTemplate(text)
+
+
+def render_template(text, variables: dict) -> str | None:
+    if text is None: return None
+    text = str(text)
+    if "{{" not in text: return text  # Caminho comum (inputs do usuário, respostas de IA): nem passa pelo LRU
+    return compile_template(text).render(variables)
@@ -0,0 +1,292 @@
+# flow_controller_service/timer_scheduler.py
+# Timers duráveis das sessões: nós delay (retomar depois de X segundos/minutos) e timeout de
+# waitInput (timeoutSeconds -> handle source-timeout). A sessão guarda o timer pendente
+# ({"id", "kind", "node_id", "due", ...}) e é a fonte da verdade; o TimerStore só indexa
+# (session_key, timer_id, due) por vencimento para achar os vencidos sem varrer sessões.
+# Backends acompanham o session store: heap em memória, ZSET no Redis ou tabela flow_timers
+# no MySQL (esses dois sobrevivem a restart e são disputados com segurança entre workers).
+import heapq
+import logging
+import os
+import threading
+import time
+import uuid
+
+from process_local import ProcessOnce
+
+logger = logging.getLogger("flow_controller.timer_scheduler")
+
+
+def new_timer(kind: str, node_id: str, seconds: float) -> dict:
+    return {"id": uuid.uuid4().hex[:16], "kind": kind, "node_id": node_id, "due": round(time.time() + seconds, 3)}
+
+
+class TimerStore:
+    backend_name = "abstract"
+
+    def schedule(self, session_key: str, timer_id: str, due: float):
+        # Um timer por sessão: agendar de novo substitui o anterior
+        raise NotImplementedError
+
+    def schedule_if_absent(self, session_key: str, timer_id: str, due: float) -> bool:
+        # Devolve um timer ao índice só se a sessão não tiver agendado outro nesse meio-tempo (retentativa de disparo)
+        raise NotImplementedError
+
+    def cancel(self, session_key: str):
+        raise NotImplementedError
+
+    def pop_due(self, now: float, limit: int) -> list:
+        # Retira e devolve [(session_key, timer_id, due)] vencidos; cada timer é entregue a um único chamador
+        raise NotImplementedError
+
+    def next_due(self) -> float | None:
+        # Próximo vencimento conhecido (None = desconhecido/sem timers: o scheduler usa o intervalo de polling)
+        return None
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+
+class InMemoryTimerStore(TimerStore):
+    # Heap com remoção preguiçosa: cancelar/reagendar só troca o timer vigente no dict; entradas velhas são descartadas ao sair do heap
+    backend_name = "memory"
+
+    def __init__(self):
+        self._heap = []; self._current = {}  # session_key -> timer_id vigente
+        self._lock = threading.Lock()
+
+    def schedule(self, session_key, timer_id, due):
+        with self._lock:
+            self._current[session_key] = timer_id; heapq.heappush(self._heap, (due, session_key, timer_id))
+            if len(self._heap) > 2 * len(self._current) + 1024: self._compact()
+
+    def schedule_if_absent(self, session_key, timer_id, due):
+        with self._lock:
+            if session_key in self._current: return False
+            self._current[session_key] = timer_id; heapq.heappush(self._heap, (due, session_key, timer_id))
+            return True
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap if self._current.get(entry[1]) == entry[2]]; heapq.heapify(self._heap)
+
+    def cancel(self, session_key):
+        with self._lock: self._current.pop(session_key, None)
+
+    def pop_due(self, now, limit):
+        due_timers = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due_timers) < limit:
+                due, session_key, timer_id = heapq.heappop(self._heap)
+                if self._current.get(session_key) != timer_id: continue
+                del self._current[session_key]; due_timers.append((session_key, timer_id, due))
+        return due_timers
+
+    def next_due(self):
+        with self._lock:
+            while self._heap and self._current.get(self._heap[0][1]) != self._heap[0][2]: heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def count(self):
+        return len(self._current)
+
+
+class RedisTimerStore(TimerStore):
+    # ZSET (membro = session_key, score = vencimento) + HASH session_key -> timer_id. Retirar os vencidos é um script Lua:
+    # ler, remover e devolver acontecem atomicamente, sem intercalar com um schedule de outro worker.
+    backend_name = "redis"
+    _POP_DUE = """
+        local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[2]))
+        local popped = {}
+        for i = 1, #due, 2 do
+            local timer_id = redis.call('HGET', KEYS[2], due[i])
+            redis.call('ZREM', KEYS[1], due[i]); redis.call('HDEL', KEYS[2], due[i])
+            if timer_id then popped[#popped + 1] = due[i]; popped[#popped + 1] = timer_id; popped[#popped + 1] = due[i + 1] end
+        end
+        return popped"""
+    _SCHEDULE_IF_ABSENT = """
+        if redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[2]) == 0 then return 0 end
+        redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+        return 1"""
+
+    def __init__(self, client, key_prefix: str = "flow_timers"):
+        self._client = client; self._zset = f"{key_prefix}:due"; self._ids = f"{key_prefix}:ids"
+        self._pop_due = client.register_script(self._POP_DUE); self._schedule_if_absent = client.register_script(self._SCHEDULE_IF_ABSENT)
+
+    def schedule(self, session_key, timer_id, due):
+        with self._client.pipeline() as pipe: pipe.hset(self._ids, session_key, timer_id); pipe.zadd(self._zset, {session_key: due}); pipe.execute()
+
+    def cancel(self, session_key):
+        with self._client.pipeline() as pipe: pipe.zrem(self._zset, session_key); pipe.hdel(self._ids, session_key); pipe.execute()
+
+    def schedule_if_absent(self, session_key, timer_id, due):
+        return bool(self._schedule_if_absent(keys=[self._zset, self._ids], args=[session_key, timer_id, due]))
+
+    def pop_due(self, now, limit):
+        popped = [value.decode("utf-8") if isinstance(value, bytes) else value for value in self._pop_due(keys=[self._zset, self._ids], args=[now, limit])]
+        return [(popped[i], popped[i + 1], float(popped[i + 2])) for i in range(0, len(popped), 3)]
+
+    def next_due(self):
+        first = self._client.zrange(self._zset, 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    def count(self):
+        return self._client.zcard(self._zset)
+
+
+class MySQLTimerStore(TimerStore):
+    # Tabela flow_timers indexada por vencimento; SELECT ... FOR UPDATE + um único DELETE na mesma transação decide quem dispara
+    backend_name = "mysql"
+
+    def __init__(self, connection_factory, table: str = "flow_timers"):
+        self._connection = connection_factory; self._table = table
+        self._table_ready = False  # DDL no primeiro uso, não no import
+
+    def ensure_table(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""CREATE TABLE IF NOT EXISTS {self._table} (
+                    session_key VARCHAR(191) NOT NULL PRIMARY KEY,
+                    timer_id VARCHAR(32) NOT NULL,
+                    due_at DOUBLE NOT NULL,
+                    KEY idx_due_at (due_at)
+                ) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci""")
+                conn.commit()
+            finally: cursor.close()
+        self._table_ready = True
+
+    def _execute(self, query: str, params: tuple = (), fetch: bool = False):
+        if not self._table_ready: self.ensure_table()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params)
+                result = cursor.fetchall() if fetch else cursor.rowcount
+                conn.commit()
+                return result
+            finally: cursor.close()
+
+    def schedule(self, session_key, timer_id, due):
+        self._execute(f"INSERT INTO {self._table} (session_key, timer_id, due_at) VALUES (%s, %s, %s) "
+                      "ON DUPLICATE KEY UPDATE timer_id = VALUES(timer_id), due_at = VALUES(due_at)", (session_key, timer_id, due))
+
+    def cancel(self, session_key):
+        self._execute(f"DELETE FROM {self._table} WHERE session_key = %s", (session_key,))
+
+    def schedule_if_absent(self, session_key, timer_id, due):
+        return self._execute(f"INSERT IGNORE INTO {self._table} (session_key, timer_id, due_at) VALUES (%s, %s, %s)", (session_key, timer_id, due)) == 1
+
+    def pop_due(self, now, limit):
+        # As linhas ficam travadas até o commit: um schedule concorrente da mesma sessão espera e grava o timer novo depois do DELETE
+        if not self._table_ready: self.ensure_table()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SELECT session_key, timer_id, due_at FROM {self._table} WHERE due_at <= %s ORDER BY due_at LIMIT %s FOR UPDATE", (now, limit))
+                rows = cursor.fetchall()
+                if rows: cursor.execute(f"DELETE FROM {self._table} WHERE session_key IN ({', '.join(['%s'] * len(rows))})", tuple(row[0] for row in rows))
+                conn.commit()
+                return [(session_key, timer_id, due) for session_key, timer_id, due in rows]
+            except Exception:
+                conn.rollback(); raise
+            finally: cursor.close()
+
+    def next_due(self):
+        rows = self._execute(f"SELECT MIN(due_at) FROM {self._table}", fetch=True)
+        return rows[0][0] if rows and rows[0][0] is not None else None
+
+    def count(self):
+        rows = self._execute(f"SELECT COUNT(*) FROM {self._table}", fetch=True)
+        return int(rows[0][0]) if rows else 0
+
+
+class TimerScheduler:
+    # Thread por processo que retira os timers vencidos e os dispara no executor (ordem por sessão preservada)
+    def __init__(self, store: TimerStore, fire, executor, poll_interval: float = 1.0, batch_size: int = 500,
+                 retry_base: float = 5.0, retry_max: float = 300.0, max_attempts: int = 10):
+        # fire(session_key, timer_id) roda no executor e levanta exceção se o disparo não foi gravado; executor.submit(chave, fn) serializa por chave
+        self.store = store; self._fire = fire; self._executor = executor
+        self.poll_interval = poll_interval; self.batch_size = batch_size
+        self.retry_base = retry_base; self.retry_max = retry_max; self.max_attempts = max_attempts
+        self._wakeup = threading.Event(); self._started = ProcessOnce(); self._lock = threading.Lock()
+        self._fired = 0; self._failed = 0; self._attempts = {}  # (session_key, timer_id) -> disparos que falharam
+
+    def schedule(self, session_key: str, timer: dict):
+        self.store.schedule(session_key, timer["id"], timer["due"])
+        if self._started.done: self._wakeup.set()  # Pode ser mais cedo que o vencimento que o loop está esperando
+
+    def cancel(self, session_key: str):
+        self.store.cancel(session_key)
+
+    def start(self):
+        if self.poll_interval <= 0: return
+        if self._started.run(self._start_loop): logger.info(f"Scheduler de timers iniciado (backend {self.store.backend_name}, polling {self.poll_interval}s).")
+
+    def _start_loop(self):
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._loop, name="timer-scheduler", daemon=True).start()
+
+    def _dispatch(self, session_key: str, timer_id: str):
+        def job():
+            try: self._fire(session_key, timer_id)
+            except Exception as e: self._failed += 1; self._retry(session_key, timer_id, e)
+            else:
+                self._fired += 1
+                with self._lock: self._attempts.pop((session_key, timer_id), None)
+        self._executor.submit(session_key, job)
+
+    def _retry(self, session_key: str, timer_id: str, error: Exception):
+        # Disparo não gravado (sessão ilegível, conflito de CAS, backend fora): o timer volta ao índice com backoff exponencial.
+        # Se a sessão já agendou outro timer, este está obsoleto e não é devolvido; um delay abandonado segue na próxima mensagem.
+        with self._lock: attempts = self._attempts[(session_key, timer_id)] = self._attempts.get((session_key, timer_id), 0) + 1
+        if attempts >= self.max_attempts:
+            with self._lock: self._attempts.pop((session_key, timer_id), None)
+            logger.error(f"Timer {timer_id} da sessão {session_key} abandonado após {attempts} falhas: {error}", exc_info=error); return
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        logger.warning(f"Timer {timer_id} da sessão {session_key} falhou ({error}). Nova tentativa em {delay:.0f}s ({attempts}/{self.max_attempts}).")
+        try: self.store.schedule_if_absent(session_key, timer_id, time.time() + delay)
+        except Exception as e: logger.error(f"Timer {timer_id} da sessão {session_key}: falha ao reagendar ({self.store.backend_name}): {e}")
+
+    def run_due(self, now: float | None = None) -> int:
+        due_timers = self.store.pop_due(time.time() if now is None else now, self.batch_size)
+        for session_key, timer_id, _ in due_timers:
+            try: self._dispatch(session_key, timer_id)
+            except Exception as e:
+                # Fila cheia: devolve o timer para daqui a pouco em vez de perdê-lo
+                logger.warning(f"Timer {timer_id} da sessão {session_key} adiado: {e}")
+                self.store.schedule_if_absent(session_key, timer_id, time.time() + self.poll_interval)
+        return len(due_timers)
+
+    def _loop(self):
+        while True:
+            try:
+                if self.run_due() >= self.batch_size: continue  # Ainda há vencidos: segue drenando
+                next_due = self.store.next_due()
+                wait = self.poll_interval if next_due is None else min(self.poll_interval, max(0.0, next_due - time.time()))
+            except Exception as e:
+                logger.warning(f"Scheduler de timers: falha ao consultar o backend ({self.store.backend_name}): {e}"); wait = self.poll_interval
+            self._wakeup.wait(wait); self._wakeup.clear()
+
+    def stats(self) -> dict:
+        try: pending = self.store.count()
+        except Exception: pending = None
+        return {"backend": self.store.backend_name, "pending": pending, "fired": self._fired, "failed": self._failed}
+
+
+def create_timer_store(backend: str | None = None, mysql_connection_factory=None) -> TimerStore:
+    # Mesmo backend do session store por padrão (TIMER_STORE_BACKEND sobrescreve)
+    backend = (backend or os.environ.get("TIMER_STORE_BACKEND") or os.environ.get("SESSION_STORE_BACKEND", "memory")).lower()
+    if backend == "memory": return InMemoryTimerStore()
+    if backend == "redis":
+        try: import redis
+        except ImportError as e: raise RuntimeError("TIMER_STORE_BACKEND=redis requer o pacote 'redis' instalado.") from e
+        return RedisTimerStore(redis.Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/0")), os.environ.get("TIMER_KEY_PREFIX", "flow_timers"))
+    if backend == "mysql":
+        if mysql_connection_factory is None: raise RuntimeError("TIMER_STORE_BACKEND=mysql requer uma fábrica de conexões MySQL.")
+        return MySQLTimerStore(mysql_connection_factory, os.environ.get("TIMER_TABLE", "flow_timers"))
+    raise ValueError(f"TIMER_STORE_BACKEND desconhecido: '{backend}' (use memory, redis ou mysql).")
+
+
+def create_scheduler_from_env(store: TimerStore, fire, executor) -> TimerScheduler:
+    return TimerScheduler(store, fire, executor, float(os.environ.get("TIMER_POLL_INTERVAL", "1")), int(os.environ.get("TIMER_BATCH_SIZE", "500")),
+                          float(os.environ.get("TIMER_RETRY_BASE", "5")), float(os.environ.get("TIMER_RETRY_MAX", "300")), int(os.environ.get("TIMER_MAX_ATTEMPTS", "10")))